@@ -20,19 +20,77 @@ Env overrides:
 - EMBEDDING_CHUNK_SIZE        -> chunk size in characters (default: 800)
 - EMBEDDING_CHUNK_OVERLAP     -> overlap in characters (default: 200)
 - EMBEDDING_MIN_CHARS         -> minimum chars per chunk (default: 100)
-- EMBEDDING_BATCH_SIZE        -> batch size for encoding (default: 64)
+- EMBEDDING_BATCH_SIZE        -> batch size for encoding when EMBEDDING_SORT_WINDOW=0 (default: 64)
+- EMBEDDING_TOKEN_BUDGET      -> padded tokens per encoder batch (default: 16384)
+- EMBEDDING_SORT_WINDOW       -> chunks sorted by token length together; 0 = fixed
+                                 EMBEDDING_BATCH_SIZE slices in file order (default: 1024)
+- EMBEDDING_DEVICES           -> encoder processes, one model copy each: comma-separated devices
+                                 (e.g. cuda:0,cuda:1) or "cuda" for all GPUs (default: none,
+                                 the model runs in this process)
+- EMBEDDING_CPU_ENCODERS      -> N CPU encoder processes if EMBEDDING_DEVICES is unset (default: 0);
+                                 they share the CPUs of SLURM_CPUS_PER_TASK (or the CPU count)
+- EMBEDDING_POOL_MIN_COSINE   -> required cosine of the encoder pool vs. the in-process model at
+                                 startup, below it the model runs in this process (default: 0.999)
+- EMBEDDING_CACHE             -> 1 = reuse embeddings of identical chunk texts (default: 1)
+- EMBEDDING_CACHE_URI         -> LanceDB directory of the embedding cache (default: DB dir)
+- EMBEDDING_DEDUP             -> near-duplicate threshold (estimated Jaccard of word 3-grams);
+                                 chunks at least this similar to a chunk already in the table
+                                 or earlier in the run are dropped, 0 = off (default: 0)
+- EMBEDDING_CHECKPOINT_SECONDS -> seconds between progress checkpoints (default: 120)
+- EMBEDDING_MANIFEST          -> manifest path (default: <DB>/<table>.manifest.json)
+- EMBEDDING_WORKERS           -> processes for PDF extraction + chunking
+                                 (default: SLURM_CPUS_PER_TASK or CPU count, max 16)
+- EMBEDDING_PDF_TIMEOUT       -> seconds per PDF before it is skipped (default: 300)
+- EMBEDDING_QUEUE_SIZE        -> max batches waiting between pipeline stages (default: 8)
+- EMBEDDING_WRITE_ROWS        -> rows per LanceDB write (default: 4096)
 - CLEAR_TABLE=1               -> drop/recreate table before ingest
+
+Incremental by default: the manifest stores a sha256 per PDF plus the model and
+chunking parameters. Only new or changed PDFs are extracted and embedded (their
+old rows are replaced), removed PDFs are purged, unchanged PDFs are skipped.
+Changing the model or a chunking parameter rebuilds everything.
+
+Chunk ids are uuid5(doc sha256, page, chunk index, chunking parameters), so the same
+chunk keeps its id across runs. Rows are written with a LanceDB merge-insert on "id":
+re-ingesting the same PDF writes nothing.
+
+Extraction, embedding and writing run as a pipeline with bounded queues, so memory
+stays flat for any corpus size and rows are persisted while later PDFs are still parsed.
+
+Progress is checkpointed into the manifest every EMBEDDING_CHECKPOINT_SECONDS (PDFs whose
+rows are committed + the last committed chunk of the PDF in progress). SIGTERM / Ctrl+C
+writes the rows embedded so far, checkpoints and stops; continue with --resume.
+
+Usage:
+  python build_pdf_embeddings.py            # incremental update
+  python build_pdf_embeddings.py --resume   # continue an interrupted run (CLEAR_TABLE is not applied again)
 """
 
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import re
+import signal
+import threading
+import time
 import uuid
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
+import numpy as np
+import pyarrow as pa
 from pypdf import PdfReader
 from sentence_transformers import SentenceTransformer
 import lancedb
 
+from embedding_cache import EmbeddingCache
+
 
 # ---------------- PATHS (repo-aligned defaults) ---------------- #
 
@@ -63,9 +121,33 @@ CHUNK_SIZE = int(os.environ.get("EMBEDDING_CHUNK_SIZE", 800))
 CHUNK_OVERLAP = int(os.environ.get("EMBEDDING_CHUNK_OVERLAP", 200))
 MIN_CHUNK_LEN = int(os.environ.get("EMBEDDING_MIN_CHARS", 100))
 BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 64))
+TOKEN_BUDGET = int(os.environ.get("EMBEDDING_TOKEN_BUDGET", 16384))
+SORT_WINDOW = int(os.environ.get("EMBEDDING_SORT_WINDOW", 1024))
+DEVICES = os.environ.get("EMBEDDING_DEVICES", "").strip()
+CPU_ENCODERS = int(os.environ.get("EMBEDDING_CPU_ENCODERS", 0))
+POOL_MIN_COSINE = float(os.environ.get("EMBEDDING_POOL_MIN_COSINE", 0.999))
+EMBED_CACHE = int(os.environ.get("EMBEDDING_CACHE", 1))
+DEDUP_THRESHOLD = float(os.environ.get("EMBEDDING_DEDUP", 0))
 
 CLEAR_TABLE = int(os.environ.get("CLEAR_TABLE", "0"))  # 1 = rebuild from scratch
 
+CPUS = int(os.environ.get("SLURM_CPUS_PER_TASK", 0)) or os.cpu_count() or 1  # CPUs of this job
+WORKERS = int(os.environ.get("EMBEDDING_WORKERS", min(16, CPUS)))
+PDF_TIMEOUT = int(os.environ.get("EMBEDDING_PDF_TIMEOUT", 300))
+CHECKPOINT_SECONDS = int(os.environ.get("EMBEDDING_CHECKPOINT_SECONDS", 120))
+QUEUE_SIZE = int(os.environ.get("EMBEDDING_QUEUE_SIZE", 8))
+WRITE_ROWS = int(os.environ.get("EMBEDDING_WRITE_ROWS", 4096))
+
+CACHE_URI = Path(os.environ.get("EMBEDDING_CACHE_URI", str(DB_URI))).expanduser()
+
+MANIFEST_PATH = Path(
+    os.environ.get("EMBEDDING_MANIFEST", str(DB_URI / f"{TABLE_NAME}.manifest.json"))
+).expanduser()
+MANIFEST_VERSION = 1
+
+# fixed namespace for the deterministic chunk ids (never change it: all ids would change)
+CHUNK_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "fuzzybot-hsbi/pdf_chunks")
+
 
 # ---------------- HELPERS ---------------- #
 
@@ -76,6 +158,111 @@ def scan_pdfs(folder: Path) -> List[Path]:
     return pdfs
 
 
+# ---------------- MANIFEST (incremental ingest) ---------------- #
+
+def ingest_params() -> Dict[str, Any]:
+    """Everything besides the PDF bytes that changes the stored rows."""
+    return {
+        "model": MODEL_NAME,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "min_chars": MIN_CHUNK_LEN,
+        "chunk_ids": "uuid5-v1",  # tables with random ids are rebuilt once
+        # 2: doc_sha256 column + fixed-size float32 vector column, 3: + minhash column (EMBEDDING_DEDUP)
+        "schema": 3 if DEDUP_THRESHOLD > 0 else 2,
+        "dedup": DEDUP_THRESHOLD,
+    }
+
+
+def chunk_id(doc_sha256: str, page: int, chunk_idx: int) -> str:
+    """Stable id of a chunk: same PDF bytes + same chunking -> same id."""
+    key = f"{doc_sha256}:{page}:{chunk_idx}:{CHUNK_SIZE}:{CHUNK_OVERLAP}:{MIN_CHUNK_LEN}"
+    return str(uuid.uuid5(CHUNK_ID_NAMESPACE, key))
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(path: Path) -> Dict[str, Any]:
+    try:
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+        print(f"[WARN] Manifest version mismatch in {path}, ignoring it.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Could not read manifest {path} ({e}), ignoring it.")
+    return {"version": MANIFEST_VERSION, "params": None, "files": {}, "resume": None}
+
+
+def save_manifest(path: Path, manifest: Dict[str, Any]) -> None:
+    """Write atomically, so an interrupted run never leaves a half-written manifest."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def plan_ingest(pdf_paths: List[Path], root: Path, manifest: Dict[str, Any]):
+    """
+    Compare the PDFs on disk with the manifest.
+    Returns (to_process, unchanged, removed, states):
+      to_process: new or changed PDFs, removed: manifest keys no longer on disk,
+      states: manifest entry per current PDF (key = path relative to the PDF folder).
+    The sha256 is only recomputed when size or mtime differ from the manifest.
+    """
+    known = manifest["files"]
+    to_process: List[Path] = []
+    unchanged: List[Path] = []
+    states: Dict[str, Dict[str, Any]] = {}
+
+    for path in pdf_paths:
+        key = path.relative_to(root).as_posix()
+        st = path.stat()
+        old = known.get(key)
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            sha = old["sha256"]
+        else:
+            sha = file_sha256(path)
+
+        states[key] = {"doc_id": path.name, "sha256": sha, "size": st.st_size, "mtime": st.st_mtime}
+        if old and old["sha256"] == sha:
+            states[key]["chunks"] = old.get("chunks", 0)
+            if "dups_of" in old:
+                states[key]["dups_of"] = old["dups_of"]
+            unchanged.append(path)
+        else:
+            to_process.append(path)
+
+    removed = [key for key in known if key not in states]
+    return to_process, unchanged, removed, states
+
+
+def dedup_dependents(unchanged: List[Path], root: Path, states: Dict[str, Dict[str, Any]]) -> List[Path]:
+    """
+    Unchanged PDFs that had chunks dropped as near-duplicates of a PDF version that is
+    gone now (changed or removed). They are processed again so the dropped chunks come back.
+    """
+    deps = []
+    for path in unchanged:
+        dups_of = states[path.relative_to(root).as_posix()].get("dups_of", {})
+        if any(states.get(key, {}).get("sha256") != sha for key, sha in dups_of.items()):
+            deps.append(path)
+    return deps
+
+
+def doc_filter(doc_ids: List[str]) -> str:
+    """SQL filter matching all rows of the given doc_ids."""
+    quoted = ", ".join("'" + d.replace("'", "''") + "'" for d in sorted(set(doc_ids)))
+    return f"doc_id IN ({quoted})"
+
+
 def extract_pdf_text(path: Path) -> List[Dict[str, Any]]:
     """Extract per-page text from a PDF."""
     reader = PdfReader(str(path))
@@ -138,96 +325,769 @@ def chunk_text(text: str) -> List[str]:
     return chunks
 
 
-def build_records_from_pdfs(pdf_paths: List[Path]) -> List[Dict[str, Any]]:
-    records: List[Dict[str, Any]] = []
+class PdfTimeout(Exception):
+    pass
+
+
+def _on_alarm(_signum, _frame):
+    raise PdfTimeout()
 
-    for pdf_path in pdf_paths:
-        print(f"[INFO] Processing PDF: {pdf_path}")
-        pages = extract_pdf_text(pdf_path)
 
+def process_pdf(pdf_path: Path, doc_sha: str, timeout: int) -> Tuple[List[Dict[str, Any]], int, Optional[str]]:
+    """
+    Extract + chunk one PDF (runs in a worker process).
+    Returns (records, pages, error). pypdf is pure Python, so SIGALRM interrupts it
+    reliably after `timeout` seconds.
+    """
+    if timeout > 0:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.alarm(timeout)
+    try:
+        pages = extract_pdf_text(pdf_path)
+        records: List[Dict[str, Any]] = []
         for page in pages:
             chunks = chunk_text(page["text"])
             for chunk_idx, chunk in enumerate(chunks):
                 records.append(
                     {
-                        "id": str(uuid.uuid4()),
+                        "id": chunk_id(doc_sha, page["page"], chunk_idx),
                         "doc_id": page["doc_id"],
+                        "doc_sha256": doc_sha,
                         "page": page["page"],
                         "chunk": chunk_idx,
                         "text": chunk,
                         # "vector" added later
                     }
                 )
+                if DEDUP_THRESHOLD > 0:
+                    records[-1]["minhash"] = minhash(chunk)
+        return records, len(pages), None
+    except PdfTimeout:
+        return [], 0, f"timeout after {timeout}s"
+    except Exception as e:
+        return [], 0, f"{type(e).__name__}: {e}"
+    finally:
+        if timeout > 0:
+            signal.alarm(0)
+
+
+# ---------------- NEAR-DUPLICATES (MinHash + LSH) ---------------- #
+
+MINHASH_PERM = 64
+LSH_BANDS = 16  # 4 rows per band: pairs above ~0.5 Jaccard become candidates
+_MINHASH_PRIME = 4294967291  # largest prime < 2**32, so signatures fit in uint32
+_rng = np.random.default_rng(20240611)  # fixed: signatures must not change between runs / workers
+_MINHASH_A = _rng.integers(1, _MINHASH_PRIME, MINHASH_PERM, dtype=np.uint64)
+_MINHASH_B = _rng.integers(0, _MINHASH_PRIME, MINHASH_PERM, dtype=np.uint64)
+_WORD_RE = re.compile(r"\w+")
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature (uint32[MINHASH_PERM]) of the lowercased word 3-grams of text."""
+    words = _WORD_RE.findall(text.lower())
+    shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+    x = np.fromiter((zlib.crc32(sh.encode("utf-8")) for sh in shingles), dtype=np.uint64, count=len(shingles))
+    # (a * x + b) mod p stays below 2**64 for a, b < p and x < 2**32
+    hashed = (_MINHASH_A[:, None] * x[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+class NearDupIndex:
+    """
+    LSH index over the MinHash signatures of the kept chunks. seed() adds the committed
+    rows of the table. add() returns the index of a kept chunk whose estimated Jaccard
+    similarity is >= threshold (the new chunk is a near-duplicate and not added, its
+    owner is owners[index]), or None (kept and added). A row id that was seeded counts
+    as kept: rows already in the table are never dropped again.
+    """
+
+    def __init__(self, threshold: float, bands: int = LSH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.sigs: List[np.ndarray] = []
+        self.owners: List[Any] = []
+        self.seeded_ids = set()
+
+    def _keys(self, sig: np.ndarray) -> List[bytes]:
+        rows = len(sig) // self.bands
+        return [sig[b * rows:(b + 1) * rows].tobytes() for b in range(self.bands)]
+
+    def _insert(self, sig: np.ndarray, owner, keys: List[bytes]) -> None:
+        idx = len(self.sigs)
+        self.sigs.append(sig)
+        self.owners.append(owner)
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, []).append(idx)
+
+    def seed(self, sig: np.ndarray, owner, row_id: str) -> None:
+        self._insert(sig, owner, self._keys(sig))
+        self.seeded_ids.add(row_id)
+
+    def add(self, sig: np.ndarray, owner=None, row_id: Optional[str] = None) -> Optional[int]:
+        if row_id is not None and row_id in self.seeded_ids:
+            return None
+        keys = self._keys(sig)
+        candidates = set()
+        for bucket, key in zip(self.buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        for c in sorted(candidates):
+            if np.mean(self.sigs[c] == sig) >= self.threshold:
+                return c
+
+        self._insert(sig, owner, keys)
+        return None
+
+
+def seed_dedup(dedup: NearDupIndex, table, owners: Dict[Tuple[str, str], Path], order: Dict[Path, int]) -> int:
+    """
+    Add the committed rows of the PDFs in `owners` ((doc_id, doc_sha256) -> path) to
+    `dedup`, in file order. Returns the number of rows seeded.
+    """
+    if table is None or not owners:
+        return 0
+    columns = ["id", "doc_id", "doc_sha256", "page", "chunk", "minhash"]
+    try:
+        arrow = table.to_lance().to_table(columns=columns)
+    except Exception:
+        arrow = table.to_arrow().select(columns)
+
+    sigs = arrow.column("minhash").combine_chunks().flatten().to_numpy().reshape(-1, MINHASH_PERM)
+    rows = []
+    for i, (row_id, doc_id, sha, page, chunk) in enumerate(zip(
+            *(arrow.column(c).to_pylist() for c in columns[:-1]))):
+        path = owners.get((doc_id, sha))
+        if path is not None:
+            rows.append((order[path], page, chunk, i, row_id, path))
+    rows.sort()
+    for _, _, _, i, row_id, path in rows:
+        dedup.seed(sigs[i].astype(np.uint32), path, row_id)
+    return len(rows)
+
+
+# ---------------- STOP (SIGTERM / Ctrl+C) ---------------- #
+
+_STOP = threading.Event()
+
+
+def _on_stop(signum, _frame):
+    if _STOP.is_set():
+        raise KeyboardInterrupt  # second signal: stop right away
+    print(f"[WARN] Received signal {signum}: writing the rows embedded so far, then stopping...")
+    _STOP.set()
+
+
+def install_stop_handlers() -> None:
+    """Slurm sends SIGTERM at the time limit (SIGKILL follows after KillWait, 30s by default)."""
+    signal.signal(signal.SIGTERM, _on_stop)
+    signal.signal(signal.SIGINT, _on_stop)
+
+
+# ---------------- PIPELINE: extract -> embed -> write ---------------- #
+#
+# Three overlapping stages connected by bounded queues:
+#   extraction (process pool, main thread) -> chunk_q -> embedding thread
+#   -> batch_q -> writer thread -> LanceDB
+# Peak memory is bounded by the queue sizes and in-flight PDFs, not by the corpus.
 
-    print(f"[INFO] Total text chunks: {len(records)}")
-    return records
+_DONE = object()  # end-of-stream marker on the queues
 
 
-def embed_records(records: List[Dict[str, Any]], model: SentenceTransformer) -> None:
-    if not records:
+def _noop() -> None:
+    return None
+
+
+def start_extract_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    """
+    Start the worker processes right away: with the fork start method all workers
+    are forked at the first submit, so this happens before the model is loaded and
+    before the pipeline threads exist.
+    """
+    if workers <= 1:
+        return None
+    pool = ProcessPoolExecutor(max_workers=workers)
+    pool.submit(_noop).result()
+    return pool
+
+
+def iter_extracted(pdf_paths: List[Path], hashes: List[str], pool: Optional[ProcessPoolExecutor],
+                   workers: int, timeout: int):
+    """
+    Yield (index, records, pages, error) per PDF, in pdf_paths order. At most
+    2 * workers PDFs are in flight, so finished results waiting for their turn stay bounded.
+    """
+    if pool is None:
+        for i, pdf_path in enumerate(pdf_paths):
+            yield (i, *process_pdf(pdf_path, hashes[i], timeout))
         return
 
-    print("[INFO] Computing embeddings...")
-    texts = [r["text"] for r in records]
+    inflight = {}
+    next_submit = 0
+    for i in range(len(pdf_paths)):
+        while next_submit < len(pdf_paths) and len(inflight) < 2 * workers:
+            inflight[next_submit] = pool.submit(process_pdf, pdf_paths[next_submit], hashes[next_submit], timeout)
+            next_submit += 1
+        try:
+            result = inflight.pop(i).result()
+        except Exception as e:  # worker crashed (e.g. killed by the OOM killer)
+            result = ([], 0, f"worker failed: {e}")
+        yield (i, *result)
 
-    for start in range(0, len(texts), BATCH_SIZE):
-        end = min(start + BATCH_SIZE, len(texts))
-        batch_texts = texts[start:end]
 
-        embs = model.encode(
-            batch_texts,
-            batch_size=len(batch_texts),
-            show_progress_bar=False,
-            convert_to_numpy=True,
-        )
+def arrow_schema(dim: int) -> pa.Schema:
+    fields = [
+        pa.field("id", pa.string()),
+        pa.field("doc_id", pa.string()),
+        pa.field("doc_sha256", pa.string()),
+        pa.field("page", pa.int64()),
+        pa.field("chunk", pa.int64()),
+        pa.field("text", pa.string()),
+    ]
+    if DEDUP_THRESHOLD > 0:
+        # signatures of the kept chunks, so later incremental runs compare against them
+        fields.append(pa.field("minhash", pa.list_(pa.uint32(), MINHASH_PERM)))
+    return pa.schema(fields + [pa.field("vector", pa.list_(pa.float32(), dim))])
+
+
+def to_record_batch(records: List[Dict[str, Any]], embs: np.ndarray, schema: pa.Schema) -> pa.RecordBatch:
+    """Records + (n, dim) embeddings -> Arrow batch; the vectors go in as one flat float32 buffer."""
+    embs = np.ascontiguousarray(embs, dtype=np.float32)
+    vectors = pa.FixedSizeListArray.from_arrays(pa.array(embs.reshape(-1), type=pa.float32()), embs.shape[1])
+    columns = [
+        pa.array([r[name] for r in records], type=schema.field(name).type)
+        for name in schema.names if name != "vector"
+    ]
+    return pa.RecordBatch.from_arrays(columns + [vectors], schema=schema)
+
+
+def token_lengths(texts: List[str], model: SentenceTransformer) -> List[int]:
+    """Tokens per text as the encoder sees them (special tokens, truncation to max_seq_length)."""
+    enc = model.tokenizer(texts, truncation=True, max_length=model.max_seq_length)
+    return [len(ids) for ids in enc["input_ids"]]
+
 
-        for i, emb in enumerate(embs):
-            records[start + i]["vector"] = emb.astype("float32").tolist()
+def fixed_batches(n: int, batch_size: int) -> List[List[int]]:
+    return [list(range(start, min(n, start + batch_size))) for start in range(0, n, batch_size)]
 
-        print(f"[INFO] Embedded {end}/{len(texts)} chunks")
 
-    print("[INFO] Embeddings computed.")
+def length_batches(lengths: List[int], token_budget: int) -> List[List[int]]:
+    """
+    Indices sorted by length (longest first), cut into batches whose padded size
+    (items * longest item) stays within token_budget. Every batch has at least one item.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches: List[List[int]] = []
+    for i in order:
+        # the first item of a batch is its longest, so it sets the padded length
+        if batches and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= token_budget:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+
+def padded_tokens(lengths: List[int], batches: List[List[int]]) -> int:
+    return sum(len(b) * max(lengths[i] for i in b) for b in batches)
+
+
+class EmbedStats:
+    """Encoder throughput and padding of the batches actually run vs. fixed slices in file order."""
+
+    def __init__(self):
+        self.texts = 0
+        self.tokens = 0
+        self.padded = 0
+        self.padded_fixed = 0
+        self.seconds = 0.0
+
+    def report(self) -> None:
+        if not self.texts:
+            return
+
+        def pad_pct(padded: int) -> float:
+            return 100.0 * (1.0 - self.tokens / padded) if padded else 0.0
+
+        tps = self.tokens / self.seconds if self.seconds > 0 else 0.0
+        print(
+            f"[INFO] Embedding: {self.texts} chunk(s), {self.tokens} tokens in {self.seconds:.1f}s "
+            f"({tps:.0f} tokens/s), padding {pad_pct(self.padded):.1f}% "
+            f"(fixed batches of {BATCH_SIZE} in file order: {pad_pct(self.padded_fixed):.1f}%)"
+        )
 
 
-def upsert_into_lancedb(records: List[Dict[str, Any]], db_uri: Path, table_name: str) -> None:
-    if not records:
-        print("[WARN] No records to store.")
+def plan_embed(texts: List[str], model: SentenceTransformer, stats: EmbedStats) -> List[List[int]]:
+    """
+    Length-sorted batches under TOKEN_BUDGET (or fixed BATCH_SIZE slices in the given
+    order if SORT_WINDOW=0), as lists of indices into texts.
+    """
+    lengths = token_lengths(texts, model)
+    fixed = fixed_batches(len(texts), BATCH_SIZE)
+    batches = length_batches(lengths, TOKEN_BUDGET) if SORT_WINDOW > 0 else fixed
+    stats.texts += len(texts)
+    stats.tokens += sum(lengths)
+    stats.padded += padded_tokens(lengths, batches)
+    stats.padded_fixed += padded_tokens(lengths, fixed)
+    return batches
+
+
+def encode_batch(model: SentenceTransformer, texts: List[str]) -> np.ndarray:
+    return model.encode(
+        texts,
+        batch_size=len(texts),
+        show_progress_bar=False,
+        convert_to_numpy=True,
+    )
+
+
+def embed_texts(texts: List[str], model: SentenceTransformer, stats: EmbedStats) -> np.ndarray:
+    """Encode texts with the in-process model; embeddings come back in input order."""
+    batches = plan_embed(texts, model, stats)
+    t0 = time.perf_counter()
+    embs = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    for batch in batches:
+        embs[batch] = encode_batch(model, [texts[i] for i in batch])
+    stats.seconds += time.perf_counter() - t0
+    return embs
+
+
+# ---------------- ENCODER POOL ---------------- #
+
+PARITY_TEXTS = [
+    "Wie starte ich einen interaktiven Job auf dem Cluster?",
+    "How do I copy data to the scratch file system?",
+    "Hallo",
+]
+
+
+def encoder_devices() -> List[str]:
+    """Devices of the encoder pool from EMBEDDING_DEVICES / EMBEDDING_CPU_ENCODERS ([] = no pool)."""
+    if DEVICES == "cuda":
+        import torch
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    if DEVICES:
+        return [d.strip() for d in DEVICES.split(",") if d.strip()]
+    if CPU_ENCODERS > 1:
+        return ["cpu"] * CPU_ENCODERS
+    return []
+
+
+def _encoder_worker(model_name: str, device: str, threads: int, in_q, out_q) -> None:
+    """Encoder process: one model copy on `device`, (task_id, texts) in, (task_id, embs, error) out."""
+    # the parent handles SIGTERM / Ctrl+C and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    try:
+        model = SentenceTransformer(model_name, device=device)
+    except Exception as e:
+        out_q.put((None, None, f"{device}: {e}"))
         return
+    out_q.put((None, None, None))  # ready
 
+    while True:
+        task = in_q.get()
+        if task is None:
+            break
+        task_id, texts = task
+        try:
+            out_q.put((task_id, encode_batch(model, texts), None))
+        except Exception as e:
+            out_q.put((task_id, None, f"{device}: {e}"))
+
+
+class EncoderPool:
+    """
+    One model copy per device, each in its own spawned process, all fed from one shared
+    task queue: an idle encoder takes the next batch. Results are scattered back by
+    index, so the output order does not depend on which encoder finished first.
+    """
+
+    def __init__(self, model_name: str, devices: List[str]):
+        ctx = multiprocessing.get_context("spawn")  # CUDA cannot be used in forked children
+        self.in_q = ctx.Queue()
+        self.out_q = ctx.Queue()
+        cpu_threads = max(1, CPUS // max(1, devices.count("cpu")))
+        self.procs = [
+            ctx.Process(
+                target=_encoder_worker,
+                args=(model_name, d, cpu_threads if d == "cpu" else 0, self.in_q, self.out_q),
+                daemon=True,
+            )
+            for d in devices
+        ]
+        for p in self.procs:
+            p.start()
+        self.devices = devices
+        self.next_id = 0
+        self.results: Dict[int, np.ndarray] = {}
+        try:
+            for _ in self.procs:
+                _, _, error = self._get()
+                if error:
+                    raise RuntimeError(f"Encoder failed to start: {error}")
+        except BaseException:
+            self.close()
+            raise
+        print(f"[INFO] Encoder pool: {len(devices)} process(es) on {', '.join(devices)}")
+
+    def submit(self, texts: List[str], batches: List[List[int]]) -> List[int]:
+        task_ids = []
+        for batch in batches:
+            self.in_q.put((self.next_id, [texts[i] for i in batch]))
+            task_ids.append(self.next_id)
+            self.next_id += 1
+        return task_ids
+
+    def collect(self, task_ids: List[int], batches: List[List[int]], n: int, dim: int) -> np.ndarray:
+        embs = np.empty((n, dim), dtype=np.float32)
+        for task_id, batch in zip(task_ids, batches):
+            while task_id not in self.results:
+                done_id, result, error = self._get()
+                if error:
+                    raise RuntimeError(f"Encoder failed: {error}")
+                self.results[done_id] = result
+            embs[batch] = self.results.pop(task_id)
+        return embs
+
+    def encode(self, texts: List[str], dim: int) -> np.ndarray:
+        batches = [list(range(len(texts)))]
+        return self.collect(self.submit(texts, batches), batches, len(texts), dim)
+
+    def _get(self):
+        while True:
+            try:
+                return self.out_q.get(timeout=5)
+            except queue.Empty:
+                dead = [p for p in self.procs if not p.is_alive()]
+                if dead:
+                    raise RuntimeError(f"{len(dead)} encoder process(es) died (exit code {dead[0].exitcode})")
+
+    def close(self) -> None:
+        for _ in self.procs:
+            self.in_q.put(None)
+        for p in self.procs:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+
+
+def parity_check(model: SentenceTransformer, encoders: EncoderPool) -> float:
+    """Minimum cosine similarity between the in-process model and the pool's embeddings."""
+    ref = encode_batch(model, PARITY_TEXTS)
+    got = encoders.encode(PARITY_TEXTS, ref.shape[1])
+    ref = ref / np.linalg.norm(ref, axis=1, keepdims=True)
+    got = got / np.linalg.norm(got, axis=1, keepdims=True)
+    return float((ref * got).sum(axis=1).min())
+
+
+def open_db(db_uri: Path):
     db_uri = Path(db_uri).expanduser()
     db_uri.mkdir(parents=True, exist_ok=True)
-
     print(f"[INFO] Connecting to LanceDB at '{db_uri}'...")
-    db = lancedb.connect(str(db_uri))
+    return lancedb.connect(str(db_uri))
 
-    if CLEAR_TABLE and table_name in db.table_names():
-        print(f"[WARN] CLEAR_TABLE=1 -> dropping existing table '{table_name}'")
-        db.drop_table(table_name)
 
-    if table_name in db.table_names():
-        print(f"[INFO] Appending to existing table '{table_name}'...")
-        table = db.open_table(table_name)
-        table.add(records)
-    else:
-        print(f"[INFO] Creating table '{table_name}'...")
-        table = db.create_table(table_name, records)
+class TableWriter:
+    """
+    Writes Arrow tables with a merge-insert on "id": rows whose id already exists are
+    left alone, new ids are inserted. Creates the table on the first write.
+    """
 
-    # Create/ensure vector index (best-effort)
-    try:
-        print("[INFO] Ensuring vector index on 'vector' column...")
-        table.create_index("vector")
-    except Exception as e:
-        print(f"[WARN] Could not create index (non-fatal): {e}")
+    def __init__(self, db, table_name: str, schema: pa.Schema):
+        self.db = db
+        self.table_name = table_name
+        self.schema = schema
+        self.table = db.open_table(table_name) if table_name in db.table_names() else None
+        self.rows_written = 0  # rows committed so far, in pipeline order
+        self.lock = threading.Lock()  # writer thread vs. checkpoint deletes
+
+    def write(self, data: pa.Table) -> None:
+        with self.lock:
+            if self.table is None:
+                print(f"[INFO] Creating table '{self.table_name}'...")
+                self.table = self.db.create_table(self.table_name, data, schema=self.schema)
+                try:
+                    self.table.create_scalar_index("id")  # speeds up the merge-insert join
+                except Exception as e:
+                    print(f"[WARN] Could not create scalar index on 'id' (non-fatal): {e}")
+            else:
+                self.table.merge_insert("id").when_not_matched_insert_all().execute(data)
+            self.rows_written += data.num_rows
+
+    def delete_stale(self, doc_ids: List[str], keep_shas) -> None:
+        """Delete the rows of doc_ids whose doc_sha256 is not in keep_shas (old versions)."""
+        if not doc_ids or self.table is None:
+            return
+        stale = doc_filter(doc_ids)
+        if keep_shas:
+            quoted = ", ".join(f"'{sha}'" for sha in sorted(set(keep_shas)))
+            stale = f"{stale} AND doc_sha256 NOT IN ({quoted})"
+        with self.lock:
+            self.table.delete(stale)
+        print(f"[INFO] Deleted stale rows of {len(set(doc_ids))} document(s).")
+
+    def finish(self, replace_doc_ids: List[str], keep_shas) -> None:
+        """
+        Delete stale rows: every row of replaced doc_ids (changed or removed PDFs)
+        that does not belong to a current PDF version. Then index + compact.
+        """
+        if self.table is None:
+            print("[WARN] No records to store.")
+            return
+
+        self.delete_stale(replace_doc_ids, keep_shas)
+
+        if self.rows_written:
+            # Create/ensure vector index (best-effort)
+            try:
+                print("[INFO] Ensuring vector index on 'vector' column...")
+                self.table.create_index("vector")
+            except Exception as e:
+                print(f"[WARN] Could not create index (non-fatal): {e}")
+            try:
+                self.table.optimize()  # merge the small fragments of the per-batch commits
+            except Exception as e:
+                print(f"[WARN] Could not compact table (non-fatal): {e}")
 
-    try:
-        count = table.count_rows()
-    except Exception:
-        count = "unknown"
+        try:
+            count = self.table.count_rows()
+        except Exception:
+            count = "unknown"
+        print("[INFO] Done. Table row count:", count)
 
-    print("[INFO] Done. Table row count:", count)
+
+def _drain(q: "queue.Queue") -> None:
+    while q.get() is not _DONE:
+        pass
+
+
+def run_pipeline(pdf_paths: List[Path], doc_hashes: Dict[Path, str], model: SentenceTransformer,
+                 writer: TableWriter, pool: Optional[ProcessPoolExecutor],
+                 workers: int = WORKERS, timeout: int = PDF_TIMEOUT,
+                 encoders: Optional[EncoderPool] = None,
+                 cache: Optional[EmbeddingCache] = None,
+                 on_checkpoint=None,
+                 resume_after: Optional[Tuple[Path, int, int]] = None,
+                 dedup: Optional[NearDupIndex] = None) -> Tuple[List[Path], bool]:
+    """
+    Extract, embed and write `pdf_paths` with overlapping stages. With `encoders`, the
+    model only tokenizes and the pool encodes; two windows are in flight so the
+    encoders do not idle while a window is collected. With `cache`, only texts
+    without a cached embedding are encoded. With `dedup` (seeded with the committed
+    rows of the other PDFs), chunks that are near-duplicates of a chunk in it are
+    dropped before embedding.
+
+    Rows are committed in pipeline order, so the committed rows are always a prefix:
+    every CHECKPOINT_SECONDS and at the end, on_checkpoint(done, partial) gets the PDFs
+    whose rows are now all committed as [(path, chunks, dups_of)] (dups_of: the PDFs
+    holding the kept copies of its dropped chunks) and the PDF in progress as
+    (path, page, chunk) of its last committed chunk (or None). resume_after skips the
+    chunks of one PDF up to and including that (page, chunk).
+    On SIGTERM / Ctrl+C the rows embedded so far are written and the run stops.
+    Returns (failed_paths, stopped). Raises if the embed or write stage failed.
+    """
+    window = SORT_WINDOW if SORT_WINDOW > 0 else BATCH_SIZE
+    chunk_q: "queue.Queue" = queue.Queue(maxsize=QUEUE_SIZE)  # lists of <= window records
+    batch_q: "queue.Queue" = queue.Queue(maxsize=QUEUE_SIZE)  # embedded Arrow record batches
+    errors: List[BaseException] = []
+    stats = EmbedStats()
+
+    dim = model.get_sentence_embedding_dimension()
+    inflight: deque = deque()  # (records, embs, missing, todo, task_ids, batches, submitted_at)
+    last_done = 0.0
+
+    def emit(records, embs: np.ndarray, missing: List[int], todo: List[str], new: np.ndarray) -> None:
+        if todo:
+            embs[missing] = new
+            if cache is not None:
+                cache.add(todo, new)
+        batch_q.put(to_record_batch(records, embs, writer.schema))
+
+    def collect_oldest() -> None:
+        nonlocal last_done
+        records, embs, missing, todo, task_ids, batches, submitted = inflight.popleft()
+        new = encoders.collect(task_ids, batches, len(todo), dim)
+        now = time.perf_counter()
+        stats.seconds += now - max(submitted, last_done)  # overlapping windows are counted once
+        last_done = now
+        emit(records, embs, missing, todo, new)
+
+    def embed_stage() -> None:
+        try:
+            while True:
+                records = chunk_q.get()
+                if records is _DONE:
+                    break
+                if _STOP.is_set():
+                    _drain(chunk_q)  # not embedded yet: redone after --resume
+                    inflight.clear()
+                    break
+                texts = [r["text"] for r in records]
+                if cache is not None:
+                    embs, missing = cache.lookup(texts)
+                else:
+                    embs, missing = np.empty((len(texts), dim), dtype=np.float32), list(range(len(texts)))
+                todo = [texts[i] for i in missing]
+
+                if encoders is None:
+                    new = embed_texts(todo, model, stats) if todo else None
+                    emit(records, embs, missing, todo, new)
+                    continue
+                batches = plan_embed(todo, model, stats) if todo else []
+                inflight.append(
+                    (records, embs, missing, todo, encoders.submit(todo, batches), batches, time.perf_counter())
+                )
+                if len(inflight) > 1:
+                    collect_oldest()
+            while inflight:
+                collect_oldest()
+            if cache is not None:
+                cache.flush()
+        except BaseException as e:
+            errors.append(e)
+            _drain(chunk_q)
+        finally:
+            batch_q.put(_DONE)
+
+    def write_stage() -> None:
+        pending: List[pa.RecordBatch] = []
+        try:
+            while True:
+                batch = batch_q.get()
+                if batch is not _DONE:
+                    pending.append(batch)
+                if pending and (batch is _DONE or sum(b.num_rows for b in pending) >= WRITE_ROWS):
+                    writer.write(pa.Table.from_batches(pending, schema=writer.schema))
+                    pending = []
+                if batch is _DONE:
+                    break
+        except BaseException as e:
+            errors.append(e)
+            _drain(batch_q)
+
+    threads = [
+        threading.Thread(target=embed_stage, name="embed", daemon=True),
+        threading.Thread(target=write_stage, name="write", daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    hashes = [doc_hashes.get(p) or file_sha256(p) for p in pdf_paths]
+    print(f"[INFO] Processing {len(pdf_paths)} PDF(s) with {max(1, workers)} extraction worker(s), "
+          f"timeout {timeout}s per PDF...")
+
+    failed: List[Path] = []
+    buffer: List[Dict[str, Any]] = []
+    extracted = 0
+    total_chunks = 0
+    dropped: Counter = Counter()  # doc_id -> near-duplicate chunks dropped
+    # (path, first row, end row, [(page, chunk)], chunks, dups_of) of PDFs not fully committed
+    spans: deque = deque()
+    rows_queued = 0
+    pages_done = 0
+    t0 = time.perf_counter()
+    last_checkpoint = t0
+
+    def checkpoint() -> None:
+        committed = writer.rows_written
+        done = []
+        while spans and spans[0][2] <= committed:
+            path, _start, _end, _keys, chunks, dups_of = spans.popleft()
+            done.append((path, chunks, dups_of))
+        partial = None
+        if spans and spans[0][1] < committed:
+            path, start, _end, keys, _chunks, _dups_of = spans[0]
+            partial = (path, *keys[committed - start - 1])
+        if on_checkpoint is not None:
+            on_checkpoint(done, partial)
+
+    try:
+        for i, records, pages, error in iter_extracted(pdf_paths, hashes, pool, workers, timeout):
+            if errors or _STOP.is_set():
+                break
+            if error:
+                print(f"[WARN] Skipping PDF {pdf_paths[i]}: {error}")
+                failed.append(pdf_paths[i])
+                continue
+
+            pages_done += pages
+            extracted += len(records)
+            chunks = len(records)
+            dups_of = set()
+            if dedup is not None:
+                # before the resume filter: the chunks committed before an interruption must
+                # be in the index (and its drops counted) exactly as in an uninterrupted run
+                kept = []
+                for r in records:
+                    match = dedup.add(r["minhash"], pdf_paths[i], r["id"])
+                    if match is None:
+                        kept.append(r)
+                    elif dedup.owners[match] != pdf_paths[i]:
+                        dups_of.add(dedup.owners[match])
+                dropped[pdf_paths[i].name] += len(records) - len(kept)
+                chunks -= len(records) - len(kept)
+                records = kept
+            if resume_after is not None and resume_after[0] == pdf_paths[i]:
+                # rows up to the checkpoint are in the table already
+                n = len(records)
+                records = [r for r in records if (r["page"], r["chunk"]) > tuple(resume_after[1:])]
+                print(f"[INFO] Resuming {pdf_paths[i].name} after {n - len(records)} committed chunk(s).")
+            total_chunks += chunks
+            spans.append((pdf_paths[i], rows_queued, rows_queued + len(records),
+                          [(r["page"], r["chunk"]) for r in records], chunks, dups_of))
+            rows_queued += len(records)
+            buffer.extend(records)
+            while len(buffer) >= window:
+                chunk_q.put(buffer[:window])
+                buffer = buffer[window:]
+
+            elapsed = max(1e-9, time.perf_counter() - t0)
+            print(
+                f"[INFO] Extracted {i + 1}/{len(pdf_paths)} PDF(s), {pages_done} page(s) "
+                f"({pages_done / elapsed:.1f} pages/s), {writer.rows_written} row(s) written - {pdf_paths[i].name}"
+            )
+            if time.perf_counter() - last_checkpoint >= CHECKPOINT_SECONDS:
+                checkpoint()
+                last_checkpoint = time.perf_counter()
+        if buffer and not errors and not _STOP.is_set():
+            chunk_q.put(buffer)
+    finally:
+        chunk_q.put(_DONE)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    checkpoint()
+    stopped = _STOP.is_set()
+    print(
+        f"[INFO] Total text chunks: {total_chunks} in {time.perf_counter() - t0:.1f}s "
+        f"({len(failed)} PDF(s) failed{', stopped early' if stopped else ''})"
+    )
+    if dedup is not None and extracted:
+        n = sum(dropped.values())
+        top = ", ".join(f"{doc} ({k})" for doc, k in dropped.most_common(3) if k)
+        print(
+            f"[INFO] Near-duplicates: dropped {n} of {extracted} chunk(s) ({100.0 * n / extracted:.1f}%)"
+            + (f", most from: {top}" if top else "")
+        )
+    stats.report()
+    if cache is not None:
+        print(
+            f"[INFO] Embedding cache: {cache.hits} hit(s), {cache.misses} miss(es) "
+            f"(hit rate {100.0 * cache.hit_rate():.1f}%)"
+        )
+    return failed, stopped
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Build PDF chunk embeddings in LanceDB")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its last checkpoint (CLEAR_TABLE is ignored)")
+    args = parser.parse_args()
+
     print("[INFO] ------------ Embeddings Builder ------------")
     print(f"[INFO] PDF input folder: {PDF_DIR.resolve()}")
     print(f"[INFO] LanceDB folder:   {DB_URI.resolve()}")
@@ -236,8 +1096,13 @@ def main() -> None:
     print(f"[INFO] Chunk size:       {CHUNK_SIZE}")
     print(f"[INFO] Chunk overlap:    {CHUNK_OVERLAP}")
     print(f"[INFO] Min chunk chars:  {MIN_CHUNK_LEN}")
-    print(f"[INFO] Batch size:       {BATCH_SIZE}")
+    if SORT_WINDOW > 0:
+        print(f"[INFO] Embed batches:    length-sorted, {TOKEN_BUDGET} tokens, window {SORT_WINDOW}")
+    else:
+        print(f"[INFO] Batch size:       {BATCH_SIZE}")
+    print(f"[INFO] Workers:          {WORKERS}")
     print(f"[INFO] CLEAR_TABLE:      {CLEAR_TABLE}")
+    print(f"[INFO] Resume:           {int(args.resume)}")
     print("[INFO] -------------------------------------------")
 
     pdf_paths = scan_pdfs(PDF_DIR)
@@ -246,18 +1111,158 @@ def main() -> None:
 
     print(f"[INFO] Found {len(pdf_paths)} PDF(s).")
 
-    print("[INFO] Loading embedding model...")
-    model = SentenceTransformer(MODEL_NAME)
-    print(f"[INFO] Embedding dimension: {model.get_sentence_embedding_dimension()}")
-
-    records = build_records_from_pdfs(pdf_paths)
-    if not records:
-        raise SystemExit("[ERROR] No text chunks extracted from PDFs.")
-
-    embed_records(records, model)
-    upsert_into_lancedb(records, DB_URI, TABLE_NAME)
+    t0 = time.perf_counter()
+    db = open_db(DB_URI)
+    manifest = load_manifest(MANIFEST_PATH)
+    dropped_table = False
+    if CLEAR_TABLE and args.resume:
+        print("[INFO] --resume -> CLEAR_TABLE is not applied again.")
+    elif CLEAR_TABLE and TABLE_NAME in db.table_names():
+        print(f"[WARN] CLEAR_TABLE=1 -> dropping existing table '{TABLE_NAME}'")
+        db.drop_table(TABLE_NAME)
+        dropped_table = True
+
+    if TABLE_NAME not in db.table_names():
+        manifest["files"] = {}
+    elif manifest["params"] != ingest_params():
+        if manifest["files"]:
+            print("[WARN] Model or chunking parameters changed -> re-embedding all PDFs.")
+        db.drop_table(TABLE_NAME)
+        dropped_table = True
+        manifest["files"] = {}
+    if dropped_table:
+        manifest["resume"] = None
+        # checkpoints of the dropped table must not survive into the rebuild
+        save_manifest(MANIFEST_PATH, dict(manifest, params=ingest_params()))
+
+    to_process, unchanged, removed, states = plan_ingest(pdf_paths, PDF_DIR, manifest)
+    print(
+        f"[INFO] Plan: {len(to_process)} new/changed, {len(unchanged)} unchanged, "
+        f"{len(removed)} removed PDF(s)."
+    )
+    changed = set(to_process)  # their rows in the table are old versions or a partial run
+    if DEDUP_THRESHOLD > 0:
+        deps = dedup_dependents(unchanged, PDF_DIR, states)
+        if deps:
+            print(f"[INFO] Near-duplicates: re-checking {len(deps)} unchanged PDF(s) whose kept copies "
+                  f"changed or were removed.")
+            order = {p: i for i, p in enumerate(pdf_paths)}
+            to_process = sorted(to_process + deps, key=order.get)
+
+    if not to_process and not removed:
+        print(f"[INFO] Nothing to do ({time.perf_counter() - t0:.1f}s).")
+        return
 
-    print("[INFO] Embedding build complete.")
+    # manifest entries that match the rows in the table; checkpoints move PDFs from the
+    # old to the new state once all their rows are committed
+    saved = dict(manifest["files"])
+    committed = set()  # keys of the PDFs processed in this run whose rows are all committed
+    resume_after = None
+    resume = manifest.get("resume") if args.resume else None
+    if resume and resume["file"] in states and states[resume["file"]]["sha256"] == resume["sha256"]:
+        resume_after = (PDF_DIR / resume["file"], *resume["after"])
+
+    def on_checkpoint(done, partial) -> None:
+        keys = [p.relative_to(PDF_DIR).as_posix() for p, _, _ in done]
+        keep_shas = {st["sha256"] for st in states.values()}
+        keep_shas |= {st["sha256"] for k, st in saved.items() if k not in keys}
+        writer.delete_stale([saved[k]["doc_id"] for k in keys if k in saved], keep_shas)
+        for (_, chunks, dups_of), key in zip(done, keys):
+            saved[key] = {k: v for k, v in states[key].items() if k != "dups_of"}
+            saved[key]["chunks"] = chunks
+            if dups_of:
+                owners = (p.relative_to(PDF_DIR).as_posix() for p in dups_of)
+                saved[key]["dups_of"] = {k: states[k]["sha256"] for k in sorted(owners)}
+            committed.add(key)
+
+        progress = None
+        if partial is not None:
+            key = partial[0].relative_to(PDF_DIR).as_posix()
+            progress = {"file": key, "sha256": states[key]["sha256"], "after": list(partial[1:])}
+        save_manifest(MANIFEST_PATH, dict(manifest, params=ingest_params(), files=saved, resume=progress))
+        print(f"[INFO] Checkpoint: {len(done)} PDF(s) committed, {writer.rows_written} row(s) written.")
+
+    if to_process:
+        pool = start_extract_pool(min(WORKERS, len(to_process)))
+        encoders = None
+        install_stop_handlers()
+        try:
+            devices = encoder_devices()
+            print("[INFO] Loading embedding model...")
+            # with an encoder pool the local copy only tokenizes, keep it off the GPUs
+            model = SentenceTransformer(MODEL_NAME, device="cpu" if devices else None)
+            print(f"[INFO] Embedding dimension: {model.get_sentence_embedding_dimension()}")
+            if devices:
+                encoders = EncoderPool(MODEL_NAME, devices)
+                cosine = parity_check(model, encoders)
+                print(f"[INFO] Encoder pool parity vs. local model: min cosine={cosine:.5f}")
+                if cosine < POOL_MIN_COSINE:
+                    print(f"[WARN] Encoder pool below EMBEDDING_POOL_MIN_COSINE={POOL_MIN_COSINE}; "
+                          f"encoding in this process instead.")
+                    encoders.close()
+                    encoders = None
+                    model = SentenceTransformer(MODEL_NAME)
+            writer = TableWriter(db, TABLE_NAME, arrow_schema(model.get_sentence_embedding_dimension()))
+            cache = None
+            if EMBED_CACHE:
+                cache_db = db if CACHE_URI == DB_URI else open_db(CACHE_URI)
+                cache = EmbeddingCache(cache_db, MODEL_NAME, model.get_sentence_embedding_dimension())
+                print(f"[INFO] Embedding cache: table '{cache.table_name}' in {CACHE_URI}")
+            dedup = None
+            if DEDUP_THRESHOLD > 0:
+                # compare against the rows that stay in the table, not only within this run
+                dedup = NearDupIndex(DEDUP_THRESHOLD)
+                owners = {(st["doc_id"], st["sha256"]): PDF_DIR / key
+                          for key, st in states.items() if PDF_DIR / key not in changed}
+                seeded = seed_dedup(dedup, writer.table, owners, {p: i for i, p in enumerate(pdf_paths)})
+                print(f"[INFO] Near-duplicates: threshold {DEDUP_THRESHOLD}, {seeded} committed chunk(s) indexed.")
+
+            doc_hashes = {p: states[p.relative_to(PDF_DIR).as_posix()]["sha256"] for p in to_process}
+            failed, stopped = run_pipeline(to_process, doc_hashes, model, writer, pool,
+                                           workers=min(WORKERS, len(to_process)), encoders=encoders,
+                                           cache=cache, on_checkpoint=on_checkpoint,
+                                           resume_after=resume_after, dedup=dedup)
+        finally:
+            if encoders is not None:
+                encoders.close()
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        if stopped:
+            raise SystemExit(
+                f"[WARN] Stopped after {len(committed)}/{len(to_process)} PDF(s), progress saved in {MANIFEST_PATH}. "
+                f"Continue with: python build_pdf_embeddings.py --resume"
+            )
+
+        for p in failed:
+            # keep the previous version (rows + manifest entry) or retry next run
+            key = p.relative_to(PDF_DIR).as_posix()
+            if key in manifest["files"]:
+                states[key] = manifest["files"][key]
+            else:
+                del states[key]
+            to_process.remove(p)
+        if writer.table is None:
+            raise SystemExit("[ERROR] No text chunks extracted from PDFs.")
+    else:
+        writer = TableWriter(db, TABLE_NAME, schema=None)
+
+    # stale rows: removed PDFs (old versions of changed PDFs went at the checkpoints)
+    replace_doc_ids = [manifest["files"][k]["doc_id"] for k in removed]
+    writer.finish(replace_doc_ids, {st["sha256"] for st in states.values()})
+
+    for key in committed:
+        states[key] = saved[key]
+    for key, state in states.items():
+        if "chunks" not in state:
+            state["chunks"] = saved.get(key, {}).get("chunks", 0)
+    manifest["params"] = ingest_params()
+    manifest["files"] = states
+    manifest["resume"] = None
+    save_manifest(MANIFEST_PATH, manifest)
+    print(f"[INFO] Manifest written: {MANIFEST_PATH}")
+
+    print(f"[INFO] Embedding build complete ({time.perf_counter() - t0:.1f}s).")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+"""
+embedding_cache.py
+
+Embedding cache keyed by (model name, sha256(text)), shared by
+build_pdf_embeddings.py (chunk embeddings) and LLM_Server/rag.py (query embeddings).
+This is the only copy; rag.py appends Embeddings_Creator/ to sys.path to import it.
+
+- Persistent layer: one LanceDB table per model, rows {key: sha256 of the text, vector}.
+  The table name contains the model name, a hash of it and the dimension, so different
+  models never mix. Writes are a merge-insert on "key", so several writers
+  (builder + server) do not create duplicates.
+- Optional in-memory LRU in front (for the server's hot queries).
+- hits / misses are counted for the hit-rate report.
+
+Needs numpy + pyarrow; LanceDB only for the persistent layer (db=None = memory only).
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pyarrow as pa
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def cache_table_name(model_name: str, dim: int) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_]+", "_", Path(model_name).name or model_name)
+    digest = hashlib.sha1(model_name.encode("utf-8")).hexdigest()[:8]
+    return f"embcache_{safe}_{digest}_{dim}"
+
+
+def _vectors(column, dim: int) -> np.ndarray:
+    """Arrow fixed-size-list column -> (n, dim) float32 array."""
+    arr = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    return arr.flatten().to_numpy(zero_copy_only=False).astype(np.float32).reshape(-1, dim)
+
+
+class EmbeddingCache:
+    """
+    lookup(texts) -> (embs, missing): embs has the cached rows filled in, `missing`
+    lists the indices to encode. add(texts, embs) stores new embeddings; persistent
+    writes are buffered and committed every `flush_rows` rows or on flush().
+    """
+
+    def __init__(self, db, model_name: str, dim: int, memory_size: int = 0,
+                 flush_rows: int = 4096, read_only: bool = False):
+        self.db = db
+        self.model_name = model_name
+        self.dim = dim
+        self.table_name = cache_table_name(model_name, dim)
+        self.memory_size = memory_size
+        self.flush_rows = flush_rows
+        self.read_only = read_only
+        self.table = None
+        if db is not None and self.table_name in db.table_names():
+            self.table = db.open_table(self.table_name)
+        self.schema = pa.schema([
+            pa.field("key", pa.string()),
+            pa.field("vector", pa.list_(pa.float32(), dim)),
+        ])
+        self.memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.pending_keys: List[str] = []
+        self.pending_vecs: List[np.ndarray] = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        keys = [text_key(t) for t in texts]
+        embs = np.empty((len(texts), self.dim), dtype=np.float32)
+        found = {}
+        with self.lock:
+            for key in keys:
+                vec = self.memory.get(key)
+                if vec is not None:
+                    self.memory.move_to_end(key)
+                    found[key] = vec
+
+        wanted = sorted({k for k in keys if k not in found})
+        if wanted and self.table is not None:
+            found.update(self._read(wanted))
+
+        missing = []
+        for i, key in enumerate(keys):
+            vec = found.get(key)
+            if vec is None:
+                missing.append(i)
+            else:
+                embs[i] = vec
+        with self.lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            for key in wanted:
+                if key in found:
+                    self._remember(key, found[key])
+        return embs, missing
+
+    def add(self, texts: List[str], embs: np.ndarray) -> None:
+        embs = np.asarray(embs, dtype=np.float32)
+        with self.lock:
+            for text, vec in zip(texts, embs):
+                key = text_key(text)
+                self._remember(key, vec)
+                if self.db is not None and not self.read_only:
+                    self.pending_keys.append(key)
+                    self.pending_vecs.append(vec)
+            due = len(self.pending_keys) >= self.flush_rows
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            keys, vecs = self.pending_keys, self.pending_vecs
+            self.pending_keys, self.pending_vecs = [], []
+        if not keys:
+            return
+
+        unique = dict(zip(keys, vecs))  # the same text can come twice in one batch
+        flat = np.ascontiguousarray(np.stack(list(unique.values())), dtype=np.float32).reshape(-1)
+        data = pa.Table.from_arrays(
+            [pa.array(list(unique), type=pa.string()),
+             pa.FixedSizeListArray.from_arrays(pa.array(flat, type=pa.float32()), self.dim)],
+            schema=self.schema,
+        )
+        if self.table is None:
+            try:
+                self.table = self.db.create_table(self.table_name, data, schema=self.schema)
+                try:
+                    self.table.create_scalar_index("key")
+                except Exception as e:
+                    print(f"[WARN] Could not create scalar index on embedding cache (non-fatal): {e}")
+                return
+            except Exception:
+                self.table = self.db.open_table(self.table_name)  # created by another process meanwhile
+        self.table.merge_insert("key").when_not_matched_insert_all().execute(data)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _read(self, keys: List[str]) -> dict:
+        quoted = ", ".join(f"'{k}'" for k in keys)
+        res = (
+            self.table.search()
+            .where(f"key IN ({quoted})")
+            .select(["key", "vector"])
+            .limit(len(keys))
+            .to_arrow()
+        )
+        if res.num_rows == 0:
+            return {}
+        return dict(zip(res.column("key").to_pylist(), _vectors(res.column("vector"), self.dim)))
+
+    def _remember(self, key: str, vec: np.ndarray) -> None:
+        if self.memory_size <= 0:
+            return
+        self.memory[key] = vec
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
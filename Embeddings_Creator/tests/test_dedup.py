@@ -0,0 +1,184 @@
+"""
+End-to-end runs of build_pdf_embeddings.main() with near-duplicate removal on.
+The "PDFs" are text files (pages separated by form feeds) and the model is a tiny
+fake, so only the ingest logic (manifest, dedup, LanceDB writes) is exercised.
+"""
+
+import json
+import sys
+
+import pytest
+
+for mod in ("numpy", "pyarrow", "lancedb", "pypdf", "sentence_transformers"):
+    pytest.importorskip(mod)
+
+import lancedb  # noqa: E402
+import numpy as np  # noqa: E402
+
+import build_pdf_embeddings as bpe  # noqa: E402
+
+BOILERPLATE = "Cluster rules: " + " ".join(f"rule{k} applies to every job on the cluster" for k in range(4))
+
+
+def page(doc: str, n: int) -> str:
+    return f"{doc} page {n}: " + " ".join(f"{doc}{n}word{k}" for k in range(12))
+
+
+class FakeModel:
+    max_seq_length = 128
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return 4
+
+    def tokenizer(self, texts, **kwargs):
+        return {"input_ids": [t.split() for t in texts]}
+
+    def encode(self, texts, **kwargs):
+        return np.array([[len(t), t.count(" "), 1.0, 0.0] for t in texts], dtype=np.float32)
+
+
+def fake_extract(path):
+    pages = path.read_text(encoding="utf-8").split("\f")
+    return [{"doc_id": path.name, "page": i + 1, "text": t} for i, t in enumerate(pages) if t.strip()]
+
+
+@pytest.fixture
+def make_builder(tmp_path, monkeypatch):
+    monkeypatch.setattr(bpe, "SentenceTransformer", FakeModel)
+    monkeypatch.setattr(bpe, "extract_pdf_text", fake_extract)
+    monkeypatch.setattr(bpe, "install_stop_handlers", lambda: None)
+    for name, value in {
+        "DEDUP_THRESHOLD": 0.9, "EMBED_CACHE": 0, "WORKERS": 1, "DEVICES": "", "CPU_ENCODERS": 0,
+        "CHUNK_SIZE": 400, "CHUNK_OVERLAP": 0, "MIN_CHUNK_LEN": 20,
+        "SORT_WINDOW": 2, "WRITE_ROWS": 2, "CHECKPOINT_SECONDS": 0, "CLEAR_TABLE": 0,
+    }.items():
+        monkeypatch.setattr(bpe, name, value)
+
+    def make(name: str):
+        root = tmp_path / name
+        (root / "pdfs").mkdir(parents=True)
+        return Builder(root, monkeypatch)
+
+    yield make
+    bpe._STOP.clear()
+
+
+class Builder:
+    def __init__(self, root, monkeypatch):
+        self.root = root
+        self.pdfs = root / "pdfs"
+        self.db = root / "db"
+        self.monkeypatch = monkeypatch
+
+    def write(self, name: str, pages) -> None:
+        (self.pdfs / name).write_text("\f".join(pages), encoding="utf-8")
+
+    def run(self, *args) -> None:
+        for name, value in {"PDF_DIR": self.pdfs, "DB_URI": self.db, "CACHE_URI": self.db,
+                            "MANIFEST_PATH": self.db / "pdf_chunks.manifest.json"}.items():
+            self.monkeypatch.setattr(bpe, name, value)
+        self.monkeypatch.setattr(sys, "argv", ["build_pdf_embeddings.py", *args])
+        bpe._STOP.clear()
+        bpe.main()
+
+    def rows(self):
+        table = lancedb.connect(str(self.db)).open_table(bpe.TABLE_NAME).to_arrow()
+        return sorted(zip(table.column("doc_id").to_pylist(), table.column("text").to_pylist()))
+
+    def manifest(self):
+        return json.loads((self.db / "pdf_chunks.manifest.json").read_text(encoding="utf-8"))
+
+
+def texts(rows):
+    return sorted(text for _, text in rows)
+
+
+def test_full_run_keeps_first_copy(make_builder):
+    b = make_builder("full")
+    b.write("a.pdf", [page("a", 1), BOILERPLATE])
+    b.write("b.pdf", [BOILERPLATE, page("b", 2)])
+    b.run()
+    assert texts(b.rows()).count(BOILERPLATE) == 1
+    assert ("a.pdf", BOILERPLATE) in b.rows()
+    files = b.manifest()["files"]
+    assert files["b.pdf"]["dups_of"] == {"a.pdf": files["a.pdf"]["sha256"]}
+
+
+def test_incremental_run_compares_with_unchanged_pdfs(make_builder):
+    b = make_builder("incremental")
+    b.write("a.pdf", [page("a", 1), BOILERPLATE])
+    b.run()
+    b.write("b.pdf", [BOILERPLATE, page("b", 2)])
+    b.run()
+    assert texts(b.rows()).count(BOILERPLATE) == 1
+    assert ("a.pdf", BOILERPLATE) in b.rows()
+
+
+@pytest.mark.parametrize("change", ["remove", "edit"])
+def test_dropped_chunks_come_back_when_the_kept_copy_goes(make_builder, change):
+    b = make_builder(change)
+    b.write("a.pdf", [page("a", 1), BOILERPLATE])
+    b.write("b.pdf", [BOILERPLATE, page("b", 2)])
+    b.write("c.pdf", [page("c", 1)])
+    b.run()
+    assert ("b.pdf", BOILERPLATE) not in b.rows()
+
+    if change == "remove":
+        (b.pdfs / "a.pdf").unlink()
+    else:
+        b.write("a.pdf", [page("a", 1), page("a", 3)])
+    b.run()
+    assert ("b.pdf", BOILERPLATE) in b.rows()
+    assert "dups_of" not in b.manifest()["files"]["b.pdf"]
+
+    # same table as a rebuild from scratch
+    fresh = make_builder(change + "-fresh")
+    for pdf in sorted(b.pdfs.iterdir()):
+        fresh.write(pdf.name, pdf.read_text(encoding="utf-8").split("\f"))
+    fresh.run()
+    assert b.rows() == fresh.rows()
+
+
+class StoppingModel(FakeModel):
+    """Sets the stop flag (as SIGTERM does) after `calls` encoder calls."""
+
+    calls = 2
+
+    def encode(self, texts, **kwargs):
+        StoppingModel.calls -= 1
+        if StoppingModel.calls == 0:
+            bpe._STOP.set()
+        return super().encode(texts, **kwargs)
+
+
+def test_resumed_run_matches_straight_run(make_builder, monkeypatch):
+    pdfs = {
+        "a.pdf": [BOILERPLATE] + [page("a", n) for n in range(2, 8)] + [BOILERPLATE, page("a", 9)],
+        "b.pdf": [page("b", 1), BOILERPLATE],
+    }
+    straight = make_builder("straight")
+    resumed = make_builder("resumed")
+    for name, pages in pdfs.items():
+        straight.write(name, pages)
+        resumed.write(name, pages)
+    straight.run()
+
+    # interrupted after two embedded windows (4 chunks), i.e. in the middle of a.pdf
+    monkeypatch.setattr(bpe, "SentenceTransformer", StoppingModel)
+    with pytest.raises(SystemExit):
+        resumed.run()
+    assert resumed.manifest()["resume"] == {"file": "a.pdf", "sha256": bpe.file_sha256(resumed.pdfs / "a.pdf"),
+                                            "after": [4, 0]}
+    monkeypatch.setattr(bpe, "SentenceTransformer", FakeModel)
+    resumed.run("--resume")
+
+    assert resumed.rows() == straight.rows()
+    assert texts(straight.rows()).count(BOILERPLATE) == 1
+
+    def summary(b):
+        return {k: (f["chunks"], f.get("dups_of")) for k, f in b.manifest()["files"].items()}
+
+    assert summary(resumed) == summary(straight)
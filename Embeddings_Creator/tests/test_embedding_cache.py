@@ -0,0 +1,55 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pyarrow")
+lancedb = pytest.importorskip("lancedb")
+
+from embedding_cache import EmbeddingCache  # noqa: E402
+
+
+def vecs(*values):
+    return np.array([[v, v + 1, v + 2] for v in values], dtype=np.float32)
+
+
+def test_persistent_layer_survives_a_new_cache(tmp_path):
+    db = lancedb.connect(str(tmp_path))
+    cache = EmbeddingCache(db, "some/model", 3)
+    embs, missing = cache.lookup(["a", "b"])
+    assert missing == [0, 1]
+    cache.add(["a", "b"], vecs(1, 2))
+    cache.flush()
+
+    again = EmbeddingCache(db, "some/model", 3)
+    embs, missing = again.lookup(["b", "c", "a"])
+    assert missing == [1]
+    np.testing.assert_array_equal(embs[[0, 2]], vecs(2, 1))
+    assert again.hit_rate() == pytest.approx(2 / 3)
+
+
+def test_models_and_dims_do_not_mix(tmp_path):
+    db = lancedb.connect(str(tmp_path))
+    cache = EmbeddingCache(db, "model-a", 3)
+    cache.add(["a"], vecs(1))
+    cache.flush()
+    assert EmbeddingCache(db, "model-b", 3).lookup(["a"])[1] == [0]
+    assert EmbeddingCache(db, "model-a", 4).lookup(["a"])[1] == [0]
+
+
+def test_duplicate_writes_are_merged(tmp_path):
+    db = lancedb.connect(str(tmp_path))
+    cache = EmbeddingCache(db, "m", 3)
+    cache.add(["a", "a"], vecs(1, 1))
+    cache.flush()
+    EmbeddingCache(db, "m", 3).add(["a", "b"], vecs(1, 2))
+    other = EmbeddingCache(db, "m", 3)
+    other.add(["a", "b"], vecs(1, 2))
+    other.flush()
+    assert other.table.count_rows() == 2
+
+
+def test_memory_only_lru(tmp_path):
+    cache = EmbeddingCache(None, "m", 3, memory_size=2)
+    cache.add(["a", "b"], vecs(1, 2))
+    cache.lookup(["a"])  # "b" is now least recently used
+    cache.add(["c"], vecs(3))
+    assert cache.lookup(["a", "b", "c"])[1] == [1]
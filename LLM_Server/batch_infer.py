@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+batch_infer.py
+
+Offline batch inference: JSONL of chat requests in, JSONL of answers out.
+Imports server.py (model, tokenizer, build_prompt, compact_history,
+apply_rag_to_messages, run_generate) without starting uvicorn.
+
+- All prompts are built first (incl. RAG), then sorted by prompt length and
+  generated in left-padded batches, so a batch wastes little padding.
+- Every finished batch is appended to the output and flushed; a rerun skips the
+  ids that are already in the output (resume after interruption).
+- --compare N generates N of the requests one at a time (the online path) and
+  reports tokens/s of both modes.
+
+Input lines look like a /v1/chat/completions body (extra keys are ignored):
+  {"id": "faq-1", "messages": [{"role": "user", "content": "..."}],
+   "max_tokens": 256, "temperature": 0.7, "top_p": 0.95, "stop": ["\\n\\n"]}
+Lines without "id" get their line number as id.
+
+Output lines:
+  {"id", "response", "prompt_tokens", "completion_tokens", "batch_size",
+   "batch_ms", "rag_decision", "rag_hits"}
+
+Usage:
+  cd ~/FuzzyBot_HSBI/LLM_Server
+  python batch_infer.py questions.jsonl answers.jsonl --batch-size 8 --compare 8
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import server
+
+
+def load_requests(path: Path) -> list:
+    requests = []
+    with path.open("r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[WARN] {path}:{line_no}: invalid JSON, skipped ({e})")
+                continue
+            obj["id"] = str(obj.get("id", line_no))
+            requests.append(obj)
+    return requests
+
+
+def load_done_ids(path: Path) -> set:
+    done = set()
+    if not path.exists():
+        return done
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)["id"]))
+            except (json.JSONDecodeError, KeyError):
+                continue  # a line cut off by the interruption is redone
+    return done
+
+
+async def prepare(requests: list) -> list:
+    """History compaction + RAG + prompt, the same steps as /v1/chat/completions."""
+    prepared = []
+    for r in requests:
+        try:
+            stops = server.normalize_stop(r.get("stop"))
+        except ValueError as e:
+            print(f"[WARN] Request {r['id']}: {e}; skipped.")
+            continue
+        messages = [server.ChatMessage(**m) for m in r["messages"]]
+        messages = await asyncio.to_thread(server.compact_history, messages)  # may run a summary generate()
+        messages, hits, _user_message, decision = await server.apply_rag_to_messages(messages)
+        prompt = server.build_prompt(messages)
+        prepared.append({
+            "id": r["id"],
+            "prompt": prompt,
+            "prompt_tokens": server.count_tokens(prompt),
+            "max_tokens": int(r.get("max_tokens", server.DEFAULT_MAX_TOKENS)),
+            "temperature": float(r.get("temperature", 0.7)),
+            "top_p": float(r.get("top_p", 0.95)),
+            "stop": stops,
+            "rag_hits": hits,
+            "rag_decision": decision,
+        })
+    return prepared
+
+
+async def prepare_runs(*runs: list) -> list:
+    """
+    prepare() for several request lists in one event loop. The remote-RAG HTTP client
+    (RAG_REMOTE_URL) belongs to the loop it was created in, so it is closed here too.
+    """
+    try:
+        return [await prepare(requests) for requests in runs]
+    finally:
+        await server._close_rag_http()
+
+
+def make_batches(prepared: list, batch_size: int) -> list:
+    """Sort by prompt length; a batch only mixes requests with the same sampling settings."""
+    groups = {}
+    for p in sorted(prepared, key=lambda p: p["prompt_tokens"]):
+        key = (p["temperature"], p["top_p"], tuple(p["stop"]))
+        groups.setdefault(key, []).append(p)
+
+    batches = []
+    for items in groups.values():
+        for start in range(0, len(items), batch_size):
+            batches.append(items[start:start + batch_size])
+    return batches
+
+
+def generate_batch(batch: list) -> list:
+    """One padded generate() call; returns the output records. Completion tokens are per row."""
+    first = batch[0]
+    inputs = server.tokenizer(
+        [p["prompt"] for p in batch],
+        return_tensors="pt",
+        padding=True,
+        add_special_tokens=False,
+    ).to(server.INPUT_DEVICE)
+    max_new_tokens = max(p["max_tokens"] for p in batch)
+
+    t0 = time.perf_counter()
+    out = server.run_generate(
+        inputs,
+        max_new_tokens=max_new_tokens,
+        temperature=first["temperature"],
+        top_p=first["top_p"],
+        stop=first["stop"] or None,
+    )
+    batch_ms = (time.perf_counter() - t0) * 1000.0
+
+    prompt_len = inputs["input_ids"].shape[1]
+    pad_id = server.tokenizer.pad_token_id
+    records = []
+    for i, p in enumerate(batch):
+        new_ids = out[i][prompt_len:prompt_len + p["max_tokens"]].tolist()
+        while new_ids and new_ids[-1] == pad_id:
+            new_ids.pop()
+        text = server.truncate_at_stop(server.tokenizer.decode(new_ids, skip_special_tokens=True), p["stop"])
+        records.append({
+            "id": p["id"],
+            "response": text,
+            "prompt_tokens": p["prompt_tokens"],
+            "completion_tokens": len(new_ids),
+            "batch_size": len(batch),
+            "batch_ms": round(batch_ms, 1),
+            "rag_decision": p["rag_decision"],
+            "rag_hits": p["rag_hits"],
+        })
+    return records
+
+
+def run_online(prepared: list) -> tuple:
+    """The online path: one request per generate() call. Returns (tokens, seconds)."""
+    tokens = 0
+    seconds = 0.0
+    for p in prepared:
+        rec = generate_batch([p])[0]
+        tokens += rec["completion_tokens"]
+        seconds += rec["batch_ms"] / 1000.0
+    return tokens, seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline batch inference (JSONL in, JSONL out)")
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--compare", type=int, default=0,
+                        help="also run N requests one at a time and compare throughput")
+    args = parser.parse_args()
+
+    requests = load_requests(args.input)
+    done = load_done_ids(args.output)
+    pending = [r for r in requests if r["id"] not in done]
+    print(f"[INFO] {len(requests)} request(s), {len(done)} already done, {len(pending)} to run.")
+    if not pending and not args.compare:
+        return
+
+    t0 = time.perf_counter()
+    # with nothing left to run, --compare uses the first N requests of the input instead
+    extra = requests[:args.compare] if args.compare > 0 and not pending else []
+    prepared, compare_prepared = asyncio.run(prepare_runs(pending, extra))
+    print(f"[INFO] Prepared {len(prepared)} prompt(s) (history + RAG) in {time.perf_counter() - t0:.1f}s.")
+
+    batches = make_batches(prepared, max(1, args.batch_size))
+    tokens = 0
+    seconds = 0.0
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with args.output.open("a", encoding="utf-8") as f:
+        for n, batch in enumerate(batches, start=1):
+            records = generate_batch(batch)
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+
+            batch_tokens = sum(r["completion_tokens"] for r in records)
+            tokens += batch_tokens
+            seconds += records[0]["batch_ms"] / 1000.0
+            print(
+                f"[INFO] Batch {n}/{len(batches)}: {len(batch)} request(s), "
+                f"{batch_tokens} tokens in {records[0]['batch_ms'] / 1000.0:.1f}s"
+            )
+
+    print("[bench] ------------ batch inference ------------")
+    if seconds > 0:
+        print(f"[bench] batched: {tokens / seconds:.2f} tokens/s ({tokens} tokens in {seconds:.1f}s)")
+
+    if args.compare > 0:
+        sample = (prepared or compare_prepared)[:args.compare]
+        online_tokens, online_seconds = run_online(sample)
+        if online_seconds > 0:
+            online_tps = online_tokens / online_seconds
+            print(f"[bench] online:  {online_tps:.2f} tokens/s ({online_tokens} tokens, {len(sample)} requests)")
+            if seconds > 0:
+                print(f"[bench] batched speedup: {(tokens / seconds) / online_tps:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
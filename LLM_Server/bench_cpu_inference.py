@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+bench_cpu_inference.py
+
+Compare CPU generation throughput (tokens/s) of the fp32 model against the
+dynamic int8 quantized model, both loaded exactly the way server.py does it
+in CPU mode (FUZZYBOT_DEVICE=cpu, CPU_QUANTIZE=0/1).
+
+Each variant runs in its own subprocess that imports server.py, so only one
+copy of the model is in memory at a time. uvicorn is not started.
+
+Usage:
+  cd ~/FuzzyBot_HSBI/LLM_Server
+  python bench_cpu_inference.py --max-tokens 64 --runs 3
+
+Env:
+- CPU_THREADS -> torch thread count (default: SLURM_CPUS_PER_TASK or all cores)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+RESULT_MARKER = "BENCH_RESULT "
+
+PROMPTS = [
+    "Wie starte ich einen interaktiven Job auf dem Cluster?",
+    "Explain in two sentences what a Slurm allocation is.",
+    "Was ist der Unterschied zwischen dem Login-Node und einem GPU-Node?",
+]
+
+
+def run_worker(max_tokens: int, runs: int) -> None:
+    """Runs inside the subprocess: import server.py (loads the model) and time generation."""
+    import server
+
+    results = []
+    for run in range(runs + 1):  # run 0 = warmup, not counted
+        for prompt_text in PROMPTS:
+            messages = [server.ChatMessage(role="user", content=prompt_text)]
+            prompt = server.build_prompt(messages)
+            inputs = server.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(server.INPUT_DEVICE)
+
+            t0 = time.perf_counter()
+            out = server.run_generate(inputs, max_new_tokens=max_tokens, temperature=0.7, top_p=0.95)
+            dt = time.perf_counter() - t0
+
+            if run == 0:
+                continue
+            results.append({
+                "new_tokens": int(out.shape[1] - inputs.input_ids.shape[1]),
+                "seconds": dt,
+            })
+
+    print(RESULT_MARKER + json.dumps(results), flush=True)
+
+
+def run_variant(quantize: int, max_tokens: int, runs: int) -> dict:
+    env = dict(os.environ)
+    env["FUZZYBOT_DEVICE"] = "cpu"
+    env["CPU_QUANTIZE"] = str(quantize)
+
+    label = "int8" if quantize else "fp32"
+    print(f"[bench] Running {label} variant...")
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker",
+         "--max-tokens", str(max_tokens), "--runs", str(runs)],
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise SystemExit(f"[ERROR] {label} worker failed with exit code {proc.returncode}")
+
+    results = None
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            results = json.loads(line[len(RESULT_MARKER):])
+    if not results:
+        raise SystemExit(f"[ERROR] {label} worker produced no results")
+
+    tokens = sum(r["new_tokens"] for r in results)
+    seconds = sum(r["seconds"] for r in results)
+    return {
+        "variant": label,
+        "requests": len(results),
+        "new_tokens": tokens,
+        "seconds": round(seconds, 2),
+        "tokens_per_s": round(tokens / seconds, 2) if seconds > 0 else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CPU fp32 vs. int8 generation benchmark")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.max_tokens, args.runs)
+        return
+
+    fp32 = run_variant(0, args.max_tokens, args.runs)
+    int8 = run_variant(1, args.max_tokens, args.runs)
+
+    print("[bench] ------------ CPU inference ------------")
+    for r in (fp32, int8):
+        print(
+            f"[bench] {r['variant']}: {r['tokens_per_s']} tokens/s "
+            f"({r['new_tokens']} tokens in {r['seconds']}s, {r['requests']} requests)"
+        )
+    if fp32["tokens_per_s"] > 0:
+        print(f"[bench] int8 speedup: {int8['tokens_per_s'] / fp32['tokens_per_s']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+bench_retrieval.py
+
+Retrieval microbenchmarks against the RAG LanceDB table (no LLM is loaded).
+
+Projection (default):
+  Old path: search(...).to_list() -> every column incl. the embedding vector as Python dicts.
+  New path: search(...).select([doc_id, page, chunk, text]).to_arrow() -> columns read once.
+  Reports median ms per query for several top_k values.
+
+Query encoders (--encoders):
+  PyTorch SentenceTransformer (CPU and, if present, GPU) vs. onnxruntime fp32 / int8.
+  Reports median ms per single query and the cosine parity against PyTorch.
+
+Usage:
+  cd ~/FuzzyBot_HSBI/LLM_Server
+  python bench_retrieval.py --top-k 5,20,50,100 --runs 20
+  python bench_retrieval.py --encoders --runs 50
+
+Uses the same env vars as server.py (EMBEDDING_DB_URI / FUZZYBOT_DB_DIR,
+EMBEDDING_TABLE_NAME, EMBEDDING_MODEL_PATH).
+"""
+
+import argparse
+import os
+import statistics
+import time
+from pathlib import Path
+
+import lancedb
+from sentence_transformers import SentenceTransformer
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]  # .../FuzzyBot_HSBI
+
+DEFAULT_DB_DIR = Path(os.environ.get("FUZZYBOT_DB_DIR", str(PROJECT_ROOT / "LLM_Server" / "rag" / "db"))).expanduser()
+EMBED_DB_URI = os.environ.get("EMBEDDING_DB_URI", str(DEFAULT_DB_DIR))
+EMBED_TABLE_NAME = os.environ.get("EMBEDDING_TABLE_NAME", "pdf_chunks")
+EMBED_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_PATH", "sentence-transformers/all-MiniLM-L6-v2")
+
+RAG_COLUMNS = ["doc_id", "page", "chunk", "text"]
+
+QUERIES = [
+    "Wie starte ich einen interaktiven Job auf dem Cluster?",
+    "Welche GPU-Partitionen gibt es?",
+    "Wie viel Speicher darf ein Job maximal anfordern?",
+    "How do I copy data to the scratch file system?",
+    "Was passiert, wenn mein Job das Zeitlimit überschreitet?",
+]
+
+
+def _median_ms(fn, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def bench_projection(table, vectors, top_ks, runs: int) -> None:
+    print("[bench] ------------ projection: to_list() vs. select().to_arrow() ------------")
+    print(f"[bench] {'top_k':>6} {'to_list ms':>12} {'arrow ms':>10} {'saved ms':>10} {'saved %':>8}")
+
+    for k in top_ks:
+        def old_path():
+            for v in vectors:
+                hits = table.search(v).limit(k).to_list()
+                [(h["doc_id"], h["page"], h["chunk"], h["text"], h["_distance"]) for h in hits]
+
+        def new_path():
+            for v in vectors:
+                res = table.search(v).select(RAG_COLUMNS).limit(k).to_arrow()
+                for name in RAG_COLUMNS + ["_distance"]:
+                    res.column(name).to_pylist()
+
+        old_path(), new_path()  # warmup
+        old_ms = _median_ms(old_path, runs) / len(vectors)
+        new_ms = _median_ms(new_path, runs) / len(vectors)
+        saved = old_ms - new_ms
+        pct = 100.0 * saved / old_ms if old_ms > 0 else 0.0
+        print(f"[bench] {k:>6} {old_ms:>12.2f} {new_ms:>10.2f} {saved:>10.2f} {pct:>7.1f}%")
+
+
+def bench_encoders(runs: int) -> None:
+    import torch
+    from onnx_encoder import default_onnx_dir, load_onnx_encoder, parity_check
+
+    onnx_base = Path(os.environ.get("RAG_ONNX_DIR", str(DEFAULT_DB_DIR.parent / "onnx"))).expanduser()
+    threads = int(os.environ.get("RAG_ONNX_THREADS", 4))
+
+    cpu_model = SentenceTransformer(EMBED_MODEL_NAME, device="cpu")
+    encoders = [("torch-cpu", cpu_model)]
+    if torch.cuda.is_available():
+        encoders.append(("torch-cuda", SentenceTransformer(EMBED_MODEL_NAME, device="cuda")))
+    for quantize in (False, True):
+        label = "onnx-int8" if quantize else "onnx-fp32"
+        try:
+            enc = load_onnx_encoder(
+                cpu_model, default_onnx_dir(onnx_base, EMBED_MODEL_NAME),
+                quantize=quantize, threads=threads, min_cosine=0.0,
+            )
+            encoders.append((label, enc))
+        except Exception as e:
+            print(f"[bench] {label} unavailable: {e}")
+
+    print(f"[bench] ------------ query encoders (batch=1, onnx threads={threads}) ------------")
+    print(f"[bench] {'encoder':>12} {'median ms':>10} {'min cosine':>11}")
+    for label, enc in encoders:
+        for q in QUERIES:  # warmup
+            enc.encode([q])
+        ms = _median_ms(lambda: [enc.encode([q]) for q in QUERIES], runs) / len(QUERIES)
+        cosine = parity_check(cpu_model, enc, QUERIES)
+        print(f"[bench] {label:>12} {ms:>10.2f} {cosine:>11.5f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="RAG retrieval microbenchmarks")
+    parser.add_argument("--top-k", default="5,20,50,100", help="comma-separated top_k values")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--encoders", action="store_true", help="benchmark query encoder backends instead")
+    args = parser.parse_args()
+
+    if args.encoders:
+        bench_encoders(args.runs)
+        return
+
+    top_ks = [int(x) for x in args.top_k.split(",") if x.strip()]
+
+    print(f"[bench] LanceDB: {EMBED_DB_URI} table={EMBED_TABLE_NAME}")
+    db = lancedb.connect(EMBED_DB_URI)
+    table = db.open_table(EMBED_TABLE_NAME)
+    print(f"[bench] Rows: {table.count_rows()}")
+
+    model = SentenceTransformer(EMBED_MODEL_NAME)
+    vectors = [v.astype("float32").tolist() for v in model.encode(QUERIES)]
+
+    bench_projection(table, vectors, top_ks, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+metrics.py
+
+Tiny in-process metrics registry shared by server.py, rag.py and retrieval_server.py.
+Counters, gauges and timing samples (count/avg/p50/p95/max over the last
+METRICS_WINDOW samples); each FastAPI app exposes metrics_snapshot() as GET /metrics.
+StageTimer times the stages of a single request against an optional latency budget.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", 1000))
+
+_METRICS_LOCK = threading.Lock()
+_COUNTERS = {}
+_GAUGES = {}
+_TIMINGS = {}
+
+
+def metric_inc(name: str, value: float = 1) -> None:
+    with _METRICS_LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def metric_set(name: str, value) -> None:
+    with _METRICS_LOCK:
+        _GAUGES[name] = value
+
+
+def metric_observe(name: str, value: float) -> None:
+    """
+    Record one sample (e.g. a latency in ms).
+    Keeps count/sum forever and the last METRICS_WINDOW samples for percentiles.
+    """
+    with _METRICS_LOCK:
+        t = _TIMINGS.get(name)
+        if t is None:
+            t = _TIMINGS[name] = {"count": 0, "sum": 0.0, "window": deque(maxlen=METRICS_WINDOW)}
+        t["count"] += 1
+        t["sum"] += value
+        t["window"].append(value)
+
+
+def metrics_snapshot() -> dict:
+    with _METRICS_LOCK:
+        timings = {}
+        for name, t in _TIMINGS.items():
+            window = sorted(t["window"])
+            n = len(window)
+            timings[name] = {
+                "count": t["count"],
+                "avg": round(t["sum"] / t["count"], 3) if t["count"] else None,
+                "p50": round(window[n // 2], 3) if n else None,
+                "p95": round(window[min(n - 1, int(n * 0.95))], 3) if n else None,
+                "max": round(window[-1], 3) if n else None,
+            }
+        return {
+            "counters": dict(_COUNTERS),
+            "gauges": dict(_GAUGES),
+            "timings": timings,
+        }
+
+
+class StageTimer:
+    """
+    Per-request stage timer with an optional latency budget:
+
+        timer = StageTimer("rag_stage_ms", budget_ms=300)
+        with timer.stage("encode"):
+            ...
+
+    Every stage is recorded as the timing "<prefix>.<stage>" and kept in timer.ms
+    (so it can be returned to the client). remaining_s() is None without a budget.
+    spent_ms counts time already spent on the request (e.g. a stage shared with others)
+    against the budget.
+    """
+
+    def __init__(self, prefix: str, budget_ms: float = 0, spent_ms: float = 0):
+        self.prefix = prefix
+        self.budget_ms = budget_ms
+        self.ms = {}
+        self._t0 = time.perf_counter() - spent_ms / 1000.0
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.ms[name] = round(self.ms.get(name, 0.0) + ms, 2)
+            metric_observe(f"{self.prefix}.{name}", ms)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._t0) * 1000.0
+
+    def remaining_s(self):
+        if self.budget_ms <= 0:
+            return None
+        return max(0.0, (self.budget_ms - self.elapsed_ms()) / 1000.0)
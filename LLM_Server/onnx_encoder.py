@@ -0,0 +1,192 @@
+"""
+onnx_encoder.py
+
+Optional ONNX Runtime backend for RAG query encoding on CPU threads, so query
+embeddings neither compete with the LLM for the GPU nor pay PyTorch overhead on CPU.
+
+- The transformer of a SentenceTransformer is exported to ONNX once and cached on disk
+  (optionally int8-quantized with onnxruntime's dynamic quantization).
+- Pooling (mean / cls / max) and normalization are reproduced in numpy.
+- parity_check() compares against the original model (cosine similarity).
+
+Needs: onnxruntime, onnx (only for quantization), both optional and listed in
+env/requirements-onnx.txt. Used by server.py when RAG_QUERY_ENCODER=onnx and by
+bench_retrieval.py --encoders.
+"""
+
+import importlib
+import re
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import torch
+
+PARITY_TEXTS = [
+    "Wie starte ich einen interaktiven Job auf dem Cluster?",
+    "Welche GPU-Partitionen gibt es und wie lange darf ein Job laufen?",
+    "How do I copy data to the scratch file system?",
+    "Hallo",
+]
+
+
+def _require(module: str):
+    """Import an optional dependency; a missing one raises an ImportError naming the package."""
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        package = (getattr(e, "name", None) or module).split(".")[0]
+        raise ImportError(
+            f"the ONNX query encoder needs the '{package}' package "
+            f"(pip install -r env/requirements-onnx.txt)"
+        ) from e
+
+
+def _pooling_mode(st_model) -> str:
+    for module in st_model:
+        if hasattr(module, "pooling_mode_mean_tokens"):
+            if module.pooling_mode_mean_tokens:
+                return "mean"
+            if module.pooling_mode_cls_token:
+                return "cls"
+            if module.pooling_mode_max_tokens:
+                return "max"
+    raise ValueError("unsupported pooling configuration for the ONNX backend")
+
+
+def _normalizes(st_model) -> bool:
+    return any(type(module).__name__ == "Normalize" for module in st_model)
+
+
+class _HiddenStates(torch.nn.Module):
+    """Export wrapper: token embeddings only, pooling happens in numpy."""
+
+    def __init__(self, auto_model):
+        super().__init__()
+        self.auto_model = auto_model
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        kwargs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:
+            kwargs["token_type_ids"] = token_type_ids
+        return self.auto_model(**kwargs).last_hidden_state
+
+
+def default_onnx_dir(base_dir: Path, model_name: str) -> Path:
+    safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", Path(model_name).name or model_name)
+    return Path(base_dir) / safe
+
+
+def export_onnx(st_model, out_dir: Path, quantize: bool = True) -> Path:
+    """Export (once) and return the path of the ONNX model to load."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fp32_path = out_dir / "model.onnx"
+
+    if not fp32_path.exists():
+        print(f"[onnx] Exporting query encoder to {fp32_path} ...")
+        dummy = st_model.tokenizer(["export probe"], return_tensors="pt")
+        input_names = ["input_ids", "attention_mask"]
+        if "token_type_ids" in dummy:
+            input_names.append("token_type_ids")
+
+        wrapper = _HiddenStates(st_model[0].auto_model).to("cpu").eval()
+        dynamic_axes = {name: {0: "batch", 1: "seq"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+        with torch.no_grad():
+            torch.onnx.export(
+                wrapper,
+                tuple(dummy[name] for name in input_names),
+                str(fp32_path),
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+            )
+
+    if not quantize:
+        return fp32_path
+
+    int8_path = out_dir / "model.int8.onnx"
+    if not int8_path.exists():
+        quantization = _require("onnxruntime.quantization")  # also imports onnx
+
+        print(f"[onnx] Quantizing to int8: {int8_path} ...")
+        quantization.quantize_dynamic(str(fp32_path), str(int8_path),
+                                      weight_type=quantization.QuantType.QInt8)
+    return int8_path
+
+
+class OnnxQueryEncoder:
+    """Drop-in for SentenceTransformer.encode() (numpy output) backed by onnxruntime."""
+
+    def __init__(self, st_model, onnx_path: Path, threads: int = 4):
+        ort = _require("onnxruntime")
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = threads
+        opts.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(str(onnx_path), opts, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = st_model.tokenizer
+        self.max_seq_length = st_model.max_seq_length
+        self.pooling = _pooling_mode(st_model)
+        self.normalize = _normalizes(st_model)
+        self.dim = st_model.get_sentence_embedding_dimension()
+        self.onnx_path = Path(onnx_path)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts: List[str], batch_size: int = 32, **_kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        out = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            enc = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            feeds = {name: enc[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            out.append(self._pool(hidden, enc["attention_mask"]))
+        if not out:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(out).astype(np.float32)
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.pooling == "cls":
+            emb = hidden[:, 0]
+        elif self.pooling == "max":
+            emb = np.where(mask[..., None] > 0, hidden, -1e9).max(axis=1)
+        else:
+            m = mask[..., None].astype(np.float32)
+            emb = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            emb = emb / np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+        return emb
+
+
+def parity_check(st_model, encoder, texts: List[str] = PARITY_TEXTS) -> float:
+    """Minimum cosine similarity between the original and the ONNX embeddings."""
+    ref = st_model.encode(texts, convert_to_numpy=True)
+    got = encoder.encode(texts)
+    ref = ref / np.linalg.norm(ref, axis=1, keepdims=True)
+    got = got / np.linalg.norm(got, axis=1, keepdims=True)
+    return float((ref * got).sum(axis=1).min())
+
+
+def load_onnx_encoder(st_model, onnx_dir: Path, quantize: bool = True, threads: int = 4,
+                      min_cosine: float = 0.99) -> OnnxQueryEncoder:
+    """Export if needed, load, and verify parity. Raises if parity is below min_cosine."""
+    path = export_onnx(st_model, onnx_dir, quantize=quantize)
+    encoder = OnnxQueryEncoder(st_model, path, threads=threads)
+    cosine = parity_check(st_model, encoder)
+    print(f"[onnx] Parity vs. PyTorch: min cosine={cosine:.5f} ({path.name})")
+    if cosine < min_cosine:
+        raise ValueError(f"ONNX parity check failed: min cosine {cosine:.5f} < {min_cosine}")
+    return encoder
@@ -0,0 +1,846 @@
+"""
+rag.py
+
+Retrieval for FuzzyBot: LanceDB vector search over the PDF chunk table built by
+Embeddings_Creator/build_pdf_embeddings.py, plus query classification, relevance
+filtering, multi-query fusion, overlap merging, neighbor expansion and
+extractive compression of the selected context.
+
+Used in-process by server.py and standalone by retrieval_server.py.
+If anything fails during init_rag(), RAG is disabled and chat keeps working.
+"""
+
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import List, Optional
+
+import lancedb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from sentence_transformers import SentenceTransformer
+
+from metrics import StageTimer, metric_inc, metric_observe, metric_set
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]  # .../FuzzyBot_HSBI
+
+# embedding_cache.py lives next to the builder and is shared with it. Appended, not
+# prepended, so modules in LLM_Server/ always win over same-named ones there.
+_EMBEDDINGS_CREATOR_DIR = str(PROJECT_ROOT / "Embeddings_Creator")
+if _EMBEDDINGS_CREATOR_DIR not in sys.path:
+    sys.path.append(_EMBEDDINGS_CREATOR_DIR)
+from embedding_cache import EmbeddingCache
+
+# ============================================================
+# RAG config + state
+# ============================================================
+
+DEFAULT_DB_DIR = Path(os.environ.get("FUZZYBOT_DB_DIR", str(PROJECT_ROOT / "LLM_Server" / "rag" / "db"))).expanduser()
+EMBED_DB_URI = os.environ.get("EMBEDDING_DB_URI", str(DEFAULT_DB_DIR))
+
+EMBED_TABLE_NAME = os.environ.get("EMBEDDING_TABLE_NAME", "pdf_chunks")
+EMBED_MODEL_NAME = os.environ.get(
+    "EMBEDDING_MODEL_PATH",
+    "sentence-transformers/all-MiniLM-L6-v2",
+)
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", 5))
+RAG_MAX_CHARS = int(os.environ.get("RAG_MAX_CHARS", 16000))
+RAG_DEBUG = int(os.environ.get("RAG_DEBUG", 1))
+# device of the (PyTorch) embedding model; empty = SentenceTransformer default (GPU if present)
+RAG_EMBED_DEVICE = os.environ.get("RAG_EMBED_DEVICE", "").strip() or None
+
+# Relevance gating: hits farther away than RAG_MAX_DISTANCE (LanceDB `_distance`,
+# lower = closer) are dropped; 0 disables the filter. With normalized embeddings
+# (all-MiniLM-L6-v2) the default L2 metric gives distance = 2 - 2 * cosine.
+RAG_MAX_DISTANCE = float(os.environ.get("RAG_MAX_DISTANCE", 0))
+# Skip retrieval when the whole message is a bare greeting / thanks / goodbye
+# (exact match against _SMALLTALK_PHRASES; off by default)
+RAG_SKIP_SMALLTALK = int(os.environ.get("RAG_SKIP_SMALLTALK", 0))
+# Search RAG_CANDIDATE_FACTOR * top_k candidates so that merged (overlapping) chunks
+# can be backfilled with the next best distinct hits.
+RAG_CANDIDATE_FACTOR = max(1, int(os.environ.get("RAG_CANDIDATE_FACTOR", 3)))
+# Expand every hit with up to N neighboring chunks of the same page (0 = off).
+# Lets the table use small, precise chunks while the prompt still gets enough context.
+RAG_NEIGHBOR_WINDOW = int(os.environ.get("RAG_NEIGHBOR_WINDOW", 0))
+
+# Multi-query retrieval (opt-in): search several variants of the question and fuse
+# the rankings (reciprocal rank fusion, RAG_RRF_K).
+RAG_MULTI_QUERY = int(os.environ.get("RAG_MULTI_QUERY", 0))
+RAG_MULTI_QUERY_WORKERS = int(os.environ.get("RAG_MULTI_QUERY_WORKERS", 4))
+RAG_RRF_K = int(os.environ.get("RAG_RRF_K", 60))
+# Wall-clock budget for one retrieval (encode + search + fusion), 0 = none. Variant
+# searches that miss it are dropped; the search for the question itself is always used.
+RAG_LATENCY_BUDGET_MS = float(os.environ.get("RAG_LATENCY_BUDGET_MS", 300))
+
+# Extractive compression (opt-in): split the selected context into sentences, score them
+# against the question embedding and keep the best ones within RAG_COMPRESS_TOKEN_BUDGET
+# (counted with the embedding model's tokenizer), in their original order.
+RAG_COMPRESS = int(os.environ.get("RAG_COMPRESS", 0))
+RAG_COMPRESS_TOKEN_BUDGET = int(os.environ.get("RAG_COMPRESS_TOKEN_BUDGET", 600))
+RAG_COMPRESS_MIN_SCORE = float(os.environ.get("RAG_COMPRESS_MIN_SCORE", 0))
+RAG_COMPRESS_MAX_SENTENCE_CHARS = int(os.environ.get("RAG_COMPRESS_MAX_SENTENCE_CHARS", 400))
+
+# Only these columns are read from search results (never the embedding vector);
+# LanceDB adds `_distance` itself.
+RAG_COLUMNS = ["doc_id", "page", "chunk", "text"]
+
+# Query encoder backend: torch (SentenceTransformer) or onnx (onnxruntime on CPU threads,
+# exported once to RAG_ONNX_DIR, optional int8). Falls back to torch if onnx fails.
+RAG_QUERY_ENCODER = os.environ.get("RAG_QUERY_ENCODER", "torch").strip().lower()
+RAG_ONNX_DIR = Path(os.environ.get("RAG_ONNX_DIR", str(DEFAULT_DB_DIR.parent / "onnx"))).expanduser()
+RAG_ONNX_QUANTIZE = int(os.environ.get("RAG_ONNX_QUANTIZE", 1))
+RAG_ONNX_THREADS = int(os.environ.get("RAG_ONNX_THREADS", 4))
+RAG_ONNX_MIN_COSINE = float(os.environ.get("RAG_ONNX_MIN_COSINE", 0.99))
+
+# Query embedding cache: in-memory LRU, optionally backed by the persistent cache table that
+# build_pdf_embeddings.py fills (same (model, sha256(text)) keys, EMBEDDING_CACHE_URI).
+RAG_QUERY_CACHE_SIZE = int(os.environ.get("RAG_QUERY_CACHE_SIZE", 1024))
+RAG_EMBED_CACHE = int(os.environ.get("RAG_EMBED_CACHE", 0))
+EMBED_CACHE_URI = os.environ.get("EMBEDDING_CACHE_URI", EMBED_DB_URI)
+
+# whole messages (lowercased words joined by one space) that never need retrieval
+_SMALLTALK_PHRASES = {
+    # de
+    "hallo", "hi", "hey", "moin", "servus", "guten morgen", "guten tag", "guten abend",
+    "danke", "dankeschön", "danke schön", "vielen dank", "tschüss", "tschüs", "ciao",
+    "bis bald", "bis später",
+    # en
+    "hello", "good morning", "good afternoon", "good evening", "thanks", "thank you",
+    "thx", "bye", "goodbye",
+}
+_WORD_RE = re.compile(r"\w+")
+# chunk text is whitespace-normalized by build_pdf_embeddings.py, so sentence ends are ". " etc.
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+# dropped from the keyword-only query variant
+_STOPWORDS = {
+    # de
+    "der", "die", "das", "den", "dem", "des", "ein", "eine", "einen", "einem", "einer", "und", "oder",
+    "ich", "du", "er", "sie", "es", "wir", "ihr", "mein", "meine", "mich", "mir", "man", "kann", "können",
+    "muss", "müssen", "soll", "will", "wie", "was", "wo", "wann", "warum", "welche", "welcher", "welches",
+    "ist", "sind", "war", "hat", "habe", "haben", "wird", "werden", "auf", "mit", "von", "zu", "zum", "zur",
+    "im", "in", "an", "am", "für", "bei", "nach", "aus", "über", "um", "nicht", "auch", "noch", "nur",
+    "bitte", "gibt", "dass", "wenn", "so", "da", "hier", "dort", "mal",
+    # en
+    "the", "a", "an", "and", "or", "i", "you", "we", "my", "me", "it", "is", "are", "was", "be", "do",
+    "does", "how", "what", "where", "when", "why", "which", "can", "could", "should", "to", "of", "in",
+    "on", "for", "with", "at", "from", "by", "about", "this", "that", "there", "please", "not",
+}
+
+_RAG_ENABLED = False
+_RAG_TABLE = None
+_RAG_EMBED_MODEL = None
+_RAG_QUERY_ENCODER = None  # object with .encode(list[str]) -> np.ndarray (model or ONNX backend)
+_RAG_CHUNK_INDEX = None  # (doc_id, page, chunk) -> text, built when RAG_NEIGHBOR_WINDOW > 0
+_SEARCH_POOL = None  # threads for concurrent variant searches (LanceDB releases the GIL)
+_QUERY_CACHE = None  # EmbeddingCache for query embeddings
+
+
+def build_chunk_index(table) -> dict:
+    """
+    Load (doc_id, page, chunk) -> text for the whole table, without the vector column.
+    Used for neighbor expansion: one dict lookup per neighbor instead of a DB query.
+    """
+    try:
+        arrow = table.to_lance().to_table(columns=RAG_COLUMNS)
+    except Exception:
+        arrow = table.to_arrow().select(RAG_COLUMNS)
+
+    doc_ids = arrow.column("doc_id").to_pylist()
+    pages = arrow.column("page").to_pylist()
+    chunks = arrow.column("chunk").to_pylist()
+    texts = arrow.column("text").to_pylist()
+    return {
+        (str(d), p, c): t
+        for d, p, c, t in zip(doc_ids, pages, chunks, texts)
+    }
+
+
+def init_rag():
+    """
+    Initialize LanceDB + embedding model.
+    If anything fails, we just disable RAG and keep the normal chat working.
+    """
+    global _RAG_ENABLED, _RAG_TABLE, _RAG_EMBED_MODEL, _RAG_QUERY_ENCODER, _RAG_CHUNK_INDEX, _SEARCH_POOL
+    global _QUERY_CACHE
+
+    try:
+        print(f"[RAG] Connecting to LanceDB at '{EMBED_DB_URI}'...")
+        db = lancedb.connect(EMBED_DB_URI)
+
+        if EMBED_TABLE_NAME not in db.table_names():
+            print(f"[RAG] Table '{EMBED_TABLE_NAME}' not found. RAG disabled.")
+            _RAG_ENABLED = False
+            return
+
+        _RAG_TABLE = db.open_table(EMBED_TABLE_NAME)
+        print(f"[RAG] Opened table '{EMBED_TABLE_NAME}' with {_RAG_TABLE.count_rows()} rows.")
+
+        if RAG_NEIGHBOR_WINDOW > 0:
+            try:
+                t0 = time.perf_counter()
+                _RAG_CHUNK_INDEX = build_chunk_index(_RAG_TABLE)
+                print(
+                    f"[RAG] Chunk index: {len(_RAG_CHUNK_INDEX)} entries in {time.perf_counter() - t0:.2f}s "
+                    f"(neighbor window={RAG_NEIGHBOR_WINDOW})."
+                )
+            except Exception as e:
+                print(f"[RAG] Could not build chunk index, neighbor expansion disabled: {e}")
+                _RAG_CHUNK_INDEX = None
+
+        print(f"[RAG] Loading embedding model: {EMBED_MODEL_NAME}")
+        _RAG_QUERY_ENCODER = None
+        if RAG_QUERY_ENCODER == "onnx":
+            # the PyTorch model stays on CPU; it is only needed for export + parity check
+            _RAG_EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME, device="cpu")
+            try:
+                from onnx_encoder import default_onnx_dir, load_onnx_encoder
+
+                _RAG_QUERY_ENCODER = load_onnx_encoder(
+                    _RAG_EMBED_MODEL,
+                    default_onnx_dir(RAG_ONNX_DIR, EMBED_MODEL_NAME),
+                    quantize=bool(RAG_ONNX_QUANTIZE),
+                    threads=RAG_ONNX_THREADS,
+                    min_cosine=RAG_ONNX_MIN_COSINE,
+                )
+                print(f"[RAG] Query encoder: onnxruntime ({RAG_ONNX_THREADS} thread(s)).")
+            except Exception as e:
+                print(f"[RAG] ONNX query encoder unavailable ({e}); using PyTorch.")
+                _RAG_EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME, device=RAG_EMBED_DEVICE)
+        else:
+            _RAG_EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME, device=RAG_EMBED_DEVICE)
+
+        if _RAG_QUERY_ENCODER is None:
+            _RAG_QUERY_ENCODER = _RAG_EMBED_MODEL
+        metric_set("rag_query_encoder", "onnx" if _RAG_QUERY_ENCODER is not _RAG_EMBED_MODEL else "torch")
+
+        dim = _RAG_EMBED_MODEL.get_sentence_embedding_dimension()
+        print(f"[RAG] Embedding dimension: {dim}")
+
+        _QUERY_CACHE = None
+        if RAG_QUERY_CACHE_SIZE > 0 or RAG_EMBED_CACHE:
+            try:
+                cache_db = None
+                if RAG_EMBED_CACHE:
+                    cache_db = db if EMBED_CACHE_URI == EMBED_DB_URI else lancedb.connect(EMBED_CACHE_URI)
+                _QUERY_CACHE = EmbeddingCache(
+                    cache_db, EMBED_MODEL_NAME, dim,
+                    memory_size=RAG_QUERY_CACHE_SIZE,
+                    flush_rows=64,
+                    # ONNX vectors are close to the PyTorch ones but not equal: read the shared table, never write it
+                    read_only=_RAG_QUERY_ENCODER is not _RAG_EMBED_MODEL,
+                )
+                where = f"+ table '{_QUERY_CACHE.table_name}'" if cache_db is not None else "(memory only)"
+                print(f"[RAG] Query embedding cache: {RAG_QUERY_CACHE_SIZE} entries {where}.")
+            except Exception as e:
+                print(f"[RAG] Query embedding cache unavailable: {e}")
+
+        if RAG_MULTI_QUERY and _SEARCH_POOL is None:
+            _SEARCH_POOL = ThreadPoolExecutor(max_workers=RAG_MULTI_QUERY_WORKERS, thread_name_prefix="rag-search")
+            print(
+                f"[RAG] Multi-query retrieval: {RAG_MULTI_QUERY_WORKERS} search thread(s), "
+                f"budget={RAG_LATENCY_BUDGET_MS:.0f} ms."
+            )
+
+        _RAG_ENABLED = True
+        print("[RAG] Retrieval is ENABLED.")
+    except Exception as e:
+        print(f"[RAG] Init failed: {e}")
+        print("[RAG] Retrieval is DISABLED.")
+        _RAG_ENABLED = False
+        _RAG_TABLE = None
+        _RAG_EMBED_MODEL = None
+        _RAG_QUERY_ENCODER = None
+        _RAG_CHUNK_INDEX = None
+        _QUERY_CACHE = None
+
+
+def flush_query_cache() -> None:
+    """Write buffered query embeddings to the persistent cache (on shutdown)."""
+    if _QUERY_CACHE is not None:
+        try:
+            _QUERY_CACHE.flush()
+        except Exception as e:
+            print(f"[RAG] Could not flush query embedding cache: {e}")
+
+
+def classify_query(query: str) -> Optional[str]:
+    """
+    Fast pre-retrieval check. Returns a skip reason ("empty", "smalltalk")
+    or None if the query should go to retrieval.
+    """
+    words = _WORD_RE.findall(query.lower())
+    if not words:
+        return "empty"
+    if RAG_SKIP_SMALLTALK and " ".join(words) in _SMALLTALK_PHRASES:
+        return "smalltalk"
+    return None
+
+
+def merge_chunk_texts(a: str, b: str) -> str:
+    """
+    Join two consecutive chunks of the same page, dropping the longest start of `b`
+    that repeats the end of `a` (chunk_text() overlap, any length). Falls back to a
+    plain join.
+    """
+    max_overlap = min(len(a), len(b))
+    if max_overlap == 0:
+        return a or b
+    # candidate starts left to right = longest overlap first
+    pos = a.find(b[0], len(a) - max_overlap)
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return a + b[len(a) - pos:]
+        pos = a.find(b[0], pos + 1)
+    return a + " " + b
+
+
+def query_variants(query: str, previous: Optional[str] = None) -> List[str]:
+    """
+    Variants searched by multi-query retrieval, the question itself first:
+    the question, the previous user turn + the question, and a keyword-only form.
+    Duplicates and empty variants are left out.
+    """
+    variants = [query]
+    if previous and previous.strip():
+        variants.append(f"{previous.strip()}\n{query}")
+    keywords = [w for w in _WORD_RE.findall(query) if len(w) > 2 and w.lower() not in _STOPWORDS]
+    if keywords:
+        variants.append(" ".join(keywords))
+
+    unique = []
+    for v in variants:
+        if v.lower() not in (u.lower() for u in unique):
+            unique.append(v)
+    return unique
+
+
+def fuse_results(results: list, limit: int):
+    """
+    Reciprocal rank fusion of several ranked search results (Arrow tables), deduplicated
+    by chunk id (doc_id, page, chunk). Returns one Arrow table in fused order with at most
+    `limit` rows; `_distance` is the best distance the chunk got in any variant.
+    """
+    if len(results) == 1:
+        return results[0]
+
+    scores = {}
+    rows = {}  # chunk id -> (row in the concatenated table, best distance)
+    offset = 0
+    for res in results:
+        doc_ids = _column(res, "doc_id", "unknown")
+        pages = _column(res, "page", "?")
+        chunks = _column(res, "chunk")
+        texts = _column(res, "text", "")
+        distances = _column(res, "_distance")
+        for rank in range(res.num_rows):
+            chunk = chunks[rank] if chunks[rank] is not None else texts[rank]
+            key = (str(doc_ids[rank]), pages[rank], chunk)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RAG_RRF_K + rank + 1)
+            distance = distances[rank]
+            best = rows.get(key)
+            if best is None:
+                rows[key] = (offset + rank, distance)
+            elif distance is not None and (best[1] is None or distance < best[1]):
+                rows[key] = (best[0], distance)
+        offset += res.num_rows
+
+    order = sorted(scores, key=lambda k: -scores[k])[:limit]
+    fused = pa.concat_tables(results).take([rows[k][0] for k in order])
+    if "_distance" in fused.column_names:
+        i = fused.column_names.index("_distance")
+        dist = pa.array([rows[k][1] for k in order], type=fused.schema.field(i).type)
+        fused = fused.set_column(i, "_distance", dist)
+    return fused
+
+
+def _column(result, name: str, default=None) -> list:
+    if name in result.column_names:
+        return result.column(name).to_pylist()
+    return [default] * result.num_rows
+
+
+def select_spans(result, top_k: int):
+    """
+    Group ranked hits (an Arrow table from the vector search) into at most top_k distinct
+    spans. A hit whose chunk index is adjacent to (or equal to) a chunk already selected
+    for the same (doc_id, page) joins that span instead of using a slot; the freed slot
+    goes to the next best hit. Columns are read once; no per-row dicts are built.
+
+    Returns (spans, merged) where each span is {"doc_id", "page", "chunks": {idx: text},
+    "distance": best distance, "rank": best rank} and merged counts absorbed hits.
+    Hits without a chunk index are never merged.
+    """
+    doc_ids = _column(result, "doc_id", "unknown")
+    pages = _column(result, "page", "?")
+    chunks = _column(result, "chunk")
+    texts = _column(result, "text", "")
+    distances = _column(result, "_distance")
+
+    spans = []
+    merged = 0
+    for rank in range(result.num_rows):
+        if len(spans) >= top_k:
+            break
+
+        doc_id = str(doc_ids[rank])
+        page = pages[rank]
+        chunk = chunks[rank]
+        text = str(texts[rank] or "")
+        distance = distances[rank]
+
+        touching = []
+        if chunk is not None:
+            touching = [
+                sp for sp in spans
+                if sp["mergeable"] and sp["doc_id"] == doc_id and sp["page"] == page
+                and any(abs(chunk - c) <= 1 for c in sp["chunks"])
+            ]
+
+        if touching:
+            target = touching[0]
+            for other in touching[1:]:  # hit bridges two spans -> join them
+                target["chunks"].update(other["chunks"])
+                spans.remove(other)
+            target["chunks"][chunk] = text
+            merged += 1
+            continue
+
+        spans.append({
+            "doc_id": doc_id,
+            "page": page,
+            "chunks": {chunk if chunk is not None else 0: text},
+            "mergeable": chunk is not None,
+            "distance": distance,
+            "rank": rank,
+        })
+    return spans, merged
+
+
+def expand_spans(spans: List[dict], window: int) -> int:
+    """
+    Add up to `window` neighboring chunks on each side of every span (same doc_id/page),
+    looked up in one pass over the in-memory chunk index. Spans that touch after the
+    expansion are joined. Returns the number of chunks added.
+    """
+    if window <= 0 or not _RAG_CHUNK_INDEX:
+        return 0
+
+    added = 0
+    for sp in spans:
+        if not sp["mergeable"]:
+            continue
+        lo, hi = min(sp["chunks"]), max(sp["chunks"])
+        for c in range(lo - window, hi + window + 1):
+            if c in sp["chunks"]:
+                continue
+            text = _RAG_CHUNK_INDEX.get((sp["doc_id"], sp["page"], c))
+            if text is not None:
+                sp["chunks"][c] = text
+                added += 1
+
+    # join spans of the same page whose chunk ranges now touch (keep the better rank)
+    joined: List[dict] = []
+    for sp in sorted(spans, key=lambda x: x["rank"]):
+        target = None
+        if sp["mergeable"]:
+            for other in joined:
+                if (other["mergeable"] and other["doc_id"] == sp["doc_id"] and other["page"] == sp["page"]
+                        and min(sp["chunks"]) <= max(other["chunks"]) + 1
+                        and min(other["chunks"]) <= max(sp["chunks"]) + 1):
+                    target = other
+                    break
+        if target is None:
+            joined.append(sp)
+        else:
+            target["chunks"].update(sp["chunks"])
+    spans[:] = joined
+    return added
+
+
+def span_text(span: dict) -> str:
+    """Contiguous text of a span, chunk overlaps removed."""
+    text = ""
+    prev = None
+    for idx in sorted(span["chunks"]):
+        piece = span["chunks"][idx]
+        if prev is not None and idx == prev + 1:
+            text = merge_chunk_texts(text, piece)
+        else:
+            text = f"{text} ... {piece}" if text else piece
+        prev = idx
+    return text
+
+
+def split_sentences(text: str, max_chars: int = RAG_COMPRESS_MAX_SENTENCE_CHARS) -> List[str]:
+    """Sentences of a span; overlong pieces (tables, lists) are cut at whitespace."""
+    out = []
+    for sentence in _SENTENCE_END_RE.split(text):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", max_chars // 2, max_chars)
+            if cut == -1:
+                cut = max_chars
+            out.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            out.append(sentence)
+    return out
+
+
+def compress_spans(spans: List[dict], q_vec, budget: int, info: dict) -> None:
+    """
+    Keep only the sentences most similar to the question, within `budget` tokens.
+    All sentences of all spans are embedded in one encoder call and scored with a
+    single matrix-vector product. Sets span["text"]; spans without a kept sentence
+    are removed. Fills info["compression"] = {chars_in, chars_out, ratio, sentences_in, sentences_out}.
+    """
+    owners = []  # sentence -> span index
+    sentences = []
+    for i, sp in enumerate(spans):
+        for sentence in split_sentences(span_text(sp)):
+            owners.append(i)
+            sentences.append(sentence)
+    chars_in = sum(len(span_text(sp)) for sp in spans)
+    if not sentences:
+        return
+
+    emb = np.asarray(_RAG_QUERY_ENCODER.encode(sentences), dtype=np.float32)
+    q = np.asarray(q_vec, dtype=np.float32)
+    scores = emb @ q / np.clip(np.linalg.norm(emb, axis=1) * np.linalg.norm(q), 1e-12, None)
+
+    lengths = [len(ids) for ids in _RAG_EMBED_MODEL.tokenizer(sentences, add_special_tokens=False)["input_ids"]]
+
+    keep = set()
+    used = 0
+    for j in np.argsort(-scores):
+        if scores[j] < RAG_COMPRESS_MIN_SCORE:
+            break
+        if used + lengths[j] > budget:
+            continue
+        keep.add(int(j))
+        used += lengths[j]
+
+    kept_text = [[] for _ in spans]
+    for j, (owner, sentence) in enumerate(zip(owners, sentences)):
+        if j in keep:
+            # mark skipped sentences inside a span so the model does not read them as adjacent
+            if kept_text[owner] and (j - 1) not in keep:
+                kept_text[owner].append("...")
+            kept_text[owner].append(sentence)
+
+    for sp, parts in zip(spans, kept_text):
+        sp["text"] = " ".join(parts)
+    spans[:] = [sp for sp in spans if sp["text"]]
+
+    chars_out = sum(len(sp["text"]) for sp in spans)
+    ratio = round(chars_out / chars_in, 3) if chars_in else 1.0
+    info["compression"] = {
+        "chars_in": chars_in,
+        "chars_out": chars_out,
+        "ratio": ratio,
+        "sentences_in": len(sentences),
+        "sentences_out": len(keep),
+        "tokens_out": used,
+    }
+    metric_observe("rag_compression_ratio", ratio)
+    if RAG_DEBUG:
+        print(
+            f"[RAG] Compressed context {chars_in} -> {chars_out} chars "
+            f"({len(keep)}/{len(sentences)} sentences, ~{used} tokens)."
+        )
+
+
+def is_enabled() -> bool:
+    return _RAG_ENABLED and _RAG_TABLE is not None and _RAG_QUERY_ENCODER is not None
+
+
+def _reset_info(info: Optional[dict]) -> dict:
+    if info is None:
+        info = {}
+    info.update({
+        "skipped": None, "variants": 1, "candidates": 0, "filtered": 0, "merged": 0, "expanded": 0, "kept": 0,
+    })
+    return info
+
+
+def _skip_reason(query: str, info: dict) -> Optional[str]:
+    reason = classify_query(query)
+    if reason:
+        info["skipped"] = reason
+        metric_inc(f"rag_skipped.{reason}")
+        if RAG_DEBUG:
+            print(f"[RAG] Query classified as '{reason}', skipping retrieval.")
+    return reason
+
+
+def encode_queries(queries: List[str]) -> list:
+    """Encode all queries in one encoder call; returns float32 lists for LanceDB."""
+    t0 = time.perf_counter()
+    if _QUERY_CACHE is None:
+        vecs = _RAG_QUERY_ENCODER.encode(queries)
+    else:
+        vecs, missing = _QUERY_CACHE.lookup(queries)
+        if missing:
+            todo = [queries[i] for i in missing]
+            new = np.asarray(_RAG_QUERY_ENCODER.encode(todo), dtype=np.float32)
+            vecs[missing] = new
+            _QUERY_CACHE.add(todo, new)
+        metric_inc("rag_embed_cache_hits", len(queries) - len(missing))
+        metric_inc("rag_embed_cache_misses", len(missing))
+        metric_set("rag_embed_cache_hit_rate", round(_QUERY_CACHE.hit_rate(), 4))
+    metric_observe("rag_query_encode_ms", (time.perf_counter() - t0) * 1000.0)
+    return [v.astype("float32").tolist() for v in vecs]
+
+
+def retrieve_context(query: str,
+                     top_k: int = RAG_TOP_K,
+                     max_chars: int = RAG_MAX_CHARS,
+                     info: Optional[dict] = None,
+                     previous: Optional[str] = None):
+    """
+    Retrieve relevant context from LanceDB for a given query.
+    Returns (concatenated_text, hits_list) where hits_list is a list of dicts:
+      { "doc_id": str, "page": int|str, "text": str, "distance": float|None }
+    If RAG is disabled/empty, returns ("", []).
+
+    Overlapping chunks of the same page are merged into one span (see select_spans),
+    and such hits additionally carry "chunks": [chunk indices].
+    With RAG_MULTI_QUERY=1, `previous` (the previous user turn) feeds one of the
+    query variants (see query_variants).
+
+    If `info` is a dict, it is filled with the retrieval decision:
+      skipped (reason or None), variants (searches fused), candidates, filtered (above
+      RAG_MAX_DISTANCE), merged (hits folded into a neighboring span), expanded (neighbor
+      chunks added), kept, timings_ms (per stage).
+    """
+    ctx, hits, result_info = retrieve_context_batch([query], top_k, max_chars, previous=[previous])[0]
+    if info is not None:
+        info.clear()
+        info.update(result_info)
+    return ctx, hits
+
+
+def retrieve_context_batch(queries: List[str],
+                           top_k: int = RAG_TOP_K,
+                           max_chars: int = RAG_MAX_CHARS,
+                           previous: Optional[List[Optional[str]]] = None):
+    """
+    Same as retrieve_context() for several queries: the queries that pass
+    classify_query() (with all their variants) are encoded in a single batch,
+    then searched query by query. Every query gets its own RAG_LATENCY_BUDGET_MS,
+    which starts with the time of the shared encode step, so results do not depend
+    on a query's position in the batch.
+    Returns a list of (concatenated_text, hits_list, info) in input order.
+    """
+    batch_timer = StageTimer("rag_stage_ms")
+    previous = previous or [None] * len(queries)
+
+    results = []
+    pending = []  # (result index, variants)
+    for query, prev in zip(queries, previous):
+        info = _reset_info(None)
+        results.append(["", [], info])
+        if not is_enabled():
+            info["skipped"] = "disabled"
+            continue
+        query = (query or "").strip()
+        if not _skip_reason(query, info):
+            variants = query_variants(query, prev) if RAG_MULTI_QUERY else [query]
+            pending.append((len(results) - 1, variants))
+
+    if not pending:
+        return [tuple(r) for r in results]
+
+    try:
+        with batch_timer.stage("encode"):
+            flat = encode_queries([v for _, variants in pending for v in variants])
+    except Exception as e:
+        print(f"[RAG] Query encoding error: {e}")
+        for i, _ in pending:
+            results[i][2]["skipped"] = "error"
+        return [tuple(r) for r in results]
+
+    encode_ms = batch_timer.ms["encode"]
+    pos = 0
+    for i, variants in pending:
+        info = results[i][2]
+        timer = StageTimer("rag_stage_ms", RAG_LATENCY_BUDGET_MS, spent_ms=encode_ms)
+        timer.ms["encode"] = encode_ms
+        vecs = flat[pos:pos + len(variants)]
+        pos += len(variants)
+        try:
+            hits = _search_variants(vecs, top_k * RAG_CANDIDATE_FACTOR, info, timer)
+            results[i][0], results[i][1] = _format_hits(hits, vecs[0], top_k, max_chars, info, timer)
+        except Exception as e:
+            print(f"[RAG] Retrieval error: {e}")
+            info["skipped"] = "error"
+        info["timings_ms"] = dict(timer.ms)
+        if RAG_DEBUG:
+            print(f"[RAG] Stage timings (ms): {timer.ms}")
+
+    metric_observe("rag_retrieval_ms", batch_timer.elapsed_ms())
+    return [tuple(r) for r in results]
+
+
+_SEARCH_EST_MS = 0.0  # moving average of one table search, for the variant deadline check
+
+
+def _search(q_vec, limit: int, deadline: Optional[float] = None):
+    """
+    One table search. With a deadline (perf_counter seconds) the search is not started
+    when it is not expected to finish in time, and None is returned instead.
+    """
+    global _SEARCH_EST_MS
+    t0 = time.perf_counter()
+    if deadline is not None and t0 + _SEARCH_EST_MS / 1000.0 > deadline:
+        return None
+    res = _RAG_TABLE.search(q_vec).select(RAG_COLUMNS).limit(limit).to_arrow()
+    ms = (time.perf_counter() - t0) * 1000.0
+    _SEARCH_EST_MS = ms if not _SEARCH_EST_MS else 0.8 * _SEARCH_EST_MS + 0.2 * ms
+    return res
+
+
+def _search_variants(vecs: list, limit: int, info: dict, timer: StageTimer):
+    """
+    Search every query variant (concurrently if there are several) and fuse the
+    rankings. A variant search is only started while it can still finish within the
+    latency budget (checked when it is submitted and again when a pool thread picks
+    it up), so late variants cost neither pool threads nor LanceDB time.
+    """
+    if len(vecs) == 1 or _SEARCH_POOL is None:
+        with timer.stage("search"):
+            return _search(vecs[0], limit)
+
+    with timer.stage("search"):
+        remaining = timer.remaining_s()
+        deadline = None if remaining is None else time.perf_counter() + remaining
+        # the question itself is always searched
+        futures = [_SEARCH_POOL.submit(_search, vecs[0], limit)]
+        for v in vecs[1:]:
+            if deadline is not None and time.perf_counter() + _SEARCH_EST_MS / 1000.0 > deadline:
+                break
+            futures.append(_SEARCH_POOL.submit(_search, v, limit, deadline))
+        wait(futures, timeout=remaining)
+        ranked = [futures[0].result()]
+        for f in futures[1:]:
+            # a search that started in time but is still running is left to finish
+            if f.done() and f.exception() is None and f.result() is not None:
+                ranked.append(f.result())
+        dropped = len(vecs) - len(ranked)
+    if dropped:
+        metric_inc("rag_variants_dropped", dropped)
+        if RAG_DEBUG:
+            print(f"[RAG] Dropped {dropped} query variant(s) (latency budget or error).")
+    info["variants"] = len(ranked)
+
+    with timer.stage("fuse"):
+        return fuse_results(ranked, limit)
+
+
+def _format_hits(hits, q_vec, top_k: int, max_chars: int, info: dict, timer: StageTimer):
+    """Relevance filter + span selection/expansion + optional compression + context formatting."""
+    with timer.stage("select"):
+        spans = _select(hits, top_k, info)
+    if not spans:
+        return "", []
+
+    if RAG_COMPRESS:
+        with timer.stage("compress"):
+            try:
+                compress_spans(spans, q_vec, RAG_COMPRESS_TOKEN_BUDGET, info)
+            except Exception as e:
+                print(f"[RAG] Compression failed, using full context: {e}")
+                for sp in spans:
+                    sp.pop("text", None)
+
+    with timer.stage("format"):
+        return _render(spans, max_chars, info)
+
+
+def _select(hits, top_k: int, info: dict) -> List[dict]:
+    info["candidates"] = hits.num_rows
+
+    if RAG_MAX_DISTANCE > 0 and "_distance" in hits.column_names:
+        relevant = hits.filter(pc.less_equal(hits.column("_distance"), RAG_MAX_DISTANCE))
+        info["filtered"] = hits.num_rows - relevant.num_rows
+        if info["filtered"]:
+            metric_inc("rag_hits_filtered", info["filtered"])
+            if RAG_DEBUG:
+                print(f"[RAG] Dropped {info['filtered']} hit(s) above distance {RAG_MAX_DISTANCE}.")
+        hits = relevant
+
+    if hits.num_rows == 0:
+        info["skipped"] = "no_relevant_hits" if info["candidates"] else "no_hits"
+        metric_inc(f"rag_skipped.{info['skipped']}")
+        if RAG_DEBUG:
+            print("[RAG] No hits.")
+        return []
+
+    print(f"[RAG] Retrieved {hits.num_rows} candidate chunk(s).")
+
+    spans, merged = select_spans(hits, top_k)
+    info["merged"] = merged
+    if merged:
+        metric_inc("rag_chunks_merged", merged)
+        if RAG_DEBUG:
+            print(f"[RAG] Merged {merged} overlapping chunk(s) into neighboring spans.")
+
+    expanded = expand_spans(spans, RAG_NEIGHBOR_WINDOW)
+    info["expanded"] = expanded
+    if expanded:
+        metric_inc("rag_neighbors_added", expanded)
+        if RAG_DEBUG:
+            print(f"[RAG] Added {expanded} neighbor chunk(s) (window={RAG_NEIGHBOR_WINDOW}).")
+    return spans
+
+
+def _render(spans: List[dict], max_chars: int, info: dict):
+    pieces = []
+    total_chars = 0
+    hits_export = []
+
+    for idx, sp in enumerate(spans):
+        doc_id = sp["doc_id"]
+        page = sp["page"]
+        text = sp["text"] if "text" in sp else span_text(sp)
+        distance = sp["distance"]
+        chunk_ids = sorted(sp["chunks"]) if sp["mergeable"] else []
+
+        prefix = f"[{doc_id} p.{page}] "
+        snippet = prefix + text
+
+        # store a clean version for the client UI
+        hit = {
+            "doc_id": doc_id,
+            "page": page,
+            "text": text,
+            "distance": round(float(distance), 4) if distance is not None else None,
+        }
+        if len(chunk_ids) > 1:
+            hit["chunks"] = chunk_ids
+        hits_export.append(hit)
+
+        if total_chars + len(snippet) > max_chars:
+            remaining = max_chars - total_chars
+            if remaining > 0:
+                pieces.append(snippet[:remaining])
+            print(f"[RAG] Reached max_chars={max_chars}, truncating context.")
+            break
+
+        pieces.append(snippet)
+        total_chars += len(snippet)
+
+        if RAG_DEBUG >= 1:
+            preview = text[:200].replace("\n", " ")
+            print(
+                f"[RAG]  -> hit {idx}: {doc_id} p.{page} "
+                f"(chunk len={len(text)}, distance={distance}) preview='{preview}...'"
+            )
+
+    info["kept"] = len(hits_export)
+    return "\n\n".join(pieces), hits_export
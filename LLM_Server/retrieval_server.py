@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+retrieval_server.py
+
+Standalone retrieval service: the RAG part of server.py (embedding model + LanceDB
+search, see rag.py) in its own FastAPI process, so retrieval does not compete with
+generation for the GIL / GPU and can be scaled and cached on a CPU node.
+
+Endpoints:
+  POST /retrieve  {"queries": [...], "previous": [...], "top_k": 5, "max_chars": 16000}
+                  -> {"results": [{"context": str, "hits": [...], "info": {...}}, ...]}
+  GET  /health
+  GET  /metrics
+
+Point server.py at it with RAG_REMOTE_URL=http://<host>:9100.
+
+Usage:
+  cd ~/FuzzyBot_HSBI/LLM_Server
+  RETRIEVAL_PORT=9100 python retrieval_server.py
+
+Env (in addition to the RAG_* / EMBEDDING_* vars of server.py):
+- RETRIEVAL_HOST / RETRIEVAL_PORT -> bind address (default 0.0.0.0:9100)
+- RETRIEVAL_DEVICE                -> device of the embedding model (default cpu)
+- RETRIEVAL_CACHE_SIZE            -> LRU result cache entries, 0 = off (default 1024)
+- RETRIEVAL_MAX_BATCH             -> max queries per /retrieve call (default 64)
+"""
+
+import os
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+# rag.py reads the device at import; retrieval is meant to run on a CPU node
+os.environ.setdefault("RAG_EMBED_DEVICE", os.environ.get("RETRIEVAL_DEVICE", "cpu"))
+
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+import rag
+from metrics import metric_inc, metric_observe, metric_set, metrics_snapshot
+
+print("=== retrieval_server.py -- FuzzyBot retrieval service ===")
+
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 1024))
+RETRIEVAL_MAX_BATCH = int(os.environ.get("RETRIEVAL_MAX_BATCH", 64))
+
+app = FastAPI()
+
+# ============================================================
+# Result cache (query, previous, top_k, max_chars) -> (context, hits, info)
+# ============================================================
+
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def _cache_get(key):
+    if RETRIEVAL_CACHE_SIZE <= 0:
+        return None
+    with _CACHE_LOCK:
+        value = _CACHE.get(key)
+        if value is not None:
+            _CACHE.move_to_end(key)
+        return value
+
+
+def _cache_put(key, value) -> None:
+    if RETRIEVAL_CACHE_SIZE <= 0:
+        return
+    with _CACHE_LOCK:
+        _CACHE[key] = value
+        _CACHE.move_to_end(key)
+        while len(_CACHE) > RETRIEVAL_CACHE_SIZE:
+            _CACHE.popitem(last=False)
+        metric_set("retrieval_cache_size", len(_CACHE))
+
+
+# ============================================================
+# API
+# ============================================================
+
+class RetrieveRequest(BaseModel):
+    queries: List[str]
+    previous: Optional[List[Optional[str]]] = None  # previous user turn per query (multi-query)
+    top_k: Optional[int] = None
+    max_chars: Optional[int] = None
+
+
+def retrieve_batch(queries: List[str], previous: List[Optional[str]], top_k: int, max_chars: int) -> list:
+    if not rag.RAG_MULTI_QUERY:
+        previous = [None] * len(queries)  # only multi-query retrieval uses the previous turn
+    results = [None] * len(queries)
+    missing = []
+    for i, query in enumerate(queries):
+        cached = _cache_get((query, previous[i], top_k, max_chars))
+        if cached is not None:
+            metric_inc("retrieval_cache_hits")
+            results[i] = cached
+        else:
+            missing.append(i)
+
+    if missing:
+        metric_inc("retrieval_cache_misses", len(missing))
+        fresh = rag.retrieve_context_batch(
+            [queries[i] for i in missing],
+            top_k=top_k,
+            max_chars=max_chars,
+            previous=[previous[i] for i in missing],
+        )
+        for i, (ctx, hits, info) in zip(missing, fresh):
+            results[i] = (ctx, hits, info)
+            if info.get("skipped") != "error":
+                _cache_put((queries[i], previous[i], top_k, max_chars), results[i])
+
+    return [{"context": ctx, "hits": hits, "info": info} for ctx, hits, info in results]
+
+
+@app.on_event("startup")
+def _startup():
+    rag.init_rag()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    rag.flush_query_cache()
+
+
+@app.post("/retrieve")
+async def retrieve(req: RetrieveRequest):
+    if len(req.queries) > RETRIEVAL_MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"at most {RETRIEVAL_MAX_BATCH} queries per request")
+    previous = req.previous or [None] * len(req.queries)
+    if len(previous) != len(req.queries):
+        raise HTTPException(status_code=422, detail="previous must have one entry per query")
+    top_k = req.top_k or rag.RAG_TOP_K
+    max_chars = req.max_chars or rag.RAG_MAX_CHARS
+
+    metric_inc("retrieval_requests")
+    metric_observe("retrieval_batch_size", len(req.queries))
+    results = await run_in_threadpool(retrieve_batch, req.queries, previous, top_k, max_chars)
+    return {"results": results}
+
+
+@app.get("/health")
+def health():
+    return {"ok": True, "rag_enabled": rag.is_enabled()}
+
+
+@app.get("/metrics")
+def metrics():
+    return metrics_snapshot()
+
+
+# ============================================================
+# Uvicorn launcher
+# ============================================================
+
+if __name__ == "__main__":
+    import uvicorn
+    host = os.environ.get("RETRIEVAL_HOST", "0.0.0.0")
+    port = int(os.environ.get("RETRIEVAL_PORT", "9100"))
+    print(f"[retrieval] Launching retrieval service on {host}:{port}")
+    uvicorn.run(app, host=host, port=port, reload=False)
@@ -12,10 +12,6 @@ MODEL_NAME = os.environ.get("FUZZYBOT_MODEL_NAME", "Apertus-8B-Instruct-2509")
 # Backwards compatible: APERTUS_MODEL_DIR overrides everything
 MODEL_DIR = Path(os.environ.get("APERTUS_MODEL_DIR", str(DEFAULT_MODELS_DIR / MODEL_NAME))).expanduser()
 
-# RAG DB
-DEFAULT_DB_DIR = Path(os.environ.get("FUZZYBOT_DB_DIR", str(PROJECT_ROOT / "LLM_Server" / "rag" / "db"))).expanduser()
-EMBED_DB_URI = os.environ.get("EMBEDDING_DB_URI", str(DEFAULT_DB_DIR))
-
 print("=== server.py -- Apertus Streaming + RAG ===")
 
 # ============================================================
@@ -28,23 +24,46 @@ os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
 
 import uuid
 import json as _json
+import asyncio
 import time
+import hashlib
+import inspect
 import threading
-from typing import List, Literal
+from collections import OrderedDict, deque
+from functools import lru_cache, wraps
+from typing import List, Literal, Optional, Union
 
 import torch
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
-    TextIteratorStreamer,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
-
-# --- RAG imports --------------------------------------------------------
-import lancedb
-from sentence_transformers import SentenceTransformer
+from transformers.generation.streamers import BaseStreamer
+
+try:
+    from transformers import CompileConfig, StaticCache
+except ImportError:  # older transformers: static decode mode unavailable
+    CompileConfig = None
+    StaticCache = None
+
+try:
+    import httpx  # only needed for RAG_REMOTE_URL
+except ImportError:
+    httpx = None
+
+# --- RAG + metrics (sibling modules) ------------------------------------
+import rag
+from rag import RAG_DEBUG, init_rag
+from metrics import metric_inc, metric_observe, metric_set, metrics_snapshot
+from stopping import StopMatcher, normalize_stop, truncate_at_stop
+from streaming import ChoiceStreamer, start_generation
 
 # ============================================================
 # FastAPI app
@@ -58,10 +77,29 @@ app = FastAPI()
 
 print(f"[apertus] Using model dir: {MODEL_DIR}")
 
+# auto = GPU(s) if visible, else CPU. cuda without a visible GPU degrades to CPU.
+FUZZYBOT_DEVICE = os.environ.get("FUZZYBOT_DEVICE", "auto").strip().lower()
+CPU_QUANTIZE = int(os.environ.get("CPU_QUANTIZE", 1))  # dynamic int8 for nn.Linear on CPU
+CPU_THREADS = int(os.environ.get("CPU_THREADS", os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1)))
+
 num_gpus = torch.cuda.device_count()
 print(f"[apertus] torch.cuda.device_count() = {num_gpus}")
 
-if num_gpus < 2:
+if FUZZYBOT_DEVICE == "cpu" or num_gpus == 0:
+    if FUZZYBOT_DEVICE == "cuda":
+        print("[apertus][WARN] FUZZYBOT_DEVICE=cuda but no GPU is visible - falling back to CPU.")
+    DEVICE = "cpu"
+else:
+    DEVICE = "cuda"
+
+INPUT_DEVICE = "cuda:0" if DEVICE == "cuda" else "cpu"
+
+# smaller default generation length on CPU, where every token is expensive
+DEFAULT_MAX_TOKENS = int(os.environ.get("DEFAULT_MAX_TOKENS", 256 if DEVICE == "cuda" else 128))
+
+print(f"[apertus] Device: {DEVICE} (default max_tokens={DEFAULT_MAX_TOKENS})")
+
+if DEVICE == "cuda" and num_gpus < 2:
     print("[apertus][WARN] Less than 2 GPUs visible - device_map='auto' will still use all available GPUs.")
 
 print(f"[apertus] Loading tokenizer...")
@@ -77,146 +115,482 @@ tokenizer.padding_side = "left"
 
 print(f"[apertus] Loading model... this may take a minute.")
 
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_DIR,
-    device_map="auto",          # use all visible GPUs
-    torch_dtype=torch.bfloat16, # A100 -> ideal
-    low_cpu_mem_usage=True,
-    trust_remote_code=True,
-    local_files_only=True,
-)
+if DEVICE == "cuda":
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_DIR,
+        device_map="auto",          # use all visible GPUs
+        torch_dtype=torch.bfloat16, # A100 -> ideal
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+        local_files_only=True,
+    )
+else:
+    torch.set_num_threads(CPU_THREADS)
+    print(f"[apertus] CPU mode: {CPU_THREADS} thread(s), int8 dynamic quantization={'on' if CPU_QUANTIZE else 'off'}")
+
+    # fp32 weights: bf16 matmuls are slow on most CPUs and quantize_dynamic expects float
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_DIR,
+        torch_dtype=torch.float32,
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+        local_files_only=True,
+    )
+
+    if CPU_QUANTIZE:
+        model = torch.ao.quantization.quantize_dynamic(
+            model,
+            {torch.nn.Linear},
+            dtype=torch.qint8,
+        )
 
 model.eval()
 print("[apertus] Model loaded & ready!")
 
 # ============================================================
-# RAG config + state
+# Static KV cache + torch.compile decode mode (opt-in)
 # ============================================================
-
-EMBED_TABLE_NAME = os.environ.get("EMBEDDING_TABLE_NAME", "pdf_chunks")
-EMBED_MODEL_NAME = os.environ.get(
-    "EMBEDDING_MODEL_PATH",
-    "sentence-transformers/all-MiniLM-L6-v2",
+#
+# STATIC_DECODE=1 preallocates one StaticCache per sequence-length bucket
+# (bucket = max_cache_len = prompt + max_new_tokens) and lets generate()
+# run the decode steps through a compiled forward. Each bucket is compiled
+# once during warmup, so requests that fit a bucket reuse the same graph.
+# Anything unsupported (no CUDA, old transformers, warmup failure, batch > 1,
+# request larger than the biggest bucket, bucket busy) falls back to the
+# plain dynamic-cache model.generate() path.
+
+STATIC_DECODE = int(os.environ.get("STATIC_DECODE", 0))
+STATIC_DECODE_BUCKETS = sorted(
+    int(x) for x in os.environ.get("STATIC_DECODE_BUCKETS", "1024,2048,4096,8192").split(",") if x.strip()
 )
-RAG_TOP_K = int(os.environ.get("RAG_TOP_K", 5))
-RAG_MAX_CHARS = int(os.environ.get("RAG_MAX_CHARS", 16000))
-RAG_DEBUG = int(os.environ.get("RAG_DEBUG", 1))
+STATIC_DECODE_COMPILE_MODE = os.environ.get("STATIC_DECODE_COMPILE_MODE", "reduce-overhead")
 
-_RAG_ENABLED = False
-_RAG_TABLE = None
-_RAG_EMBED_MODEL = None
+_STATIC_DECODE_READY = False
+_STATIC_SLOTS = {}  # bucket -> (StaticCache, threading.Lock)
+_COMPILE_CONFIG = None
+_GRAPH_COUNT_LOCK = threading.Lock()
+_LAST_GRAPH_COUNT = 0
 
 
-def init_rag():
-    """
-    Initialize LanceDB + embedding model.
-    If anything fails, we just disable RAG and keep the normal chat working.
-    """
-    global _RAG_ENABLED, _RAG_TABLE, _RAG_EMBED_MODEL
-
+def _compiled_graph_count() -> int:
+    """Number of graphs torch.compile has produced so far in this process."""
     try:
-        print(f"[RAG] Connecting to LanceDB at '{EMBED_DB_URI}'...")
-        db = lancedb.connect(EMBED_DB_URI)
+        from torch._dynamo.utils import counters
+        return int(counters["stats"]["unique_graphs"])
+    except Exception:
+        return 0
+
 
-        if EMBED_TABLE_NAME not in db.table_names():
-            print(f"[RAG] Table '{EMBED_TABLE_NAME}' not found. RAG disabled.")
-            _RAG_ENABLED = False
-            return
+def _track_recompiles() -> None:
+    """Count graphs compiled after warmup - each one is a recompilation on the hot path."""
+    global _LAST_GRAPH_COUNT
+    now = _compiled_graph_count()
+    with _GRAPH_COUNT_LOCK:
+        if now > _LAST_GRAPH_COUNT:
+            metric_inc("static_decode_recompiles", now - _LAST_GRAPH_COUNT)
+            print(f"[static] WARN: {now - _LAST_GRAPH_COUNT} recompilation(s) after warmup (total graphs={now}).")
+        _LAST_GRAPH_COUNT = now
 
-        _RAG_TABLE = db.open_table(EMBED_TABLE_NAME)
-        print(f"[RAG] Opened table '{EMBED_TABLE_NAME}' with {_RAG_TABLE.count_rows()} rows.")
 
-        print(f"[RAG] Loading embedding model: {EMBED_MODEL_NAME}")
-        _RAG_EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME)
-        dim = _RAG_EMBED_MODEL.get_sentence_embedding_dimension()
-        print(f"[RAG] Embedding dimension: {dim}")
+def _make_static_cache(max_cache_len: int):
+    try:
+        return StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=max_cache_len,
+            device=model.device,
+            dtype=model.dtype,
+        )
+    except TypeError:
+        # newer transformers: layers are allocated lazily on first use
+        return StaticCache(config=model.config, max_cache_len=max_cache_len)
+
+
+def _acquire_static_slot(needed_len: int):
+    """Return (bucket, cache, lock) for the smallest free bucket >= needed_len, or None."""
+    fitting = [b for b in STATIC_DECODE_BUCKETS if b >= needed_len]
+    if not fitting:
+        metric_inc("static_decode_bucket_misses")
+        return None
+    for bucket in fitting:
+        cache, lock = _STATIC_SLOTS[bucket]
+        if lock.acquire(blocking=False):
+            return bucket, cache, lock
+    metric_inc("static_decode_busy_fallbacks")
+    return None
+
+
+def init_static_decode():
+    """
+    Allocate the per-bucket static caches and compile each bucket once.
+    On any failure the static mode is disabled and model.generate() is used as before.
+    """
+    global _STATIC_DECODE_READY, _COMPILE_CONFIG, _LAST_GRAPH_COUNT
+
+    metric_set("static_decode_enabled", 0)
+    if not STATIC_DECODE:
+        return
+    if StaticCache is None or CompileConfig is None:
+        print("[static] transformers has no StaticCache/CompileConfig - static decode DISABLED.")
+        return
+    if DEVICE != "cuda":
+        print("[static] Not running on CUDA - static decode DISABLED.")
+        return
+    if not getattr(model, "_supports_static_cache", True):
+        print("[static] Model does not support a static cache - static decode DISABLED.")
+        return
+    shard_devices = {str(d) for d in (getattr(model, "hf_device_map", None) or {}).values()}
+    if len(shard_devices) > 1:
+        # the cache would be allocated on model.device only, not next to each layer
+        print(f"[static] Model is sharded over {sorted(shard_devices)} - static decode DISABLED.")
+        return
 
-        _RAG_ENABLED = True
-        print("[RAG] Retrieval is ENABLED.")
+    try:
+        _COMPILE_CONFIG = CompileConfig(fullgraph=False, dynamic=False, mode=STATIC_DECODE_COMPILE_MODE)
+        warmup_inputs = tokenizer("Warmup", return_tensors="pt", add_special_tokens=False).to(INPUT_DEVICE)
+
+        for bucket in STATIC_DECODE_BUCKETS:
+            cache = _make_static_cache(bucket)
+            _STATIC_SLOTS[bucket] = (cache, threading.Lock())
+
+            graphs_before = _compiled_graph_count()
+            t0 = time.perf_counter()
+            # two short runs: the first compiles, the second captures/replays the graph
+            for _ in range(2):
+                cache.reset()
+                with torch.no_grad():
+                    model.generate(
+                        **warmup_inputs,
+                        max_new_tokens=4,
+                        do_sample=False,
+                        past_key_values=cache,
+                        compile_config=_COMPILE_CONFIG,
+                    )
+            compile_s = time.perf_counter() - t0
+            graphs = _compiled_graph_count() - graphs_before
+
+            metric_set(f"static_decode_compile_s.{bucket}", round(compile_s, 2))
+            print(f"[static] Bucket {bucket}: compiled in {compile_s:.1f}s ({graphs} graph(s)).")
+
+        _LAST_GRAPH_COUNT = _compiled_graph_count()
+        metric_set("static_decode_graphs_after_warmup", _LAST_GRAPH_COUNT)
+        metric_set("static_decode_enabled", 1)
+        _STATIC_DECODE_READY = True
+        print(f"[static] Static decode ENABLED for buckets {STATIC_DECODE_BUCKETS}.")
     except Exception as e:
-        print(f"[RAG] Init failed: {e}")
-        print("[RAG] Retrieval is DISABLED.")
-        _RAG_ENABLED = False
-        _RAG_TABLE = None
-        _RAG_EMBED_MODEL = None
+        print(f"[static] Warmup failed: {e}")
+        print("[static] Static decode DISABLED, using model.generate() with dynamic cache.")
+        _STATIC_SLOTS.clear()
+        _STATIC_DECODE_READY = False
+
+
+# ============================================================
+# Chunked prefill + FIFO forward scheduling (opt-in)
+# ============================================================
+#
+# Every stream runs model.generate() in its own thread and they share the GPU.
+# A long RAG prompt is prefilled in a single forward pass, and all other streams
+# wait for it. PREFILL_CHUNK_TOKENS=N turns on:
+# - a FIFO turn around every model forward (a prefill slice or one decode step), so
+#   the decode steps of running streams get the GPU between the slices of a prefill;
+# - prefill of prompts longer than N tokens in N-token slices into a DynamicCache;
+#   generate() then continues from that cache with the last prompt token.
+# Smaller slices lower the inter-token latency of running streams and raise the
+# TTFT of the long prompt. Both (ttft_ms, itl_ms) are reported in GET /metrics.
+# Not combined with STATIC_DECODE (the compiled forward cannot take the turn).
+
+PREFILL_CHUNK_TOKENS = int(os.environ.get("PREFILL_CHUNK_TOKENS", 0))
+
+
+class ForwardTurns:
+    """Ticket lock: forward passes run one at a time, in arrival order."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def __enter__(self):
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._cond.wait()
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._serving += 1
+            self._cond.notify_all()
+
+
+_FORWARD_TURNS = None
+_PREFILL_LOGITS_KWARGS = {}
+
+
+def init_chunked_prefill():
+    """Wrap model.forward with the FIFO turn (keeps its signature for generate())."""
+    global PREFILL_CHUNK_TOKENS, _FORWARD_TURNS, _PREFILL_LOGITS_KWARGS
+
+    metric_set("prefill_chunk_tokens", 0)
+    if PREFILL_CHUNK_TOKENS <= 0:
+        return
+    if _STATIC_DECODE_READY:
+        print("[prefill] STATIC_DECODE is active - chunked prefill DISABLED.")
+        PREFILL_CHUNK_TOKENS = 0
+        return
+
+    _FORWARD_TURNS = ForwardTurns()
+    inner = model.forward
+
+    @wraps(inner)
+    def forward(*args, **kwargs):
+        t0 = time.perf_counter()
+        with _FORWARD_TURNS:
+            metric_observe("forward_wait_ms", (time.perf_counter() - t0) * 1000.0)
+            return inner(*args, **kwargs)
+
+    model.forward = forward
+    # prefill slices only need the cache, not logits for every position
+    if "logits_to_keep" in inspect.signature(inner).parameters:
+        _PREFILL_LOGITS_KWARGS = {"logits_to_keep": 1}
+    metric_set("prefill_chunk_tokens", PREFILL_CHUNK_TOKENS)
+    print(f"[prefill] Chunked prefill ENABLED ({PREFILL_CHUNK_TOKENS} tokens per slice).")
+
+
+def _chunked_prefill(inputs, chunk: int = 0):
+    """Prefill all prompt tokens but the last in `chunk`-token slices (0 = one pass); returns the cache."""
+    ids = inputs["input_ids"]
+    mask = inputs.get("attention_mask")
+    cache = DynamicCache()
+    n = ids.shape[1] - 1
+    step = chunk if chunk > 0 else max(1, n)
+    for start in range(0, n, step):
+        end = min(start + step, n)
+        model(
+            input_ids=ids[:, start:end],
+            attention_mask=mask[:, :end] if mask is not None else None,
+            past_key_values=cache,
+            use_cache=True,
+            cache_position=torch.arange(start, end, device=ids.device),
+            **_PREFILL_LOGITS_KWARGS,
+        )
+        metric_inc("prefill_slices")
+    return cache
 
 
-def retrieve_context(query: str,
-                     top_k: int = RAG_TOP_K,
-                     max_chars: int = RAG_MAX_CHARS):
+class _StreamGuard(BaseStreamer):
     """
-    Retrieve relevant context from LanceDB for a given query.
-    Returns (concatenated_text, hits_list) where hits_list is a list of dicts:
-      { "doc_id": str, "page": int|str, "text": str }
-    If RAG is disabled/empty, returns ("", []).
+    Forwards to the caller's streamer and remembers whether any token went through,
+    so a failed static-decode attempt is only retried if nothing was streamed yet.
+    skip_prompt=True drops the prompt push of the retry: the caller's streamer
+    already got one from the first attempt.
     """
-    if not _RAG_ENABLED or _RAG_TABLE is None or _RAG_EMBED_MODEL is None:
-        return "", []
 
-    query = query.strip()
-    if not query:
-        return "", []
+    def __init__(self, streamer, skip_prompt: bool = False):
+        self.streamer = streamer
+        self.prompt_pending = True
+        self.skip_prompt = skip_prompt
+        self.emitted = False
+
+    def put(self, value):
+        if self.prompt_pending:
+            # generate() pushes the prompt ids first
+            self.prompt_pending = False
+            if self.skip_prompt:
+                return
+        else:
+            self.emitted = True
+        self.streamer.put(value)
+
+    def end(self):
+        self.streamer.end()
+
+    def fail(self, error: BaseException):
+        """Closes the caller's stream after an error; generate() itself never ends it then."""
+        if hasattr(self.streamer, "fail"):
+            self.streamer.fail(error)
+        else:
+            self.streamer.end()
+
+
+def run_generate(inputs, max_new_tokens: int, temperature: float, top_p: float,
+                 streamer=None, num_return_sequences: int = 1, stop: Optional[List[str]] = None):
+    """
+    Single entry point for generation. Uses a static-cache bucket when static decode is
+    ready and the request fits, otherwise the plain model.generate() path (with a
+    chunked prefill for long single-sequence prompts when PREFILL_CHUNK_TOKENS is set).
+    num_return_sequences > 1 prefills the prompt once and copies the KV cache n times
+    before decoding (generate() on its own would expand the prompt to n rows and
+    prefill all of them).
+    stop strings end a sequence on the GPU as soon as its text contains one of them
+    (the returned ids still include the stop text; cut it with truncate_at_stop()).
+    Returns the generate() output (prompt ids followed by the new ids, one row per sequence).
+    """
+    global _STATIC_DECODE_READY
+
+    prompt_len = inputs["input_ids"].shape[1]
+    stop_criteria = StopSequenceCriteria(tokenizer, stop, prompt_len) if stop else None
+
+    gen_kwargs = dict(
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        temperature=temperature,
+        top_p=top_p,
+        streamer=streamer,
+        num_return_sequences=num_return_sequences,
+    )
+    if stop_criteria is not None:
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList([stop_criteria])
 
-    try:
-        q_vec = _RAG_EMBED_MODEL.encode([query])[0].astype("float32").tolist()
-        hits = _RAG_TABLE.search(q_vec).limit(top_k).to_list()
+    slot = None
+    if _STATIC_DECODE_READY and inputs["input_ids"].shape[0] == 1 and num_return_sequences == 1:
+        slot = _acquire_static_slot(prompt_len + max_new_tokens)
 
-        if not hits:
-            if RAG_DEBUG:
-                print("[RAG] No hits.")
-            return "", []
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        if slot is not None:
+            _bucket, cache, lock = slot
+            guard = _StreamGuard(streamer) if streamer is not None else None
+            try:
+                cache.reset()
+                out = model.generate(**inputs, **dict(gen_kwargs, streamer=guard),
+                                     past_key_values=cache, compile_config=_COMPILE_CONFIG)
+                _track_recompiles()
+            except Exception as e:
+                print(f"[static] Generation failed ({e}); disabling static decode.")
+                metric_inc("static_decode_errors")
+                metric_set("static_decode_enabled", 0)
+                _STATIC_DECODE_READY = False
+                if guard is not None and guard.emitted:
+                    # the client already has part of this answer; a retry would repeat it,
+                    # so close the stream here instead of leaving its reader waiting
+                    guard.fail(e)
+                    raise
+                slot = None
+                t0 = time.perf_counter()
+                if guard is not None:
+                    gen_kwargs["streamer"] = _StreamGuard(streamer, skip_prompt=not guard.prompt_pending)
+                if stop_criteria is not None:
+                    stop_criteria = StopSequenceCriteria(tokenizer, stop, prompt_len)
+                    gen_kwargs["stopping_criteria"] = StoppingCriteriaList([stop_criteria])
+                out = model.generate(**inputs, **gen_kwargs)
+            finally:
+                lock.release()
+        elif inputs["input_ids"].shape[0] == 1 and prompt_len > 1 and (
+                num_return_sequences > 1 or 0 < PREFILL_CHUNK_TOKENS < prompt_len):
+            chunk = PREFILL_CHUNK_TOKENS if 0 < PREFILL_CHUNK_TOKENS < prompt_len else 0
+            cache = _chunked_prefill(inputs, chunk)
+            metric_observe("prefill_ms.chunked" if chunk else "prefill_ms.shared",
+                           (time.perf_counter() - t0) * 1000.0)
+            if num_return_sequences > 1:
+                # one prefill, n copies of its cache; generate() then only feeds the last prompt token
+                cache.batch_repeat_interleave(num_return_sequences)
+                inputs = {k: v.repeat(num_return_sequences, 1) for k, v in inputs.items()}
+            out = model.generate(**inputs, **dict(gen_kwargs, num_return_sequences=1),
+                                 past_key_values=cache)
+        else:
+            out = model.generate(**inputs, **gen_kwargs)
+    elapsed_ms = (time.perf_counter() - t0) * 1000.0
+
+    mode = "static" if slot is not None else "dynamic"
+    new_tokens = out.shape[1] - prompt_len  # decode steps (shared by all sequences)
+    metric_inc(f"generate_requests.{mode}")
+    if new_tokens > 0:
+        metric_observe(f"ms_per_token.{mode}", elapsed_ms / new_tokens)
+
+    if stop_criteria is not None:
+        for steps in stop_criteria.stop_steps:
+            if steps is not None:
+                metric_inc("stop_sequence_hits")
+                metric_inc("stop_tokens_saved", max_new_tokens - steps)
+    return out
+
+
+init_static_decode()
+init_chunked_prefill()
 
-        pieces = []
-        total_chars = 0
-        hits_export = []
+# ============================================================
+# RAG: in-process (rag.py) or remote retrieval service
+# ============================================================
+#
+# RAG_REMOTE_URL points at retrieval_server.py (e.g. on a CPU node). Then no embedding
+# model or LanceDB table is loaded here; retrieval goes through a pooled async HTTP
+# client with a timeout, and any failure falls back to answering without RAG.
 
-        print(f"[RAG] Retrieved {len(hits)} candidate chunk(s).")
+RAG_REMOTE_URL = os.environ.get("RAG_REMOTE_URL", "").strip().rstrip("/")
+RAG_REMOTE_TIMEOUT = float(os.environ.get("RAG_REMOTE_TIMEOUT", 2.0))
+RAG_REMOTE_POOL = int(os.environ.get("RAG_REMOTE_POOL", 16))
 
-        for idx, h in enumerate(hits):
-            doc_id = str(h.get("doc_id", "unknown"))
-            page = h.get("page", "?")
-            text = str(h.get("text", ""))
+_RAG_HTTP = None
 
-            prefix = f"[{doc_id} p.{page}] "
-            snippet = prefix + text
 
-            # store a clean version for the client UI
-            hits_export.append({
-                "doc_id": doc_id,
-                "page": page,
-                "text": text,
-            })
+def _rag_http():
+    global _RAG_HTTP
+    if _RAG_HTTP is None:
+        _RAG_HTTP = httpx.AsyncClient(
+            base_url=RAG_REMOTE_URL,
+            timeout=RAG_REMOTE_TIMEOUT,
+            limits=httpx.Limits(max_connections=RAG_REMOTE_POOL, max_keepalive_connections=RAG_REMOTE_POOL),
+        )
+    return _RAG_HTTP
 
-            if total_chars + len(snippet) > max_chars:
-                remaining = max_chars - total_chars
-                if remaining > 0:
-                    pieces.append(snippet[:remaining])
-                print(f"[RAG] Reached max_chars={max_chars}, truncating context.")
-                break
 
-            pieces.append(snippet)
-            total_chars += len(snippet)
+def rag_available() -> bool:
+    if RAG_REMOTE_URL:
+        return httpx is not None
+    return rag.is_enabled()
 
-            if RAG_DEBUG >= 1:
-                preview = text[:200].replace("\n", " ")
-                print(
-                    f"[RAG]  -> hit {idx}: {doc_id} p.{page} "
-                    f"(chunk len={len(text)}) preview='{preview}...'"
-                )
 
-        return "\n\n".join(pieces), hits_export
+async def retrieve_for_query(query: str, previous: Optional[str] = None):
+    """
+    Returns (context, hits, info) like rag.retrieve_context(..., info=info),
+    either from the remote retrieval service or in-process (in a worker thread).
+    `previous` is the previous user turn (used by multi-query retrieval).
+    """
+    if not RAG_REMOTE_URL:
+        info = {}
+        ctx, hits = await run_in_threadpool(rag.retrieve_context, query, info=info, previous=previous)
+        return ctx, hits, info
 
+    t0 = time.perf_counter()
+    try:
+        r = await _rag_http().post("/retrieve", json={"queries": [query], "previous": [previous]})
+        r.raise_for_status()
+        result = r.json()["results"][0]
+        metric_observe("rag_remote_ms", (time.perf_counter() - t0) * 1000.0)
+        return result["context"], result["hits"], result["info"]
     except Exception as e:
-        print(f"[RAG] Retrieval error: {e}")
-        return "", []
-
-# init RAG once, after model is loaded
-init_rag()
+        metric_inc("rag_remote_errors")
+        print(f"[RAG] Remote retrieval failed ({type(e).__name__}: {e}); answering without RAG.")
+        return "", [], {"skipped": "remote_error"}
+
+
+if RAG_REMOTE_URL:
+    if httpx is None:
+        print("[RAG] RAG_REMOTE_URL is set but httpx is not installed. RAG disabled.")
+    else:
+        print(f"[RAG] Using remote retrieval service at {RAG_REMOTE_URL} (timeout={RAG_REMOTE_TIMEOUT}s).")
+else:
+    # init RAG once, after model is loaded
+    init_rag()
+
+
+@app.on_event("shutdown")
+async def _close_rag_http():
+    global _RAG_HTTP
+    if _RAG_HTTP is not None:
+        # the client is bound to this event loop; a later loop creates a new one
+        client, _RAG_HTTP = _RAG_HTTP, None
+        await client.aclose()
+    rag.flush_query_cache()
 
 # ============================================================
 # Request/Response models
 # ============================================================
 
+MAX_CHOICES = int(os.environ.get("MAX_CHOICES", 8))  # upper bound for n
+
+
 class ChatMessage(BaseModel):
     role: Literal["system", "user", "assistant"]
     content: str
@@ -225,17 +599,22 @@ class ChatMessage(BaseModel):
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: List[ChatMessage]
-    max_tokens: int = 256
+    max_tokens: int = DEFAULT_MAX_TOKENS
     temperature: float = 0.7
     top_p: float = 0.95
+    n: int = Field(1, ge=1, le=MAX_CHOICES)
+    stop: Optional[Union[str, List[str]]] = None
     stream: bool = False
+    priority: Optional[str] = None  # priority class, overrides the X-Priority header
 
 
 class ChatRequest(BaseModel):
     prompt: str
-    max_new_tokens: int = 256
+    max_new_tokens: int = DEFAULT_MAX_TOKENS
     temperature: float = 0.7
     top_p: float = 0.95
+    stop: Optional[Union[str, List[str]]] = None
+    priority: Optional[str] = None
 
 
 class ChatResponse(BaseModel):
@@ -255,24 +634,250 @@ def build_prompt(messages: List[ChatMessage]) -> str:
     )
 
 
+# ============================================================
+# Chat history compaction
+# ============================================================
+#
+# Keeps the prompt size per turn roughly constant for long sessions:
+# - leading system message(s) are always kept
+# - then the newest turns (user message + replies) that fit both
+#   HISTORY_MAX_TURNS and HISTORY_TOKEN_BUDGET; the last turn is always kept
+# - RAG context blocks injected into earlier user messages are reduced to the question
+# - optionally (HISTORY_SUMMARY=1) the dropped turns are folded into a short summary
+#   appended to the system prompt. Turns are folded in blocks of HISTORY_SUMMARY_BLOCK,
+#   so the summary only changes every few turns and is served from a cache in between.
+# Everything is off by default (the prompt is the client's history as sent); set
+# HISTORY_MAX_TURNS and/or HISTORY_TOKEN_BUDGET to enable it. The summary runs a
+# generate(), so callers on the event loop go through run_in_threadpool.
+
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", 0))        # 0 = unlimited
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 0))  # 0 = unlimited
+HISTORY_STRIP_RAG = int(os.environ.get("HISTORY_STRIP_RAG", 0))
+HISTORY_SUMMARY = int(os.environ.get("HISTORY_SUMMARY", 0))
+HISTORY_SUMMARY_BLOCK = max(1, int(os.environ.get("HISTORY_SUMMARY_BLOCK", 4)))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", 160))
+HISTORY_SUMMARY_CACHE_SIZE = int(os.environ.get("HISTORY_SUMMARY_CACHE_SIZE", 256))
+
+RAG_CONTEXT_PREAMBLE = (
+    "Benutze den folgenden Kontext, bzw. die folgenden Informationen um die Fragen "
+    "der Nutzer*innen zu beantworten, wenn diese zur Frage passen:\n\n"
+)
+RAG_QUESTION_MARKER = "User question:\n"
+
+SUMMARY_INSTRUCTION = (
+    "Fasse den folgenden bisherigen Gesprächsverlauf in wenigen kurzen Sätzen zusammen. "
+    "Behalte Namen, Fakten und offene Fragen, lass Begrüßungen weg."
+)
+SUMMARY_PREFIX = "Zusammenfassung des bisherigen Gesprächs:\n"
+
+_SUMMARY_CACHE = OrderedDict()
+_SUMMARY_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False).input_ids)
+
+
+def strip_rag_context(content: str) -> str:
+    """Reduce a RAG-augmented user message back to the original question."""
+    if not content.startswith(RAG_CONTEXT_PREAMBLE):
+        return content
+    pos = content.rfind(RAG_QUESTION_MARKER)
+    return content[pos + len(RAG_QUESTION_MARKER):] if pos != -1 else content
+
+
+def _group_turns(messages: List[ChatMessage]) -> List[List[ChatMessage]]:
+    """A turn starts at a user message and includes the replies that follow it."""
+    turns: List[List[ChatMessage]] = []
+    for m in messages:
+        if m.role == "user" or not turns:
+            turns.append([m])
+        else:
+            turns[-1].append(m)
+    return turns
+
+
+def _turns_key(turns: List[List[ChatMessage]]) -> str:
+    h = hashlib.sha1()
+    for turn in turns:
+        for m in turn:
+            h.update(m.role.encode("utf-8") + b"\0" + m.content.encode("utf-8") + b"\0")
+    return h.hexdigest()
+
+
+def _summarize(previous_summary: str, turns: List[List[ChatMessage]]) -> str:
+    lines = []
+    if previous_summary:
+        lines.append(f"Bisherige Zusammenfassung: {previous_summary}")
+    for turn in turns:
+        for m in turn:
+            lines.append(f"{m.role}: {m.content}")
+
+    prompt = build_prompt([
+        ChatMessage(role="system", content=SUMMARY_INSTRUCTION),
+        ChatMessage(role="user", content="\n".join(lines)),
+    ])
+    inputs = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(INPUT_DEVICE)
+    out = run_generate(inputs, max_new_tokens=HISTORY_SUMMARY_MAX_TOKENS, temperature=0.3, top_p=0.9)
+    return tokenizer.decode(out[0][inputs.input_ids.shape[1]:], skip_special_tokens=True).strip()
+
+
+def _cached_summary(turns: List[List[ChatMessage]], n: int) -> str:
+    """
+    Summary of turns[:n] (n is a multiple of HISTORY_SUMMARY_BLOCK).
+    Built incrementally from the cached summary of turns[:n - block] when available.
+    """
+    key = _turns_key(turns[:n])
+    with _SUMMARY_LOCK:
+        if key in _SUMMARY_CACHE:
+            _SUMMARY_CACHE.move_to_end(key)
+            metric_inc("history_summary_cache_hits")
+            return _SUMMARY_CACHE[key]
+        prev_n = n - HISTORY_SUMMARY_BLOCK
+        prev = _SUMMARY_CACHE.get(_turns_key(turns[:prev_n])) if prev_n > 0 else ""
+
+    metric_inc("history_summary_cache_misses")
+    t0 = time.perf_counter()
+    if prev is not None:
+        summary = _summarize(prev, turns[max(prev_n, 0):n])
+    else:
+        summary = _summarize("", turns[:n])
+    metric_observe("history_summary_ms", (time.perf_counter() - t0) * 1000.0)
+
+    with _SUMMARY_LOCK:
+        _SUMMARY_CACHE[key] = summary
+        while len(_SUMMARY_CACHE) > HISTORY_SUMMARY_CACHE_SIZE:
+            _SUMMARY_CACHE.popitem(last=False)
+    return summary
+
+
+def compact_history(messages: List[ChatMessage]) -> List[ChatMessage]:
+    """Apply the history policy above. Returns a new list; the input is not modified."""
+    if not (HISTORY_MAX_TURNS or HISTORY_TOKEN_BUDGET or HISTORY_STRIP_RAG):
+        return list(messages)
+    n_system = 0
+    while n_system < len(messages) and messages[n_system].role == "system":
+        n_system += 1
+    system = list(messages[:n_system])
+    rest = list(messages[n_system:])
+
+    if HISTORY_STRIP_RAG and rest:
+        # the newest user message is handled by apply_rag_to_messages itself
+        last_user = max((i for i, m in enumerate(rest) if m.role == "user"), default=-1)
+        rest = [
+            ChatMessage(role=m.role, content=strip_rag_context(m.content))
+            if m.role == "user" and i != last_user else m
+            for i, m in enumerate(rest)
+        ]
+
+    turns = _group_turns(rest)
+    kept = 0
+    used = 0
+    for turn in reversed(turns):
+        cost = sum(count_tokens(m.content) for m in turn)
+        if kept and (
+            (HISTORY_MAX_TURNS and kept >= HISTORY_MAX_TURNS)
+            or (HISTORY_TOKEN_BUDGET and used + cost > HISTORY_TOKEN_BUDGET)
+        ):
+            break
+        kept += 1
+        used += cost
+
+    dropped = len(turns) - kept
+    if dropped and HISTORY_SUMMARY:
+        # fold whole blocks so the summary (and its cache key) stays stable between blocks
+        block = HISTORY_SUMMARY_BLOCK
+        dropped = min(-(-dropped // block) * block, len(turns) - 1)
+        dropped -= dropped % block
+        if dropped:
+            summary = _cached_summary(turns, dropped)
+            if summary:
+                if system:
+                    first = system[0]
+                    system[0] = ChatMessage(role="system", content=f"{first.content}\n\n{SUMMARY_PREFIX}{summary}")
+                else:
+                    system = [ChatMessage(role="system", content=SUMMARY_PREFIX + summary)]
+        else:
+            # not a full block yet: keep everything rather than silently losing turns
+            dropped = 0
+
+    if dropped:
+        metric_inc("history_turns_dropped", dropped)
+        if RAG_DEBUG:
+            print(f"[history] Dropped {dropped} old turn(s), kept {len(turns) - dropped}.")
+
+    return system + [m for turn in turns[dropped:] for m in turn]
+
+
+# ============================================================
+# Streaming helpers
+# ============================================================
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    Ends each sequence on the GPU as soon as its generated text contains a stop string.
+    Each row has its own StopMatcher, which decodes only the newest token and searches
+    only the tail that can hold a new match, so the cost per step is constant.
+    Returns a per-row bool tensor, so with n > 1 the other sequences keep running.
+    """
+
+    def __init__(self, tokenizer, stops: List[str], prompt_len: int):
+        self.tokenizer = tokenizer
+        self.stops = stops
+        self.prompt_len = prompt_len
+        self.matchers = None
+        self.stop_steps = []  # generated tokens at which each row stopped (None = not stopped)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        batch = input_ids.shape[0]
+        if self.matchers is None:
+            self.matchers = [StopMatcher(self.tokenizer, self.stops) for _ in range(batch)]
+            self.stop_steps = [None] * batch
+
+        steps = input_ids.shape[1] - self.prompt_len
+        newest = input_ids[:, -1].tolist()
+        stopped = []
+        for i, matcher in enumerate(self.matchers):
+            if not matcher.stopped and matcher.add(newest[i]):
+                self.stop_steps[i] = steps
+            stopped.append(matcher.stopped)
+
+        return torch.tensor(stopped, dtype=torch.bool, device=input_ids.device)
+
+
+def _eos_token_ids() -> List[int]:
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    if eos is None:
+        return []
+    return list(eos) if isinstance(eos, (list, tuple)) else [eos]
+
+
 # ============================================================
 # Helper: inject RAG context into last user message
 # ============================================================
 
-def apply_rag_to_messages(messages: List[ChatMessage]):
+async def apply_rag_to_messages(messages: List[ChatMessage]):
     """
     Find the *last* user message, retrieve context for it, and rewrite its content
     to include the retrieved context + the original question.
+    Retrieval runs in-process or on the remote retrieval service (see retrieve_for_query).
 
     Returns:
-      (new_messages, rag_hits_list, rag_user_message_text)
+      (new_messages, rag_hits_list, rag_user_message_text, rag_decision)
 
     rag_hits_list is [] and rag_user_message_text is None if RAG is disabled or nothing found.
+    rag_decision says whether context was injected and why not (sent to the client as meta).
     """
-    if not _RAG_ENABLED:
+    decision = {"injected": False, "reason": None}
+
+    if not rag_available():
         if RAG_DEBUG:
             print("[RAG] Disabled or unavailable, skipping injection.")
-        return messages, [], None
+        decision["reason"] = "disabled"
+        return messages, [], None, decision
 
     # find last user message index
     last_user_idx = None
@@ -282,28 +887,183 @@ def apply_rag_to_messages(messages: List[ChatMessage]):
             break
 
     if last_user_idx is None:
-        return messages, [], None
+        decision["reason"] = "no_user_message"
+        return messages, [], None, decision
 
     orig_user = messages[last_user_idx]
     user_text = orig_user.content
+    previous = next(
+        (strip_rag_context(m.content) for m in reversed(messages[:last_user_idx]) if m.role == "user"),
+        None,
+    )
 
-    ctx, hits = retrieve_context(user_text)
+    ctx, hits, info = await retrieve_for_query(user_text, previous)
+    decision.update(info)
     if not ctx:
         if RAG_DEBUG:
             print("[RAG] No context retrieved for this query.")
-        return messages, [], None
+        decision["reason"] = info.get("skipped") or "no_context"
+        return messages, [], None, decision
 
     print("[RAG] Injecting context into last user message.")
 
     new_user_content = (
-        "Benutze den folgenden Kontext, bzw. die folgenden Informationen um die Fragen der Nutzer*innen zu beantworten, wenn diese zur Frage passen:\n\n"
-        f"{ctx}\n\n"
-        f"User question:\n{user_text}"
+        RAG_CONTEXT_PREAMBLE
+        + f"{ctx}\n\n"
+        + RAG_QUESTION_MARKER
+        + user_text
     )
 
     new_msgs = list(messages)
     new_msgs[last_user_idx] = ChatMessage(role="user", content=new_user_content)
-    return new_msgs, hits, new_user_content
+    decision["injected"] = True
+    metric_inc("rag_injected")
+    return new_msgs, hits, new_user_content, decision
+
+
+# ============================================================
+# Priority classes + weighted-fair admission (opt-in)
+# ============================================================
+#
+# GENERATION_SLOTS bounds how many generations run at once; further requests wait
+# in one FIFO queue per priority class. A free slot goes to the class with the lowest
+# virtual time (stride scheduling): each admission advances its class by 1 / weight,
+# so with "interactive:4,batch:1" interactive requests get 4 of every 5 slots while
+# both are waiting, and batch jobs still make progress. CLIENT_MAX_CONCURRENCY caps
+# running + admitted requests per client (API key, else client address).
+# The class comes from the "priority" body field or the X-Priority header.
+
+def _parse_priority_classes(spec: str) -> dict:
+    classes = {}
+    for item in spec.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name:
+            classes[name.strip().lower()] = max(0.001, float(weight or 1))
+    return classes
+
+
+PRIORITY_CLASSES = _parse_priority_classes(os.environ.get("PRIORITY_CLASSES", "interactive:4,batch:1"))
+PRIORITY_DEFAULT = os.environ.get("PRIORITY_DEFAULT", "interactive").strip().lower()
+if PRIORITY_DEFAULT not in PRIORITY_CLASSES:
+    PRIORITY_CLASSES[PRIORITY_DEFAULT] = 1.0
+GENERATION_SLOTS = int(os.environ.get("GENERATION_SLOTS", 0))  # 0 = unlimited (no queueing)
+CLIENT_MAX_CONCURRENCY = int(os.environ.get("CLIENT_MAX_CONCURRENCY", 0))  # 0 = unlimited
+
+
+class FairScheduler:
+    """
+    Weighted-fair admission for generation requests. All methods run on the event loop;
+    release() may be scheduled from a generation thread via loop.call_soon_threadsafe.
+    """
+
+    def __init__(self, slots: int, weights: dict, client_cap: int):
+        self.slots = slots
+        self.weights = weights
+        self.client_cap = client_cap
+        self.running = 0
+        self.queues = {cls: deque() for cls in weights}  # entries: [future, client]
+        self.vtime = {cls: 0.0 for cls in weights}
+        self.by_client = {}
+
+    async def acquire(self, cls: str, client: str) -> None:
+        if not self.queues[cls]:
+            # a class that was idle does not get to spend its idle time as a burst
+            self.vtime[cls] = max(self.vtime[cls], self._min_vtime())
+
+        entry = [asyncio.get_running_loop().create_future(), client]
+        self.queues[cls].append(entry)
+        self._publish_depth(cls)
+        self._dispatch()
+        try:
+            await entry[0]
+        except asyncio.CancelledError:
+            if entry[0].done() and not entry[0].cancelled():
+                self.release(client)  # admitted but the client is gone
+            elif entry in self.queues[cls]:
+                self.queues[cls].remove(entry)
+                self._publish_depth(cls)
+            raise
+
+    def release(self, client: str) -> None:
+        self.running -= 1
+        self.by_client[client] -= 1
+        if self.by_client[client] <= 0:
+            del self.by_client[client]
+        self._dispatch()
+
+    def _min_vtime(self) -> float:
+        busy = [self.vtime[c] for c, q in self.queues.items() if q]
+        return min(busy) if busy else max(self.vtime.values(), default=0.0)
+
+    def _eligible(self, client: str) -> bool:
+        return self.client_cap <= 0 or self.by_client.get(client, 0) < self.client_cap
+
+    def _dispatch(self) -> None:
+        while self.slots <= 0 or self.running < self.slots:
+            pick = None
+            for cls in sorted(self.queues, key=lambda c: self.vtime[c]):
+                entry = next((e for e in self.queues[cls] if self._eligible(e[1])), None)
+                if entry is not None:
+                    pick = (cls, entry)
+                    break
+            if pick is None:
+                return
+
+            cls, entry = pick
+            self.queues[cls].remove(entry)
+            self._publish_depth(cls)
+            self.vtime[cls] += 1.0 / self.weights[cls]
+            self.running += 1
+            self.by_client[entry[1]] = self.by_client.get(entry[1], 0) + 1
+            entry[0].set_result(None)
+
+    def _publish_depth(self, cls: str) -> None:
+        metric_set(f"queue_depth.{cls}", len(self.queues[cls]))
+
+
+_SCHEDULER = FairScheduler(GENERATION_SLOTS, PRIORITY_CLASSES, CLIENT_MAX_CONCURRENCY)
+
+
+def request_priority(http_request: Request, body_priority: Optional[str]) -> str:
+    """Priority class of a request: body field, else X-Priority header, else PRIORITY_DEFAULT."""
+    cls = (body_priority or http_request.headers.get("x-priority") or PRIORITY_DEFAULT).strip().lower()
+    if cls not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"unknown priority '{cls}' (one of {sorted(PRIORITY_CLASSES)})")
+    return cls
+
+
+def request_stops(stop) -> List[str]:
+    """The request's stop sequences; 400 for more than MAX_STOP_SEQUENCES."""
+    try:
+        return normalize_stop(stop)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def request_client(http_request: Request) -> str:
+    """Client identity for concurrency caps: API key if sent, else the client address."""
+    auth = http_request.headers.get("authorization", "")
+    key = auth[7:].strip() if auth.lower().startswith("bearer ") else http_request.headers.get("x-api-key", "")
+    if key:
+        return "key:" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return "addr:" + (http_request.client.host if http_request.client else "unknown")
+
+
+async def admit(cls: str, client: str) -> None:
+    """Wait for a generation slot; records queue_wait_ms.<class>."""
+    t0 = time.perf_counter()
+    await _SCHEDULER.acquire(cls, client)
+    metric_observe(f"queue_wait_ms.{cls}", (time.perf_counter() - t0) * 1000.0)
+    metric_inc(f"requests.{cls}")
+
+
+# ============================================================
+# Metrics endpoint
+# ============================================================
+
+@app.get("/metrics")
+def metrics():
+    return metrics_snapshot()
 
 
 # ============================================================
@@ -311,24 +1071,34 @@ def apply_rag_to_messages(messages: List[ChatMessage]):
 # ============================================================
 
 @app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+async def chat(req: ChatRequest, http_request: Request):
+    t_request = time.perf_counter()
+    cls = request_priority(http_request, req.priority)
+    client = request_client(http_request)
+    stops = request_stops(req.stop)
+
     messages = [ChatMessage(role="user", content=req.prompt)]
-    messages, _rag_hits, _rag_user_message = apply_rag_to_messages(messages)
+    messages, _rag_hits, _rag_user_message, _rag_decision = await apply_rag_to_messages(messages)
 
     prompt = build_prompt(messages)
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda:0")
+    inputs = tokenizer(prompt, return_tensors="pt").to(INPUT_DEVICE)
 
-    with torch.no_grad():
-        out = model.generate(
-            **inputs,
+    await admit(cls, client)
+    try:
+        out = await run_in_threadpool(
+            run_generate,
+            inputs,
             max_new_tokens=req.max_new_tokens,
             temperature=req.temperature,
             top_p=req.top_p,
-            do_sample=True,
+            stop=stops,
         )
+    finally:
+        _SCHEDULER.release(client)
+    metric_observe(f"request_ms.{cls}", (time.perf_counter() - t_request) * 1000.0)
 
     new_tokens = out[0][inputs.input_ids.shape[1]:]
-    text = tokenizer.decode(new_tokens, skip_special_tokens=True)
+    text = truncate_at_stop(tokenizer.decode(new_tokens, skip_special_tokens=True), stops)
     return ChatResponse(response=text)
 
 
@@ -338,36 +1108,62 @@ def chat(req: ChatRequest):
 # ============================================================
 
 @app.post("/v1/chat/completions")
-async def v1_chat_completions(req: ChatCompletionRequest):
+async def v1_chat_completions(req: ChatCompletionRequest, http_request: Request):
+    t_request = time.perf_counter()
+    cls = request_priority(http_request, req.priority)
+    client = request_client(http_request)
+
+    stops = request_stops(req.stop)
 
-    # 1) apply RAG to messages
-    rag_messages, rag_hits, rag_user_message = apply_rag_to_messages(req.messages)
+    # the slot is taken before compact_history: a history summary is a generate() call too
+    # and must count against GENERATION_SLOTS and the client's cap like the answer itself
+    await admit(cls, client)
+    try:
+        # 1) bound the history, then apply RAG to the newest user message
+        messages = await run_in_threadpool(compact_history, req.messages)
+        rag_messages, rag_hits, rag_user_message, rag_decision = await apply_rag_to_messages(messages)
+
+        # 2) build prompt from RAG-augmented messages
+        prompt = build_prompt(rag_messages)
 
-    # 2) build prompt from RAG-augmented messages
-    prompt = build_prompt(rag_messages)
+        inputs = tokenizer(
+            prompt,
+            return_tensors="pt",
+            add_special_tokens=False,
+        ).to(INPUT_DEVICE)
+    except BaseException:
+        _SCHEDULER.release(client)
+        raise
 
-    inputs = tokenizer(
-        prompt,
-        return_tensors="pt",
-        add_special_tokens=False,
-    ).to("cuda:0")
+    metric_observe("prompt_tokens", inputs.input_ids.shape[1])
 
     # ============================================================
     # NON-STREAMING path
     # ============================================================
     if not req.stream:
-        with torch.no_grad():
-            out = model.generate(
-                **inputs,
+        try:
+            out = await run_in_threadpool(
+                run_generate,
+                inputs,
                 max_new_tokens=req.max_tokens,
-                do_sample=True,
                 temperature=req.temperature,
                 top_p=req.top_p,
+                num_return_sequences=req.n,
+                stop=stops,
             )
+        finally:
+            _SCHEDULER.release(client)
+        metric_observe(f"request_ms.{cls}", (time.perf_counter() - t_request) * 1000.0)
 
         prompt_len = inputs.input_ids.shape[1]
-        new_ids = out[0][prompt_len:]
-        text = tokenizer.decode(new_ids, skip_special_tokens=True)
+        choices = []
+        for i in range(out.shape[0]):
+            text = truncate_at_stop(tokenizer.decode(out[i][prompt_len:], skip_special_tokens=True), stops)
+            choices.append({
+                "index": i,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop"
+            })
 
         cid = f"chatcmpl-{uuid.uuid4().hex}"
         return {
@@ -375,39 +1171,36 @@ async def v1_chat_completions(req: ChatCompletionRequest):
             "object": "chat.completion",
             "created": int(time.time()),
             "model": req.model,
-            "choices": [{
-                "index": 0,
-                "message": {"role": "assistant", "content": text},
-                "finish_reason": "stop"
-            }],
+            "choices": choices,
             # extra transparency for your UI
             "rag_hits": rag_hits,
             "rag_user_message": rag_user_message,
+            "rag_decision": rag_decision,
         }
 
     # ============================================================
     # TRUE STREAMING path - send RAG meta first, then tokens
     # ============================================================
 
-    streamer = TextIteratorStreamer(
-        tokenizer,
-        skip_special_tokens=True,
-        skip_prompt=True,
-    )
+    # one prefill, n sampled sequences; each streams as its own choices[].index
+    streamer = ChoiceStreamer(tokenizer, n=req.n, eos_token_ids=_eos_token_ids(), stops=stops)
+
+    loop = asyncio.get_running_loop()
 
     def generate():
-        with torch.no_grad():
-            model.generate(
-                **inputs,
-                max_new_tokens=req.max_tokens,
-                do_sample=True,
-                temperature=req.temperature,
-                top_p=req.top_p,
-                streamer=streamer,
-            )
+        run_generate(
+            inputs,
+            max_new_tokens=req.max_tokens,
+            temperature=req.temperature,
+            top_p=req.top_p,
+            streamer=streamer,
+            num_return_sequences=req.n,
+            stop=stops,
+        )
 
-    thread = threading.Thread(target=generate)
-    thread.start()
+    # a failing generate() ends the stream with streamer.error set; the slot is held
+    # until the GPU work ends, even if the client disconnected
+    start_generation(generate, streamer, lambda: loop.call_soon_threadsafe(_SCHEDULER.release, client))
 
     cid = f"chatcmpl-{uuid.uuid4().hex}"
 
@@ -419,25 +1212,37 @@ async def v1_chat_completions(req: ChatCompletionRequest):
             "created": int(time.time()),
             "model": req.model,
             "choices": [{
-                "index": 0,
+                "index": i,
                 "delta": {},          # no tokens here
                 "finish_reason": None
-            }],
+            } for i in range(req.n)],
             "rag_hits": rag_hits,
             "rag_user_message": rag_user_message,
+            "rag_decision": rag_decision,
         }
         yield "data: " + _json.dumps(meta, ensure_ascii=False) + "\n\n"
 
-        # 2) THEN: token-by-token stream
-        first_token = True
-        for token in streamer:
+        # 2) THEN: token-by-token stream (interleaved across choices when n > 1)
+        started = [False] * req.n
+        last_token_at = [None] * req.n
+        # the streamer blocks while waiting for tokens -> iterate it off the event loop
+        async for index, token in iterate_in_threadpool(streamer):
             if not token:
                 continue
 
+            now = time.perf_counter()
+            if not any(started):
+                metric_observe("ttft_ms", (now - t_request) * 1000.0)
+                metric_observe(f"ttft_ms.{cls}", (now - t_request) * 1000.0)
+            if last_token_at[index] is not None:
+                metric_observe("itl_ms", (now - last_token_at[index]) * 1000.0)
+                metric_observe(f"itl_ms.{cls}", (now - last_token_at[index]) * 1000.0)
+            last_token_at[index] = now
+
             delta = {"content": token}
-            if first_token:
+            if not started[index]:
                 delta["role"] = "assistant"
-                first_token = False
+                started[index] = True
 
             chunk = {
                 "id": cid,
@@ -445,7 +1250,7 @@ async def v1_chat_completions(req: ChatCompletionRequest):
                 "created": int(time.time()),
                 "model": req.model,
                 "choices": [{
-                    "index": 0,
+                    "index": index,
                     "delta": delta,
                     "finish_reason": None
                 }]
@@ -453,20 +1258,23 @@ async def v1_chat_completions(req: ChatCompletionRequest):
 
             yield "data: " + _json.dumps(chunk, ensure_ascii=False) + "\n\n"
 
-        # final chunk with finish_reason=stop
+        # final chunk with finish_reason=stop, or "error" if generation failed mid-stream
         final = {
             "id": cid,
             "object": "chat.completion.chunk",
             "created": int(time.time()),
             "model": req.model,
             "choices": [{
-                "index": 0,
+                "index": i,
                 "delta": {},
-                "finish_reason": "stop"
-            }]
+                "finish_reason": "stop" if streamer.error is None else "error"
+            } for i in range(req.n)]
         }
+        if streamer.error is not None:
+            final["error"] = {"message": f"generation failed: {streamer.error}", "type": "server_error"}
         yield "data: " + _json.dumps(final, ensure_ascii=False) + "\n\n"
         yield "data: [DONE]\n\n"
+        metric_observe(f"request_ms.{cls}", (time.perf_counter() - t_request) * 1000.0)
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
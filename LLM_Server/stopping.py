@@ -0,0 +1,103 @@
+"""
+stopping.py
+
+Stop-string helpers shared by server.py and batch_infer.py (no torch needed):
+OpenAI `stop` normalization, searching/cutting text at a stop string, incremental
+detokenization, and StopMatcher, the per-sequence check behind StopSequenceCriteria.
+"""
+
+from typing import List
+
+MAX_STOP_SEQUENCES = 4  # same limit as the OpenAI API
+
+
+class IncrementalDecoder:
+    """
+    Turns a growing list of token ids into text deltas.
+    Only the last few tokens are re-decoded per step (prefix/read offsets), and a
+    trailing incomplete UTF-8 character is held back until the next token completes it.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add(self, token_ids: List[int]) -> str:
+        self.ids.extend(token_ids)
+        prefix_text = self.tokenizer.decode(
+            self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(self.ids[self.prefix_offset:], skip_special_tokens=True)
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+
+def normalize_stop(stop) -> List[str]:
+    """
+    OpenAI `stop` may be a string or a list of strings; empty strings are ignored.
+    Raises ValueError for more than MAX_STOP_SEQUENCES (the API rejects those too).
+    """
+    if not stop:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    stops = [s for s in stop if s]
+    if len(stops) > MAX_STOP_SEQUENCES:
+        raise ValueError(f"at most {MAX_STOP_SEQUENCES} stop sequences are allowed, got {len(stops)}")
+    return stops
+
+
+def find_stop(text: str, stops: List[str]) -> int:
+    """Index of the earliest stop string in text, or -1."""
+    positions = [p for p in (text.find(s) for s in stops) if p != -1]
+    return min(positions) if positions else -1
+
+
+def partial_stop_len(text: str, stops: List[str]) -> int:
+    """Length of the longest suffix of text that is a proper prefix of a stop string."""
+    best = 0
+    for s in stops:
+        for k in range(min(len(s) - 1, len(text)), best, -1):
+            if text.endswith(s[:k]):
+                best = k
+                break
+    return best
+
+
+def truncate_at_stop(text: str, stops: List[str]) -> str:
+    pos = find_stop(text, stops) if stops else -1
+    return text if pos == -1 else text[:pos]
+
+
+class StopMatcher:
+    """
+    Stop check for one generated sequence, fed one token id per step.
+    Only the newest token is decoded and only the tail that can hold a new match
+    (the last len(longest stop) - 1 characters plus the delta) is searched.
+    """
+
+    def __init__(self, tokenizer, stops: List[str]):
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.stops = stops
+        self.keep = max(len(s) for s in stops) - 1
+        self.tail = ""
+        self.stopped = False
+
+    def add(self, token_id: int) -> bool:
+        """Feeds the next token; True once the text contains a stop string."""
+        if self.stopped:
+            return True
+        delta = self.decoder.add([token_id])
+        if not delta:
+            return False
+        tail = self.tail + delta
+        if find_stop(tail, self.stops) != -1:
+            self.stopped = True
+        # a tail shorter than `keep` is kept whole (stop strings spread over early tokens)
+        self.tail = tail[-self.keep:] if self.keep else ""
+        return self.stopped
@@ -0,0 +1,130 @@
+"""
+streaming.py
+
+Streaming side of generation for server.py: ChoiceStreamer turns the token ids that
+generate() pushes into per-choice text deltas, and start_generation() runs generate()
+in a thread so that a failure still ends the stream instead of leaving the reader
+blocked on the queue.
+"""
+
+import queue
+import threading
+from typing import Callable, Optional
+
+from metrics import metric_inc
+from stopping import IncrementalDecoder, find_stop, partial_stop_len
+
+
+class ChoiceStreamer:
+    """
+    Streamer for one or more sampled sequences (generate(..., num_return_sequences=n)).
+    Iterating yields (choice_index, text_delta) tuples until generation has finished.
+    Tokens after a sequence's EOS (padding while the other sequences continue) are dropped.
+    With stop strings, text that might still turn into a stop sequence is held back, and
+    a sequence ends right before its first stop string, so cut text never reaches the client.
+    If generation fails, fail(error) ends the iteration too and leaves the error in
+    self.error (generate() does not call end() when it raises).
+    """
+
+    def __init__(self, tokenizer, n: int = 1, eos_token_ids=None, stops=None, timeout=None):
+        self.n = n
+        self.timeout = timeout
+        self.eos_token_ids = set(eos_token_ids or [])
+        self.stops = stops or []
+        self.decoders = [IncrementalDecoder(tokenizer) for _ in range(n)]
+        self.pending = [""] * n
+        self.finished = [False] * n
+        self.queue = queue.Queue()
+        self.error: Optional[BaseException] = None
+        self._prompt_seen = False
+        self._closed = False
+
+    def put(self, value):
+        # generate() first pushes the prompt ids, then one token per sequence per step
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+
+        rows = value.reshape(self.n, -1).tolist()
+        for i, row in enumerate(rows):
+            if self.finished[i]:
+                continue
+            kept = []
+            for tok in row:
+                if tok in self.eos_token_ids:
+                    self.finished[i] = True
+                    break
+                kept.append(tok)
+            if kept:
+                delta = self.decoders[i].add(kept)
+                if delta:
+                    self._emit(i, delta)
+
+    def _emit(self, i: int, delta: str):
+        if not self.stops:
+            self.queue.put((i, delta))
+            return
+
+        text = self.pending[i] + delta
+        pos = find_stop(text, self.stops)
+        if pos != -1:
+            self.finished[i] = True
+            self.pending[i] = ""
+            if pos > 0:
+                self.queue.put((i, text[:pos]))
+            return
+
+        hold = partial_stop_len(text, self.stops)
+        self.pending[i] = text[len(text) - hold:] if hold else ""
+        if len(text) > hold:
+            self.queue.put((i, text[:len(text) - hold]))
+
+    def end(self):
+        if self._closed:
+            return
+        self._closed = True
+        # held-back text that never completed a stop sequence belongs to the answer
+        for i, rest in enumerate(self.pending):
+            if rest and not self.finished[i]:
+                self.queue.put((i, rest))
+        self.pending = [""] * self.n
+        self.queue.put(None)
+
+    def fail(self, error: BaseException):
+        """Ends the stream after a generation error; text held back for stop strings is dropped."""
+        if self._closed:
+            return
+        self._closed = True
+        self.error = error
+        self.queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get(timeout=self.timeout)
+        if item is None:
+            raise StopIteration
+        return item
+
+
+def start_generation(generate: Callable[[], object], streamer: ChoiceStreamer,
+                     on_done: Callable[[], None]) -> threading.Thread:
+    """
+    Runs generate() (which feeds `streamer`) in a new thread. If it raises, the
+    streamer is ended with the error; on_done() runs last either way.
+    """
+
+    def target():
+        try:
+            generate()
+        except Exception as e:
+            print(f"[ERROR] Generation failed: {type(e).__name__}: {e}")
+            metric_inc("generate_errors")
+            streamer.fail(e)
+        finally:
+            on_done()
+
+    thread = threading.Thread(target=target, name="generate")
+    thread.start()
+    return thread
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# LLM_Server is a directory of scripts, not a package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
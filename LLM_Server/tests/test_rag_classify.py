@@ -0,0 +1,39 @@
+import pytest
+
+for mod in ("numpy", "pyarrow", "lancedb", "sentence_transformers"):
+    pytest.importorskip(mod)
+
+import rag  # noqa: E402
+
+
+@pytest.fixture
+def skip_smalltalk(monkeypatch):
+    monkeypatch.setattr(rag, "RAG_SKIP_SMALLTALK", 1)
+
+
+def test_smalltalk_skip_is_off_by_default():
+    assert rag.classify_query("Hallo") is None
+
+
+@pytest.mark.parametrize("message", ["Hallo!", "Vielen Dank.", "guten Morgen", "Thank you", "tschüss"])
+def test_bare_greetings_skip(skip_smalltalk, message):
+    assert rag.classify_query(message) == "smalltalk"
+
+
+@pytest.mark.parametrize("message", [
+    "Wie geht das?",
+    "Bis wann?",
+    "Wann ist die Bibliothek offen?",
+    "Guten Tag, wo ist das Prüfungsamt?",
+    "Danke, und wie melde ich mich ab?",
+    "Wie geht es dir mit Mathe?",
+    "How are you graded?",
+    "Is there a deadline?",
+    "Ok, und dann?",
+])
+def test_short_questions_still_retrieve(skip_smalltalk, message):
+    assert rag.classify_query(message) is None
+
+
+def test_empty(skip_smalltalk):
+    assert rag.classify_query(" ?! ") == "empty"
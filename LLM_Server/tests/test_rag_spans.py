@@ -0,0 +1,71 @@
+import pytest
+
+for mod in ("numpy", "pyarrow", "lancedb", "sentence_transformers"):
+    pytest.importorskip(mod)
+
+import pyarrow as pa  # noqa: E402
+
+from rag import merge_chunk_texts, select_spans  # noqa: E402
+
+
+def test_merge_long_overlap():
+    a = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda"
+    b = "eta theta iota kappa lambda mu nu xi omicron pi rho sigma"
+    assert merge_chunk_texts(a, b) == a + " mu nu xi omicron pi rho sigma"
+
+
+def test_merge_overlap_shorter_than_32_chars():
+    assert merge_chunk_texts("eta theta", "theta iota") == "eta theta iota"
+
+
+def test_merge_overlap_mid_word():
+    assert merge_chunk_texts("the quick bro", "rown fox") == "the quick brown fox"
+
+
+def test_merge_prefers_longest_overlap():
+    assert merge_chunk_texts("ab ab ab", "ab ab cd") == "ab ab ab cd"
+
+
+def test_merge_without_overlap_joins_with_space():
+    assert merge_chunk_texts("alpha beta", "gamma delta") == "alpha beta gamma delta"
+    assert merge_chunk_texts("", "gamma") == "gamma"
+    assert merge_chunk_texts("alpha", "") == "alpha"
+
+
+def hits(rows):
+    names = ["doc_id", "page", "chunk", "text", "_distance"]
+    return pa.table({n: [r[i] for r in rows] for i, n in enumerate(names)})
+
+
+def test_adjacent_hits_share_a_span_and_free_the_slot():
+    result = hits([
+        ("a.pdf", 1, 4, "four", 0.1),
+        ("a.pdf", 1, 5, "five", 0.2),   # adjacent -> joins the first span
+        ("a.pdf", 2, 6, "other page", 0.3),
+        ("b.pdf", 1, 5, "other doc", 0.4),
+        ("c.pdf", 1, 0, "over budget", 0.5),
+    ])
+    spans, merged = select_spans(result, top_k=3)
+    assert merged == 1
+    assert [(sp["doc_id"], sp["page"]) for sp in spans] == [("a.pdf", 1), ("a.pdf", 2), ("b.pdf", 1)]
+    assert spans[0]["chunks"] == {4: "four", 5: "five"}
+    assert spans[0]["distance"] == 0.1 and spans[0]["rank"] == 0
+
+
+def test_hit_bridging_two_spans_joins_them():
+    result = hits([
+        ("a.pdf", 1, 2, "two", 0.1),
+        ("a.pdf", 1, 4, "four", 0.2),
+        ("a.pdf", 1, 3, "three", 0.3),
+    ])
+    spans, merged = select_spans(result, top_k=5)
+    assert merged == 1
+    assert len(spans) == 1
+    assert sorted(spans[0]["chunks"]) == [2, 3, 4]
+
+
+def test_hits_without_chunk_index_are_not_merged():
+    result = pa.table({"doc_id": ["a.pdf", "a.pdf"], "page": [1, 1], "text": ["x", "y"], "_distance": [0.1, 0.2]})
+    spans, merged = select_spans(result, top_k=5)
+    assert merged == 0
+    assert len(spans) == 2
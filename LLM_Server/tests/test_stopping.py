@@ -0,0 +1,47 @@
+import pytest
+
+from stopping import MAX_STOP_SEQUENCES, StopMatcher, normalize_stop, partial_stop_len, truncate_at_stop
+
+
+class FakeTokenizer:
+    """Token id i decodes to vocab[i]."""
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(self.vocab[i] for i in ids)
+
+
+def feed(pieces, stops):
+    tok = FakeTokenizer(pieces)
+    matcher = StopMatcher(tok, stops)
+    return [matcher.add(i) for i in range(len(pieces))]
+
+
+def test_stop_spanning_three_tokens_at_start():
+    assert feed(["Use", "r", ":", " hi"], ["User:"]) == [False, False, True, True]
+
+
+def test_stop_spanning_two_tokens_at_start():
+    assert feed(["\n\nUs", "er"], ["\n\nUser"]) == [False, True]
+
+
+def test_stop_spanning_tokens_later_in_output():
+    assert feed(["Hello", " there", ".", "Us", "er", ":"], ["User:"]) == [False] * 5 + [True]
+
+
+def test_no_stop():
+    assert feed(["Use", "r", " name"], ["User:"]) == [False, False, False]
+
+
+def test_helpers():
+    assert normalize_stop("x") == ["x"]
+    assert normalize_stop(["a", "", "b", "c", "d"]) == ["a", "b", "c", "d"]
+    assert truncate_at_stop("answer User: more", ["User:"]) == "answer "
+    assert partial_stop_len("answer Us", ["User:"]) == 2
+
+
+def test_too_many_stop_sequences_are_rejected():
+    with pytest.raises(ValueError):
+        normalize_stop([str(i) for i in range(MAX_STOP_SEQUENCES + 1)])
@@ -0,0 +1,55 @@
+import pytest
+
+from streaming import ChoiceStreamer, start_generation
+
+np = pytest.importorskip("numpy")
+
+
+class FakeTokenizer:
+    """Token id i decodes to vocab[i]."""
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(self.vocab[i] for i in ids)
+
+
+def test_tokens_stream_until_stop_string():
+    streamer = ChoiceStreamer(FakeTokenizer(["Hi", " there", "Us", "er", ":"]), stops=["User:"])
+
+    def generate():
+        streamer.put(np.array([[0]]))  # prompt
+        for tok in range(1, 5):
+            streamer.put(np.array([tok]))
+        streamer.end()
+
+    done = []
+    thread = start_generation(generate, streamer, lambda: done.append(True))
+    assert list(streamer) == [(0, " there")]
+    thread.join(timeout=5)
+    assert streamer.error is None and done == [True]
+
+
+def test_failing_generate_still_ends_stream():
+    streamer = ChoiceStreamer(FakeTokenizer(["Hi", " there"]), timeout=5)
+
+    def generate():
+        streamer.put(np.array([[0]]))
+        streamer.put(np.array([1]))
+        raise RuntimeError("CUDA out of memory")
+
+    done = []
+    thread = start_generation(generate, streamer, lambda: done.append(True))
+    assert list(streamer) == [(0, " there")]  # would raise queue.Empty if the stream hung
+    thread.join(timeout=5)
+    assert isinstance(streamer.error, RuntimeError)
+    assert done == [True]
+
+
+def test_end_after_fail_is_ignored():
+    streamer = ChoiceStreamer(FakeTokenizer(["a"]), timeout=5)
+    streamer.fail(ValueError("boom"))
+    streamer.end()
+    assert list(streamer) == []
+    assert streamer.queue.empty()